@@ -0,0 +1,152 @@
+# backfill.py
+# `flask backfill-webhooks` - replay a JSONL archive of OpenPhone webhook payloads without going through HTTP.
+
+import gzip
+import json
+import time
+import click
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam
+from extensions import db
+from models import Message, MessageMedia
+from ingest import parse_webhook_event, ingest_events, InvalidWebhookEvent
+from media_jobs import download_media
+from media_catalog import build_media_rows
+from message_stats import message_stats
+from gallery_overview import gallery_overview
+
+
+def iter_archive(path):
+    """Yield (line_number, line) for each non-blank line of a .jsonl / .jsonl.gz archive ('-' for stdin)."""
+    if path == "-":
+        stream = click.get_text_stream("stdin")
+    elif path.endswith(".gz"):
+        stream = gzip.open(path, "rt", encoding="utf-8")
+    else:
+        stream = open(path, "r", encoding="utf-8")
+    with stream:
+        for line_no, line in enumerate(stream, start=1):
+            line = line.strip()
+            if line:
+                yield line_no, line
+
+
+def _download_for_message(app, message_id, urls, upload_dir):
+    with app.app_context():
+        return message_id, download_media(message_id, urls, upload_dir)
+
+
+def _store_media_paths(done_futures, upload_dir):
+    """Record finished downloads: one executemany INSERT into message_media plus the legacy column UPDATE."""
+    saved = {}
+    for future in done_futures:
+        try:
+            message_id, saved_paths = future.result()
+        except Exception as e:
+            current_app.logger.error(f"❌ Backfill media download failed: {e}")
+            continue
+        if saved_paths:
+            saved[message_id] = saved_paths
+    if saved:
+        property_ids = dict(
+            db.session.query(Message.id, Message.property_id).filter(Message.id.in_(list(saved))).all()
+        )
+        media_rows = []
+        for message_id, saved_paths in saved.items():
+            media_rows.extend(build_media_rows(message_id, property_ids.get(message_id), saved_paths, upload_dir))
+        db.session.execute(db.insert(MessageMedia), media_rows)
+        table = Message.__table__
+        db.session.execute(
+            table.update().where(table.c.id == bindparam("message_id")).values(local_media_paths=bindparam("paths")),
+            [{"message_id": m, "paths": ",".join(path for _, path in p)} for m, p in saved.items()],
+        )
+        db.session.commit()
+        message_stats.invalidate()
+        gallery_overview.invalidate()
+    return len(saved)
+
+
+@click.command("backfill-webhooks")
+@click.argument("archive")
+@click.option("--batch-size", default=500, show_default=True, help="Events per insert transaction.")
+@click.option("--media-workers", default=8, show_default=True, help="Parallel media downloads (0 skips media).")
+@click.option("--progress-every", default=1, show_default=True, help="Print progress every N batches.")
+@with_appcontext
+def backfill_webhooks(archive, batch_size, media_workers, progress_every):
+    """Ingest ARCHIVE (JSONL of webhook payloads, optionally .gz, '-' for stdin).
+
+    Uses the webhook's parsing and the batched insert path. Messages keep the payload's createdAt,
+    replayed SIDs are skipped, and no notification emails are sent for historical messages.
+    """
+    app = current_app._get_current_object()
+    upload_dir = app.config.get("UPLOAD_FOLDER")
+    if media_workers and not upload_dir:
+        raise click.ClickException("UPLOAD_FOLDER is not configured; rerun with --media-workers 0 to skip media.")
+
+    executor = ThreadPoolExecutor(max_workers=media_workers, thread_name_prefix="backfill-media") if media_workers > 0 else None
+    max_in_flight = max(media_workers * 4, 1)
+    in_flight = set()
+    totals = {"lines": 0, "invalid": 0, "inserted": 0, "duplicates": 0, "contacts_created": 0, "media_messages": 0}
+    started = time.time()
+
+    def flush_downloads(block_until):
+        nonlocal in_flight
+        while len(in_flight) > block_until:
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            totals["media_messages"] += _store_media_paths(done, upload_dir)
+
+    def ingest_batch(batch, batch_no):
+        result = ingest_events(batch, submit_jobs=False, create_jobs=False, use_event_time=True)
+        for key in ("inserted", "duplicates", "contacts_created"):
+            totals[key] += result[key]
+
+        if executor:
+            inserted = result["inserted_ids"]
+            for e in batch:
+                if e["direction"] == "incoming" and e["urls"] and e["sid"] in inserted:
+                    in_flight.add(executor.submit(_download_for_message, app, inserted[e["sid"]], e["urls"], upload_dir))
+                    inserted.pop(e["sid"]) # Same SID twice in one batch only downloads once
+            # Bound the download backlog so memory stays flat on large archives
+            flush_downloads(max_in_flight)
+
+        if batch_no % progress_every == 0:
+            elapsed = max(time.time() - started, 1e-6)
+            click.echo(
+                f"batch {batch_no}: {totals['lines']} lines, {totals['inserted']} new, "
+                f"{totals['duplicates']} duplicate, {totals['invalid']} invalid, "
+                f"{len(in_flight)} media pending | {totals['lines'] / elapsed:,.0f} rows/sec"
+            )
+
+    batch, batch_no = [], 0
+    try:
+        for line_no, line in iter_archive(archive):
+            totals["lines"] += 1
+            try:
+                batch.append(parse_webhook_event(json.loads(line)))
+            except (ValueError, AttributeError, InvalidWebhookEvent) as e:
+                totals["invalid"] += 1
+                current_app.logger.warning(f"⚠️ Skipping archive line {line_no}: {e}")
+                continue
+            if len(batch) >= batch_size:
+                batch_no += 1
+                ingest_batch(batch, batch_no)
+                batch = []
+        if batch:
+            batch_no += 1
+            ingest_batch(batch, batch_no)
+        if executor:
+            click.echo(f"waiting for {len(in_flight)} media download(s)...")
+            flush_downloads(0)
+    finally:
+        if executor:
+            executor.shutdown(wait=True)
+
+    elapsed = max(time.time() - started, 1e-6)
+    click.echo(
+        f"done: {totals['lines']} lines in {elapsed:.1f}s ({totals['lines'] / elapsed:,.0f} rows/sec) - "
+        f"{totals['inserted']} messages inserted, {totals['duplicates']} duplicates, {totals['invalid']} invalid, "
+        f"{totals['contacts_created']} contacts created, media saved for {totals['media_messages']} message(s)"
+    )
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# benchmarks/smtp_pool_bench.py
+# Messages/sec of the SMTP email backend (email_utils._send_via_smtp) with and without connection pooling.
+#
+#   python benchmarks/smtp_pool_bench.py --messages 500 --threads 8 --pool-sizes 0,1,4,8
+#   python benchmarks/smtp_pool_bench.py --no-tls --latency-ms 0 --output smtp.json
+#   python benchmarks/smtp_pool_bench.py --server 127.0.0.1:2525 --no-tls   # against benchmarks/smtp_sink.py
+#
+# Starts an in-process SMTP sink (STARTTLS with a self-signed certificate unless --no-tls) and sends the
+# same messages once per pool size; SMTP_POOL_SIZE=0 is the old connection-per-message behaviour.
+
+import io
+import os
+import sys
+import ssl
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from smtp_sink import SMTPSink, make_self_signed_cert # noqa: E402
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark SMTP sends with and without the connection pool.")
+    p.add_argument("--messages", type=int, default=300, help="Messages per run.")
+    p.add_argument("--threads", type=int, default=8, help="Concurrent senders.")
+    p.add_argument("--pool-sizes", default="0,4", help="Comma-separated SMTP_POOL_SIZE values to compare.")
+    p.add_argument("--latency-ms", type=float, default=5, help="Sink reply delay, modelling the network round trip.")
+    p.add_argument("--no-tls", action="store_true", help="Plain SMTP instead of STARTTLS.")
+    p.add_argument("--drop-after", type=int, default=0, help="Sink closes connections after N messages.")
+    p.add_argument("--attachment-bytes", type=int, default=0, help="Attach a file of this size to every message.")
+    p.add_argument("--server", help="host:port of an already running sink instead of an in-process one.")
+    p.add_argument("--output", help="Write the JSON report here (default: stdout).")
+    return p.parse_args(argv)
+
+
+def start_sink(args):
+    """(host, port, sink or None); sets SSL_CERT_FILE so the client trusts the sink's certificate."""
+    if args.server:
+        host, port = args.server.rsplit(":", 1)
+        return host, int(port), None
+    context = None
+    if not args.no_tls:
+        certfile, keyfile = make_self_signed_cert(tempfile.mkdtemp(prefix="smtp-bench-"))
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile, keyfile)
+        os.environ["SSL_CERT_FILE"] = certfile
+    sink = SMTPSink(("127.0.0.1", 0), tls_context=context, latency_ms=args.latency_ms, drop_after=args.drop_after)
+    host, port = sink.start()
+    return "localhost", port, sink
+
+
+def run_once(args, pool_size, send):
+    import email_utils
+    os.environ["SMTP_POOL_SIZE"] = str(pool_size)
+    pool = email_utils.get_smtp_pool()
+    attachments = None
+    if args.attachment_bytes:
+        import base64
+        attachments = [{"filename": "report.pdf", "type": "application/pdf",
+                        "content": base64.b64encode(os.urandom(args.attachment_bytes)).decode()}]
+
+    latencies = []
+    errors = []
+
+    def one(i):
+        started = time.perf_counter()
+        try:
+            send(f"tenant{i}@example.com", f"Notice {i}", f"<p>Hello tenant {i}</p>", attachments=attachments)
+        except Exception as e:
+            errors.append(str(e))
+            return
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()): # _send_via_smtp prints per message
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            list(executor.map(one, range(args.messages)))
+    elapsed = time.perf_counter() - started
+    pool.close()
+
+    latencies.sort()
+    pct = lambda p: round(latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))], 2) if latencies else None
+    return {
+        "pool_size": pool_size,
+        "messages_sent": len(latencies),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "elapsed_sec": round(elapsed, 3),
+        "messages_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "latency_ms": {"p50": pct(50), "p95": pct(95), "p99": pct(99)},
+        "pool": pool.stats(),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    host, port, sink = start_sink(args)
+    os.environ.update({
+        "SMTP_SERVER": host,
+        "SMTP_PORT": str(port),
+        "SMTP_USERNAME": "bench",
+        "SMTP_PASSWORD": "bench",
+        "SMTP_FROM": "bench@example.com",
+        "SMTP_SECURITY": "none" if args.no_tls else "starttls",
+    })
+    import email_utils
+
+    runs = []
+    for size in [int(s) for s in args.pool_sizes.split(",") if s.strip()]:
+        before = sink.stats() if sink else None
+        result = run_once(args, size, email_utils._send_via_smtp)
+        if sink:
+            after = sink.stats()
+            result["server"] = {k: after[k] - before[k] for k in after}
+        runs.append(result)
+        print(f"pool_size={size}: {result['messages_per_sec']} msg/sec, "
+              f"{result['pool']['opened']} connections, {result['errors']} errors", file=sys.stderr)
+
+    baseline = next((r for r in runs if r["pool_size"] == 0), None)
+    if baseline and baseline["messages_per_sec"]:
+        for r in runs:
+            r["speedup_vs_unpooled"] = round((r["messages_per_sec"] or 0) / baseline["messages_per_sec"], 2)
+
+    report = {
+        "benchmark": "smtp_pool",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "runs": runs,
+    }
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if sink:
+        sink.shutdown()
+
+
+if __name__ == "__main__":
+    main()
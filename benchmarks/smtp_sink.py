@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# benchmarks/smtp_sink.py
+# Local SMTP server that accepts and discards every message, for benchmarking the SMTP backend.
+#
+#   python benchmarks/smtp_sink.py --port 2525                      # plain SMTP + AUTH
+#   python benchmarks/smtp_sink.py --port 2525 --tls --latency-ms 20   # STARTTLS with a self-signed cert
+#
+# Speaks enough ESMTP for smtplib: EHLO, STARTTLS, AUTH PLAIN/LOGIN (any credentials), MAIL, RCPT, DATA,
+# RSET, NOOP, QUIT. --latency-ms delays the greeting and every reply to model a remote server's round
+# trip; --drop-after closes a connection after N messages to exercise client reconnects.
+
+import os
+import ssl
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import subprocess
+import socketserver
+
+
+def make_self_signed_cert(directory):
+    """(certfile, keyfile) for CN=localhost, generated with the openssl CLI."""
+    certfile = os.path.join(directory, "sink-cert.pem")
+    keyfile = os.path.join(directory, "sink-key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-keyout", keyfile, "-out", certfile, "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        check=True, capture_output=True,
+    )
+    return certfile, keyfile
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """Threaded SMTP server counting connections, logins and accepted messages."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, tls_context=None, latency_ms=0, drop_after=0):
+        super().__init__(address, _SinkHandler)
+        self.tls_context = tls_context
+        self.latency = latency_ms / 1000.0
+        self.drop_after = drop_after
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.logins = 0
+        self.messages = 0
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def start(self):
+        """Serve from a daemon thread; returns (host, port)."""
+        threading.Thread(target=self.serve_forever, name="smtp-sink", daemon=True).start()
+        return self.server_address
+
+    def stats(self):
+        return {"connections": self.connections, "logins": self.logins, "messages": self.messages}
+
+
+class _SinkHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+        self.wfile.flush()
+
+    def readline(self):
+        line = self.rfile.readline(65536)
+        if not line:
+            raise ConnectionError("client closed")
+        return line.rstrip(b"\r\n").decode("utf-8", "replace")
+
+    def handle(self):
+        self.server.count("connections")
+        sent = 0
+        tls = False
+        try:
+            self.reply("220 localhost SMTP sink ready")
+            while True:
+                line = self.readline()
+                verb = line.split(" ", 1)[0].upper()
+                if verb in ("EHLO", "HELO"):
+                    features = ["AUTH PLAIN LOGIN", "8BITMIME", "SIZE 52428800"]
+                    if self.server.tls_context and not tls:
+                        features.insert(0, "STARTTLS")
+                    self.reply("250-localhost")
+                    for feature in features[:-1]:
+                        self.reply(f"250-{feature}")
+                    self.reply(f"250 {features[-1]}")
+                elif verb == "STARTTLS" and self.server.tls_context and not tls:
+                    self.reply("220 Ready to start TLS")
+                    self.request = self.server.tls_context.wrap_socket(self.request, server_side=True)
+                    self.rfile = self.request.makefile("rb")
+                    self.wfile = self.request.makefile("wb")
+                    tls = True
+                elif verb == "AUTH":
+                    if line.upper().startswith("AUTH LOGIN"):
+                        if len(line.split()) < 3:
+                            self.reply("334 VXNlcm5hbWU6")
+                            self.readline()
+                        self.reply("334 UGFzc3dvcmQ6")
+                        self.readline()
+                    elif len(line.split()) < 3:
+                        self.reply("334 ")
+                        self.readline()
+                    self.server.count("logins")
+                    self.reply("235 Authentication successful")
+                elif verb in ("MAIL", "RCPT", "RSET", "NOOP"):
+                    self.reply("250 OK")
+                elif verb == "DATA":
+                    self.reply("354 End data with <CR><LF>.<CR><LF>")
+                    while self.readline() != ".":
+                        pass
+                    sent += 1
+                    self.server.count("messages")
+                    self.reply("250 OK queued")
+                    if self.server.drop_after and sent >= self.server.drop_after:
+                        return # Drop the connection without a QUIT, like a server enforcing a session limit
+                elif verb == "QUIT":
+                    self.reply("221 Bye")
+                    return
+                else:
+                    self.reply("502 Command not implemented")
+        except (ConnectionError, ssl.SSLError, OSError):
+            return
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Run a local SMTP server that discards every message.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=2525)
+    p.add_argument("--tls", action="store_true", help="Offer STARTTLS with a generated self-signed certificate.")
+    p.add_argument("--latency-ms", type=float, default=0, help="Delay before the greeting and every reply.")
+    p.add_argument("--drop-after", type=int, default=0, help="Close each connection after N messages.")
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    context = None
+    if args.tls:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(*make_self_signed_cert(tempfile.mkdtemp(prefix="smtp-sink-")))
+    sink = SMTPSink((args.host, args.port), tls_context=context, latency_ms=args.latency_ms, drop_after=args.drop_after)
+    print(f"SMTP sink listening on {args.host}:{args.port}{' (STARTTLS)' if context else ''}", file=sys.stderr)
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        print(sink.stats(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
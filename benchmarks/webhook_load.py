@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# benchmarks/webhook_load.py
+# Load generator for /webhook/: synthetic OpenPhone payloads, a local fake media server and a JSON latency report.
+#
+#   python benchmarks/webhook_load.py --rate 200 --duration 20 --media-mix 0.3
+#   python benchmarks/webhook_load.py --database-url postgresql://localhost/bench --mode spool --output pg.json
+#   python benchmarks/webhook_load.py --target http://127.0.0.1:8000/webhook/   # against a running gunicorn
+#
+# In-process runs import main with the given DATABASE_URL and count DB commits and statements per event
+# by hooking the SQLAlchemy engine; --target runs only measure HTTP latency and throughput.
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import platform
+import threading
+import subprocess
+import http.server
+import socketserver
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Drive /webhook/ with synthetic OpenPhone events and report latency.")
+    p.add_argument("--rate", type=float, default=100, help="Target events/sec (0 = as fast as the workers allow).")
+    p.add_argument("--duration", type=float, default=10, help="Seconds to generate load for.")
+    p.add_argument("--requests", type=int, default=0, help="Stop after N events instead of --duration.")
+    p.add_argument("--concurrency", type=int, default=8, help="Concurrent senders.")
+    p.add_argument("--media-mix", type=float, default=0.2, help="Fraction of incoming events carrying media.")
+    p.add_argument("--media-per-message", type=int, default=1)
+    p.add_argument("--media-bytes", type=int, default=200_000, help="Size of each fake media file.")
+    p.add_argument("--media-latency-ms", type=float, default=50, help="Artificial delay of the fake media server.")
+    p.add_argument("--duplicate-rate", type=float, default=0.05, help="Fraction of events replaying an earlier SID.")
+    p.add_argument("--outgoing-rate", type=float, default=0.2, help="Fraction of message.delivered events.")
+    p.add_argument("--contacts", type=int, default=500, help="Distinct phone numbers to draw from.")
+    p.add_argument("--mode", choices=["direct", "spool"], default="direct", help="WEBHOOK_INGEST_MODE for in-process runs.")
+    p.add_argument("--database-url", help="Database for in-process runs (default: a fresh SQLite file).")
+    p.add_argument("--target", help="POST to this URL instead of an in-process test client.")
+    p.add_argument("--drain-timeout", type=float, default=60, help="Seconds to wait for media jobs / spool after the run.")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--output", help="Write the JSON report here (default: stdout).")
+    return p.parse_args(argv)
+
+
+# --- Fake media server ---
+
+def start_media_server(media_bytes, latency_ms):
+    """Serve deterministic bytes for any path (one distinct file per path) after an artificial delay."""
+
+    class MediaHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(latency_ms / 1000.0)
+            seed = self.path.encode()
+            body = (seed * (media_bytes // max(len(seed), 1) + 1))[:media_bytes]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), MediaHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-media", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# --- Synthetic payloads ---
+
+class PayloadGenerator:
+    """OpenPhone-shaped message.received / message.delivered payloads with a configurable mix."""
+
+    def __init__(self, args, media_base):
+        self.args = args
+        self.media_base = media_base
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.issued = 0
+        self.phones = [f"+1702{n:07d}" for n in self.rng.sample(range(10**7), args.contacts)]
+
+    def next(self):
+        with self.lock:
+            rng = self.rng
+            if self.issued and rng.random() < self.args.duplicate_rate:
+                sid = f"BENCH{self.args.seed}-{rng.randrange(self.issued)}"
+            else:
+                sid = f"BENCH{self.args.seed}-{self.issued}"
+                self.issued += 1
+            incoming = rng.random() >= self.args.outgoing_rate
+            phone = rng.choice(self.phones)
+            media = []
+            if incoming and rng.random() < self.args.media_mix:
+                media = [{"url": f"{self.media_base}/{sid}/{i}.jpg", "type": "image/jpeg"} for i in range(self.args.media_per_message)]
+        return {
+            "type": "message.received" if incoming else "message.delivered",
+            "createdAt": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            "data": {"object": {
+                "id": sid,
+                "from": phone if incoming else "+17025550000",
+                "to": "+17025550000" if incoming else phone,
+                "body": f"Synthetic message {sid}",
+                "media": media,
+                "createdAt": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+            }},
+        }
+
+
+# --- DB instrumentation (in-process only) ---
+
+class CommitCounter:
+    """Counts commits and statements per thread group via SQLAlchemy engine events."""
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.lock = threading.Lock()
+        self.commits = {}
+        self.statements = {}
+        event.listen(engine, "commit", self._on_commit)
+        event.listen(engine, "after_cursor_execute", self._on_statement)
+
+    @staticmethod
+    def _group():
+        name = threading.current_thread().name
+        if name.startswith("bench-sender"):
+            return "request"
+        if name.startswith("media-job"):
+            return "media_jobs"
+        if name.startswith("webhook-spool"):
+            return "spool_consumer"
+        return "other"
+
+    def _bump(self, counter):
+        group = self._group()
+        with self.lock:
+            counter[group] = counter.get(group, 0) + 1
+
+    def _on_commit(self, conn):
+        self._bump(self.commits)
+
+    def _on_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self._bump(self.statements)
+
+    def reset(self):
+        with self.lock:
+            self.commits.clear()
+            self.statements.clear()
+
+
+def setup_in_process(args, workdir):
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    # Every file the app writes goes under workdir, whatever the shell or .env points them at
+    os.environ["UPLOAD_FOLDER"] = os.path.join(workdir, "uploads")
+    os.environ["WEBHOOK_SPOOL_PATH"] = os.path.join(workdir, "webhook_spool.db")
+    os.environ["SEMANTIC_INDEX_FOLDER"] = os.path.join(workdir, "semantic_index")
+    os.environ["LLM_CACHE_PATH"] = os.path.join(workdir, "llm_cache.sqlite3")
+    os.environ["THUMBNAIL_FOLDER"] = os.path.join(workdir, "derivatives")
+    os.environ["WEBHOOK_INGEST_MODE"] = args.mode
+    os.environ.pop("SENDGRID_TO_EMAIL", None) # Never email from a benchmark
+    sys.path.insert(0, REPO_ROOT)
+
+    import logging
+    logging.disable(logging.WARNING) # Route logging would dominate the measurement
+    import main
+    from extensions import db
+
+    app = main.app
+    main.start_background_workers() # As gunicorn's post_worker_init does; the spool needs its consumer
+    with app.app_context():
+        counter = CommitCounter(db.engine)
+        dialect = db.engine.dialect.name
+    local = threading.local()
+
+    def send(payload):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app.test_client()
+        return client.post("/webhook/", json=payload).status_code
+
+    return app, send, counter, dialect
+
+
+def setup_remote(args):
+    import requests
+    session_local = threading.local()
+
+    def send(payload):
+        session = getattr(session_local, "session", None)
+        if session is None:
+            session = session_local.session = requests.Session()
+        try:
+            return session.post(args.target, json=payload, timeout=30).status_code
+        except requests.RequestException:
+            return 0
+
+    return send
+
+
+# --- Load loop ---
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1)) # Nearest-rank
+    return sorted_values[rank]
+
+
+def run_load(args, send, generator):
+    """Open-loop load: events are scheduled at the target rate regardless of how fast earlier ones return."""
+    latencies, statuses, lags = [], {}, []
+    lock = threading.Lock()
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    limit = args.requests or None
+    started = time.perf_counter()
+    deadline = started + args.duration
+
+    def one(scheduled_at):
+        payload = generator.next()
+        t0 = time.perf_counter()
+        status = send(payload)
+        elapsed = time.perf_counter() - t0
+        with lock:
+            latencies.append(elapsed)
+            lags.append(max(0.0, t0 - scheduled_at))
+            statuses[status] = statuses.get(status, 0) + 1
+
+    sent = 0
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bench-sender") as pool:
+        in_flight = threading.Semaphore(args.concurrency * 4)
+        while True:
+            scheduled_at = started + sent * interval
+            if (limit and sent >= limit) or (not limit and scheduled_at >= deadline):
+                break
+            delay = scheduled_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            in_flight.acquire()
+            future = pool.submit(one, scheduled_at)
+            future.add_done_callback(lambda _: in_flight.release())
+            sent += 1
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    lags.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    ok = sum(n for status, n in statuses.items() if 200 <= status < 300)
+    return {
+        "events_sent": sent,
+        "wall_seconds": round(wall, 3),
+        "throughput_events_per_sec": round(sent / wall, 1) if wall else None,
+        "ok_events_per_sec": round(ok / wall, 1) if wall else None,
+        "status_counts": {str(k): v for k, v in sorted(statuses.items())},
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1] if latencies else None),
+            "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+        },
+        "schedule_lag_ms_p99": ms(percentile(lags, 99)), # >0 means the senders couldn't keep up with --rate
+    }
+
+
+def drain_background(app, timeout):
+    """Wait for the spool and media jobs to empty; returns their final stats."""
+    from media_jobs import media_job_runner
+    from webhook_spool import webhook_spool
+
+    deadline = time.time() + timeout
+    with app.app_context():
+        while time.time() < deadline:
+            spool_depth = webhook_spool.depth()[0] if webhook_spool.enabled else 0
+            jobs = media_job_runner.stats()
+            if not spool_depth and not jobs["pending"] and not jobs["running"]:
+                break
+            time.sleep(0.2)
+        return {
+            "drained": time.time() < deadline,
+            "media_jobs": media_job_runner.stats(),
+            "webhook_ingest": webhook_spool.stats() if webhook_spool.enabled else None,
+        }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="webhook-bench-")
+    media_server, media_base = start_media_server(args.media_bytes, args.media_latency_ms)
+    generator = PayloadGenerator(args, media_base)
+
+    app = counter = None
+    if args.target:
+        send, dialect = setup_remote(args), None
+    else:
+        app, send, counter, dialect = setup_in_process(args, workdir)
+        counter.reset() # Ignore startup DDL
+
+    load = run_load(args, send, generator)
+    request_commits = dict(counter.commits) if counter else None
+    request_statements = dict(counter.statements) if counter else None
+    background = drain_background(app, args.drain_timeout) if app else None
+    media_server.shutdown()
+
+    events = max(load["events_sent"], 1)
+    report = {
+        "benchmark": "webhook_load",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "database": dialect,
+        "results": load,
+    }
+    if counter:
+        report["db"] = {
+            "request_commits_per_event": round(request_commits.get("request", 0) / events, 3),
+            "request_statements_per_event": round(request_statements.get("request", 0) / events, 3),
+            "commits_during_load": request_commits,
+            "commits_total": dict(counter.commits),
+            "commits_per_event_total": round(sum(counter.commits.values()) / events, 3),
+            "statements_total": dict(counter.statements),
+        }
+        report["background"] = background
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        print(f"Report written to {args.output}: {load['throughput_events_per_sec']} events/sec, "
+              f"p50 {load['latency_ms']['p50']} ms, p99 {load['latency_ms']['p99']} ms", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
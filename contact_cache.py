@@ -0,0 +1,54 @@
+# contact_cache.py
+# Phone key -> (contact_name, exists) cache used by the webhook ingest paths and /contact/update.
+
+import os
+
+from extensions import db
+from models import Contact
+from cache_utils import LRUCache
+
+# The TTL bounds how long a rename made in another gunicorn worker can go unnoticed here
+contact_cache = LRUCache(
+    maxsize=int(os.getenv("CONTACT_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("CONTACT_CACHE_TTL", "300")),
+)
+
+
+def lookup_contact(key):
+    """Return (contact_name, exists) for a normalized phone key, querying only on a cache miss."""
+    entry = contact_cache.get(key)
+    if entry is None:
+        contact = db.session.get(Contact, key)
+        entry = (contact.contact_name, True) if contact else (None, False)
+        contact_cache.set(key, entry)
+    return entry
+
+
+def lookup_contacts(keys):
+    """Bulk lookup_contact: returns {key: (contact_name, exists)} with one query for all misses."""
+    found = {}
+    missing = []
+    for key in keys:
+        entry = contact_cache.get(key)
+        if entry is None:
+            missing.append(key)
+        else:
+            found[key] = entry
+    if missing:
+        names = dict(
+            db.session.query(Contact.phone_number, Contact.contact_name).filter(Contact.phone_number.in_(missing)).all()
+        )
+        for key in missing:
+            entry = (names[key], True) if key in names else (None, False)
+            contact_cache.set(key, entry)
+            found[key] = entry
+    return found
+
+
+def remember_contact(key, contact_name):
+    """Record a contact that was just created or renamed (call after the commit)."""
+    contact_cache.set(key, (contact_name, True))
+
+
+def invalidate_contact(key):
+    contact_cache.invalidate(key)
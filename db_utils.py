@@ -0,0 +1,22 @@
+# db_utils.py
+# Small dialect helpers shared by the bulk ingestion paths (Postgres in production, SQLite locally).
+
+from extensions import db
+
+
+def dialect_insert(table):
+    """Return an INSERT for table that supports on_conflict_do_nothing() on the bound database."""
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upserts are not supported on '{dialect}'")
+    return insert(table)
+
+
+def chunked(items, size):
+    """Yield successive lists of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
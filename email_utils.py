@@ -1,10 +1,11 @@
 import os
-import smtplib
-import ssl
 import base64
 from email.message import EmailMessage
 from email.utils import make_msgid
 import mimetypes
+import threading
+
+from smtp_pool import SMTPConnectionPool
 
 # SendGrid imports
 from sendgrid import SendGridAPIClient
@@ -19,9 +20,25 @@ from sendgrid.helpers.mail import (
     From,             # Add this
     To,               # Add this
     Subject,          # Add this
-    HtmlContent       # Add this
+    HtmlContent,      # Add this
+    Personalization,
+    Substitution,
 )
 
+SENDGRID_MAX_PERSONALIZATIONS = 1000 # SendGrid's per-request limit
+
+_sendgrid_client = None
+_sendgrid_client_lock = threading.Lock()
+
+
+def get_sendgrid_client():
+    """One SendGridAPIClient per process, shared by every send instead of built per call."""
+    global _sendgrid_client
+    with _sendgrid_client_lock:
+        if _sendgrid_client is None:
+            _sendgrid_client = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
+        return _sendgrid_client
+
 def wrap_email_html(content: str) -> str:
     """Enhanced HTML wrapper with conversation-style design."""
     html_template = """
@@ -137,13 +154,51 @@ def wrap_email_html(content: str) -> str:
     """
     return html_template.replace("{content}", content) if content.strip() else html_template.replace("{content}", "<p>(No text content)</p>")
 
-def _send_via_smtp(
-    to_address: str,
-    subject: str,
-    html_content: str,
-    plain_content: str = None,
-    attachments: list = None,
-):
+_smtp_pool = None
+_smtp_pool_settings = None
+_smtp_pool_lock = threading.Lock()
+
+
+def get_smtp_pool():
+    """The process-wide SMTPConnectionPool for the SMTP_* settings (rebuilt if they change).
+
+    SMTP_POOL_SIZE (default 4, 0 = a new connection per message), SMTP_POOL_MAX_IDLE seconds,
+    SMTP_POOL_MAX_MESSAGES per connection and SMTP_SECURITY (ssl / starttls / none, default by port).
+    """
+    global _smtp_pool, _smtp_pool_settings
+    smtp_server = os.getenv("SMTP_SERVER") or os.getenv("SMTP_HOST")
+    smtp_port_str = os.getenv("SMTP_PORT", "587")
+    smtp_username = os.getenv("SMTP_USERNAME")
+    smtp_password = os.getenv("SMTP_PASSWORD")
+
+    if not all([smtp_server, smtp_port_str, smtp_username, smtp_password]):
+        raise RuntimeError("SMTP configuration is incomplete.")
+
+    settings = dict(
+        host=smtp_server,
+        port=int(smtp_port_str),
+        username=smtp_username,
+        password=smtp_password,
+        security=os.getenv("SMTP_SECURITY") or None,
+        size=int(os.getenv("SMTP_POOL_SIZE", "4")),
+        max_idle=float(os.getenv("SMTP_POOL_MAX_IDLE", "60")),
+        max_messages=int(os.getenv("SMTP_POOL_MAX_MESSAGES", "100")),
+    )
+    with _smtp_pool_lock:
+        if _smtp_pool is None or _smtp_pool_settings != settings:
+            if _smtp_pool is not None:
+                _smtp_pool.close()
+            _smtp_pool = SMTPConnectionPool(**settings)
+            _smtp_pool_settings = settings
+        return _smtp_pool
+
+
+def smtp_pool_stats():
+    """Counters of the SMTP pool, or None before the first SMTP send."""
+    return _smtp_pool.stats() if _smtp_pool is not None else None
+
+
+def _smtp_settings():
     smtp_server = os.getenv("SMTP_SERVER") or os.getenv("SMTP_HOST")
     smtp_port_str = os.getenv("SMTP_PORT", "587")
     smtp_username = os.getenv("SMTP_USERNAME")
@@ -152,17 +207,17 @@ def _send_via_smtp(
 
     if not all([smtp_server, smtp_port_str, smtp_username, smtp_password, from_address]):
         raise RuntimeError("SMTP configuration is incomplete.")
+    return from_address
 
-    html_content = wrap_email_html(html_content)
-    plain_content = plain_content or "(No text content)"
 
+def _build_smtp_message(from_address, to_address, subject, html_content, plain_content=None, attachments=None):
     msg = EmailMessage()
     msg["Subject"] = subject
     msg["From"] = from_address
     msg["To"] = to_address
     msg["Message-ID"] = make_msgid()
 
-    msg.set_content(plain_content, subtype="plain")
+    msg.set_content(plain_content or "(No text content)", subtype="plain")
     msg.add_alternative(html_content, subtype="html")
 
     if attachments:
@@ -190,26 +245,51 @@ def _send_via_smtp(
                 print(f"📎 Added attachment '{filename}' for SMTP.")
             except Exception as e:
                 print(f"⚠️ Error adding attachment '{filename}' for SMTP: {e}")
+    return msg
+
+
+def _send_via_smtp(
+    to_address: str,
+    subject: str,
+    html_content: str,
+    plain_content: str = None,
+    attachments: list = None,
+):
+    from_address = _smtp_settings()
+    msg = _build_smtp_message(from_address, to_address, subject, wrap_email_html(html_content),
+                              plain_content, attachments)
 
-    port = int(smtp_port_str)
-    context = ssl.create_default_context()
     try:
-        if port == 465:
-            print(f"📧 Connecting to SMTP server {smtp_server}:{port} using SSL...")
-            with smtplib.SMTP_SSL(smtp_server, port, context=context) as server:
-                server.login(smtp_username, smtp_password)
-                server.send_message(msg)
-        else:
-            print(f"📧 Connecting to SMTP server {smtp_server}:{port} using STARTTLS...")
-            with smtplib.SMTP(smtp_server, port) as server:
-                server.starttls(context=context)
-                server.login(smtp_username, smtp_password)
-                server.send_message(msg)
+        get_smtp_pool().send_message(msg)
         print(f"✅ Email sent successfully via SMTP to {to_address}")
     except Exception as e:
         print(f"❌ SMTP Error: {e}")
         raise
 
+
+def _send_batch_via_smtp(messages, html_content, attachments=None):
+    """send_email_batch over the SMTP pool: one message per recipient, substitutions applied here."""
+    from_address = _smtp_settings()
+    encoded = [
+        {"filename": a["filename"], "type": a["type"], "content": base64.b64encode(a["content_bytes"]).decode()}
+        for a in attachments or []
+    ]
+    pool = get_smtp_pool()
+    results = {}
+    for item in messages:
+        html, subject = html_content, item["subject"]
+        for tag, value in (item.get("substitutions") or {}).items():
+            html, subject = html.replace(tag, value), subject.replace(tag, value)
+        try:
+            pool.send_message(_build_smtp_message(from_address, item["to"], subject, html, attachments=encoded))
+            results[item["to"]] = None
+        except Exception as e:
+            results[item["to"]] = str(e)[:500]
+            print(f"❌ SMTP Error sending to {item['to']}: {e}")
+    print(f"Batch email sent via SMTP to {len(messages)} recipient(s), "
+          f"{sum(1 for error in results.values() if error is None)} accepted")
+    return results
+
 def _send_via_sendgrid(
     to_address: str,
     subject: str,
@@ -277,25 +357,10 @@ def send_email(to_emails, subject, html_content, attachments=None):
     )
 
     if attachments:
-        processed_attachments = []
-        for attachment_data in attachments:
-            # Ensure content is Base64 encoded string
-            encoded_content = base64.b64encode(attachment_data['content_bytes']).decode()
-
-            attachment = Attachment(
-                FileContent(encoded_content),
-                FileName(attachment_data['filename']),
-                FileType(attachment_data['type']), # Use the content type from Flask
-                Disposition('attachment') # 'inline' is also an option for images
-                # ContentId('...') # Optional: Used for inline images
-            )
-            processed_attachments.append(attachment)
-
-        message.attachment = processed_attachments # Assign the list of attachments
+        message.attachment = _build_attachments(attachments)
 
     try:
-        sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
-        response = sg.send(message)
+        response = get_sendgrid_client().send(message)
         print(f"Email sent to {to_emails}, Status Code: {response.status_code}")
         # Handle response status, body, headers as needed
         return True
@@ -303,3 +368,58 @@ def send_email(to_emails, subject, html_content, attachments=None):
         print(f"Error sending email to {to_emails}: {e}")
         # Log the error details (e.g., e.body if available)
         return False
+
+
+def _build_attachments(attachments):
+    return [
+        Attachment(
+            FileContent(base64.b64encode(attachment_data['content_bytes']).decode()),
+            FileName(attachment_data['filename']),
+            FileType(attachment_data['type']),
+            Disposition('attachment')
+        )
+        for attachment_data in attachments or []
+    ]
+
+
+def send_email_batch(messages, html_content, attachments=None, batch_size=SENDGRID_MAX_PERSONALIZATIONS):
+    """Send one HTML body to many recipients, up to batch_size personalizations per SendGrid request.
+
+    messages: [{"to": email, "subject": str, "substitutions": {tag: value}}] - each tag found in
+    html_content is replaced by SendGrid for that recipient only. Returns {email: None on success,
+    or an error string}; a rejected request marks every recipient in it as failed.
+
+    EMAIL_BACKEND=smtp sends through the SMTP connection pool (SMTP_* settings) instead, one message
+    per recipient.
+    """
+    if os.getenv("EMAIL_BACKEND", "sendgrid").lower() == "smtp":
+        return _send_batch_via_smtp(messages, html_content, attachments)
+    results = {}
+    batch_size = max(1, min(batch_size, SENDGRID_MAX_PERSONALIZATIONS))
+    for start in range(0, len(messages), batch_size):
+        chunk = messages[start:start + batch_size]
+        message = Mail(
+            from_email=From('phil@sincityrentals.com', 'Sin City Rentals'),
+            html_content=HtmlContent(html_content)
+        )
+        for item in chunk:
+            personalization = Personalization()
+            personalization.add_to(To(item["to"]))
+            personalization.subject = Subject(item["subject"])
+            for tag, value in (item.get("substitutions") or {}).items():
+                personalization.add_substitution(Substitution(tag, value))
+            message.add_personalization(personalization)
+        if attachments:
+            message.attachment = _build_attachments(attachments)
+
+        try:
+            response = get_sendgrid_client().send(message)
+            ok = 200 <= response.status_code < 300
+            error = None if ok else f"SendGrid status {response.status_code}"
+            print(f"Batch email sent to {len(chunk)} recipient(s), Status Code: {response.status_code}")
+        except Exception as e:
+            error = str(getattr(e, "body", None) or e)[:500]
+            print(f"Error sending batch email to {len(chunk)} recipient(s): {error}")
+        for item in chunk:
+            results[item["to"]] = error
+    return results
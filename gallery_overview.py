@@ -0,0 +1,82 @@
+# gallery_overview.py
+# Data for the /galleries overview: per-property image counts and cover image from one windowed query,
+# kept as a cached snapshot that the writers drop when media, assignments or thumbnails change.
+#
+# Like message_stats, the snapshot is per gunicorn worker: invalidate() clears this worker's copy and
+# other workers pick up the change when GALLERY_OVERVIEW_TTL expires (0 disables caching).
+
+import os
+
+from sqlalchemy import func
+
+from extensions import db
+from models import Message, MessageMedia, Property
+from cache_utils import LRUCache
+
+SNAPSHOT_KEY = "overview"
+
+
+class GalleryOverview:
+    """Cached {'properties': [...], 'unsorted_count': n} for the galleries overview page."""
+
+    def __init__(self, ttl=300):
+        self._cache = LRUCache(maxsize=1, ttl=ttl)
+        self.recomputes = 0
+
+    def _compute(self):
+        # One pass over message_media: image count per property plus its newest image (rn = 1).
+        # The NULL-property partition is the unsorted media.
+        ranked = (
+            db.session.query(
+                MessageMedia.property_id.label("property_id"),
+                MessageMedia.path.label("path"),
+                func.count().over(partition_by=MessageMedia.property_id).label("image_count"),
+                func.row_number().over(
+                    partition_by=MessageMedia.property_id,
+                    order_by=(Message.timestamp.desc(), MessageMedia.message_id.desc(), MessageMedia.position),
+                ).label("rn"),
+            )
+            .join(Message, Message.id == MessageMedia.message_id)
+            .subquery()
+        )
+        rows = (
+            db.session.query(ranked.c.property_id, Property.name, Property.thumbnail_path,
+                             ranked.c.image_count, ranked.c.path)
+            .outerjoin(Property, Property.id == ranked.c.property_id)
+            .filter(ranked.c.rn == 1)
+            .all()
+        )
+
+        properties, unsorted_count = [], 0
+        for property_id, name, thumbnail_path, image_count, latest_path in rows:
+            if property_id is None:
+                unsorted_count = image_count
+            elif name is not None:
+                properties.append({
+                    "id": property_id,
+                    "name": name,
+                    "image_count": image_count,
+                    "thumbnail_path": thumbnail_path,
+                    "has_thumbnail": bool(thumbnail_path),
+                    "sample_image": thumbnail_path or latest_path,
+                })
+        properties.sort(key=lambda p: p["name"])
+        return {"properties": properties, "unsorted_count": unsorted_count}
+
+    def snapshot(self):
+        cached = self._cache.get(SNAPSHOT_KEY)
+        if cached is None:
+            cached = self._compute()
+            self.recomputes += 1
+            self._cache.set(SNAPSHOT_KEY, cached)
+        return cached
+
+    def invalidate(self):
+        """Call after committing a change to media rows, property assignments or thumbnails."""
+        self._cache.clear()
+
+    def stats(self):
+        return dict(self._cache.stats(), recomputes=self.recomputes)
+
+
+gallery_overview = GalleryOverview(ttl=float(os.getenv("GALLERY_OVERVIEW_TTL", "300")))
@@ -0,0 +1,11 @@
+# gunicorn.conf.py
+# Loaded automatically by `gunicorn main:app` (see Procfile).
+#
+# Background workers run only in serving workers: importing main (flask db upgrade, flask CLI commands,
+# benchmarks) must not start draining the outbox or the webhook spool, or resuming media jobs.
+
+
+def post_worker_init(worker):
+    from main import start_background_workers
+    start_background_workers()
+    worker.log.info(f"✅ Background workers started in worker {worker.pid}.")
@@ -0,0 +1,183 @@
+# ingest.py
+# OpenPhone webhook payload parsing plus batched ingestion of many events in one transaction.
+
+from datetime import datetime, timezone
+from flask import current_app
+from extensions import db
+from models import Contact, Message, MediaJob
+from db_utils import dialect_insert, chunked
+from media_jobs import media_job_runner
+from contact_cache import lookup_contacts, remember_contact
+from sid_filter import recent_sids
+from message_stats import message_stats
+from search_index import search_index
+from semantic_index import semantic_index
+
+INSERT_CHUNK_SIZE = 500 # Rows per multi-VALUES statement, well under Postgres/SQLite bind limits
+
+
+class InvalidWebhookEvent(ValueError):
+    """Raised when a webhook payload can't be turned into a message event."""
+
+
+def normalize_phone_key(phone):
+    """Normalize a phone number to the contact key (last 10 digits)."""
+    return "".join(filter(str.isdigit, phone))[-10:]
+
+
+def parse_webhook_event(data):
+    """Extract the message fields from an OpenPhone webhook payload.
+
+    Raises InvalidWebhookEvent with the HTTP error text when the payload is unusable.
+    """
+    event_type = data.get("type", "")
+    # Assuming the relevant object is nested under 'data' -> 'object'
+    payload_data = data.get("data", {})
+    obj = payload_data.get("object", {}) if isinstance(payload_data, dict) else {}
+
+    sid = obj.get("sid") or obj.get("id") # Unique ID for the message event
+    if not sid:
+        raise InvalidWebhookEvent("Bad Request: Missing unique message ID.")
+
+    direction = "incoming" if "received" in event_type.lower() else "outgoing"
+    phone = obj.get("from") if direction == "incoming" else obj.get("to")
+    if not phone:
+        raise InvalidWebhookEvent("Bad Request: Missing phone number.")
+
+    media = obj.get("media") or [] # Ensure media is a list
+    urls = [m.get("url") for m in media if isinstance(m, dict) and isinstance(m.get("url"), str)]
+
+    return {
+        "sid": sid,
+        "direction": direction,
+        "phone": phone,
+        "key": normalize_phone_key(phone),
+        "text": obj.get("body", ""),
+        "urls": urls,
+        "created_at": _parse_event_time(obj.get("createdAt") or data.get("createdAt")),
+    }
+
+
+def _parse_event_time(value):
+    """OpenPhone ISO-8601 timestamp -> naive UTC datetime (None if missing or unparseable)."""
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def ingest_events(events, received_at=None, submit_jobs=True, create_jobs=True, use_event_time=False):
+    """Insert a batch of parsed webhook events with one commit.
+
+    Contacts are upserted and messages inserted with ON CONFLICT DO NOTHING, so replayed
+    SIDs are skipped without a per-event lookup (recently seen ones before any query at all).
+    Media jobs are created for new incoming messages in the same transaction and scheduled
+    once it commits; create_jobs=False skips them (no download or email), for callers such
+    as the archive backfill that handle media themselves. use_event_time stamps messages
+    with the payload's createdAt instead of received_at. Returns counts for the batch (rows
+    actually inserted) plus {sid: message_id} for the new messages.
+    """
+    received_at = received_at or datetime.utcnow()
+
+    if not events:
+        return {"received": 0, "inserted": 0, "duplicates": 0, "contacts_created": 0, "job_ids": [], "inserted_ids": {}}
+
+    # Keep the first occurrence of each SID within the batch, skipping SIDs ingested recently
+    seen_sids = set()
+    unique_events = []
+    for e in events:
+        if e["sid"] not in seen_sids and not recent_sids.seen(e["sid"]):
+            seen_sids.add(e["sid"])
+            unique_events.append(e)
+    if not unique_events:
+        return {"received": len(events), "inserted": 0, "duplicates": len(events), "contacts_created": 0, "job_ids": [], "inserted_ids": {}}
+
+    # --- Contacts: cached lookup for the whole batch, bulk insert for unknown keys ---
+    known = lookup_contacts({e["key"] for e in unique_events})
+    contact_names = {key: name for key, (name, exists) in known.items() if exists}
+    new_contacts = {}
+    for e in unique_events:
+        if e["key"] not in contact_names and e["key"] not in new_contacts:
+            # Raw phone is the default name, same as the direct webhook path
+            new_contacts[e["key"]] = {"phone_number": e["key"], "contact_name": e["phone"], "created_at": received_at}
+    created_contacts = set() # Keys this batch inserted; a concurrent ingest may have won the rest
+    for chunk in chunked(list(new_contacts.values()), INSERT_CHUNK_SIZE):
+        stmt = (
+            dialect_insert(Contact.__table__)
+            .values(chunk)
+            .on_conflict_do_nothing(index_elements=["phone_number"])
+            .returning(Contact.__table__.c.phone_number)
+        )
+        created_contacts.update(db.session.execute(stmt).scalars().all())
+    contact_names.update({k: c["contact_name"] for k, c in new_contacts.items()})
+
+    # --- Messages: multi-row insert, duplicates by SID silently skipped ---
+    rows = [{
+        "sid": e["sid"],
+        "phone_number": e["key"],
+        "contact_name": contact_names.get(e["key"]),
+        "direction": e["direction"],
+        "message": e["text"],
+        "media_urls": ",".join(e["urls"]) if e["urls"] else None,
+        "timestamp": (e.get("created_at") if use_event_time else None) or received_at,
+        "local_media_paths": None,
+    } for e in unique_events]
+
+    inserted = {}
+    for chunk in chunked(rows, INSERT_CHUNK_SIZE):
+        stmt = (
+            dialect_insert(Message.__table__)
+            .values(chunk)
+            .on_conflict_do_nothing(index_elements=["sid"])
+            .returning(Message.__table__.c.id, Message.__table__.c.sid)
+        )
+        inserted.update({sid: msg_id for msg_id, sid in db.session.execute(stmt).all()})
+
+    # --- Media jobs for new incoming messages ---
+    job_rows = [{
+        "message_id": inserted[e["sid"]],
+        "phone": e["phone"],
+        "status": "pending",
+        "stage": "download",
+        "attempts": 0,
+        "next_attempt_at": received_at,
+        "created_at": received_at,
+        "updated_at": received_at,
+    } for e in unique_events if create_jobs and e["sid"] in inserted and e["direction"] == "incoming"]
+
+    job_ids = []
+    for chunk in chunked(job_rows, INSERT_CHUNK_SIZE):
+        stmt = db.insert(MediaJob.__table__).values(chunk).returning(MediaJob.__table__.c.id)
+        job_ids.extend(db.session.execute(stmt).scalars().all())
+
+    search_index.index_messages(inserted.values())
+    db.session.commit()
+    for sid in seen_sids:
+        recent_sids.add(sid) # Inserted now or already in the table - either way a replay
+    for key in created_contacts:
+        remember_contact(key, new_contacts[key]["contact_name"])
+    message_stats.record_new_messages([r["timestamp"] for r in rows if r["sid"] in inserted])
+    if inserted:
+        semantic_index.schedule_sync()
+
+    if submit_jobs:
+        for job_id in job_ids:
+            media_job_runner.submit(job_id)
+
+    current_app.logger.info(
+        f"✅ Ingested batch: {len(events)} event(s), {len(inserted)} new message(s), "
+        f"{len(created_contacts)} new contact(s), {len(job_ids)} media job(s)."
+    )
+    return {
+        "received": len(events),
+        "inserted": len(inserted),
+        "duplicates": len(events) - len(inserted),
+        "contacts_created": len(created_contacts),
+        "job_ids": job_ids,
+        "inserted_ids": inserted,
+    }
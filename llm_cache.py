@@ -0,0 +1,186 @@
+# llm_cache.py
+# Response cache for OpenAI chat completions (AI search, /ask, invoice extraction).
+#
+# Entries are keyed by a SHA-256 of the request (model, messages, temperature and the other arguments),
+# so an identical question over an unchanged set of messages is answered from disk without an API call.
+# The store is a SQLite file (LLM_CACHE_PATH, default: "llm_cache.sqlite3" next to UPLOAD_FOLDER) shared
+# by all gunicorn workers. Entries expire after LLM_CACHE_TTL seconds, and the least recently used are
+# evicted beyond LLM_CACHE_MAX_ENTRIES. New messages need no invalidation: they change the prompt's
+# message context and so the key. Answers about messages are also tagged with their property
+# ("property:<id>", or "property:all" when unscoped); reassigning a message to another property drops
+# those tags, since that can change the answer without changing the prompt.
+# Cache errors never fail the request - the call just goes to the API.
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from contextlib import closing
+from flask import current_app
+
+ALL_PROPERTIES_TAG = "property:all"
+
+
+def property_tags(property_id=None):
+    """Tags for an answer built from messages of property_id (or of every property)."""
+    return [f"property:{property_id}"] if property_id else [ALL_PROPERTIES_TAG]
+
+
+def request_key(**kwargs):
+    """Stable hash of a chat completion request."""
+    payload = json.dumps(kwargs, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """SQLite-backed cache of chat completion text with TTL, LRU size limit and tag invalidation."""
+
+    def __init__(self, app=None):
+        self.path = None
+        self.ttl = 6 * 3600
+        self.max_entries = 2000
+        self._schema_ready = False
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self.invalidated = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        upload_dir = app.config.get("UPLOAD_FOLDER")
+        default_path = os.path.join(os.path.dirname(upload_dir.rstrip("/")), "llm_cache.sqlite3") if upload_dir else None
+        self.path = os.getenv("LLM_CACHE_PATH", default_path)
+        self.ttl = float(os.getenv("LLM_CACHE_TTL", str(6 * 3600)))
+        self.max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+        app.extensions["llm_cache"] = self
+
+    @property
+    def enabled(self):
+        return bool(self.path) and self.ttl > 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None) # Autocommit; writes are single statements or explicit
+        if not self._schema_ready:
+            with self._lock:
+                conn.execute("PRAGMA journal_mode=WAL") # Readers in other workers don't block on writes
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS llm_cache (
+                        key TEXT PRIMARY KEY,
+                        model TEXT,
+                        response TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_used_at REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS ix_llm_cache_last_used ON llm_cache (last_used_at);
+                    CREATE TABLE IF NOT EXISTS llm_cache_tags (
+                        tag TEXT NOT NULL,
+                        key TEXT NOT NULL REFERENCES llm_cache(key) ON DELETE CASCADE,
+                        PRIMARY KEY (tag, key)
+                    );
+                    CREATE INDEX IF NOT EXISTS ix_llm_cache_tags_key ON llm_cache_tags (key);
+                """)
+                self._schema_ready = True
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT response FROM llm_cache WHERE key = ? AND created_at > ?", (key, now - self.ttl)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE llm_cache SET last_used_at = ? WHERE key = ?", (now, key))
+        return row[0] if row else None
+
+    def set(self, key, response, model=None, tags=()):
+        now = time.time()
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, model, response, created_at, last_used_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            conn.executemany("INSERT OR IGNORE INTO llm_cache_tags (tag, key) VALUES (?, ?)", [(tag, key) for tag in tags])
+            # Expired entries, then the least recently used beyond max_entries
+            conn.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl,))
+            conn.execute("""
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            conn.execute("COMMIT")
+
+    def invalidate_tags(self, tags):
+        """Drop every entry carrying any of tags (e.g. after new messages for a property)."""
+        tags = list(tags)
+        if not self.enabled or not tags:
+            return 0
+        try:
+            with closing(self._connect()) as conn:
+                placeholders = ",".join("?" * len(tags))
+                deleted = conn.execute(
+                    f"DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache_tags WHERE tag IN ({placeholders}))", tags
+                ).rowcount
+            self.invalidated += deleted
+            return deleted
+        except sqlite3.Error as e:
+            self.errors += 1
+            current_app.logger.warning(f"⚠️ Could not invalidate LLM cache tags {tags}: {e}")
+            return 0
+
+    def invalidate_property(self, property_id=None):
+        """Reassigned messages: drop answers about property_id and about all properties."""
+        tags = [ALL_PROPERTIES_TAG] + ([f"property:{property_id}"] if property_id else [])
+        return self.invalidate_tags(tags)
+
+    def chat_completion(self, client, tags=(), **kwargs):
+        """Text of client.chat.completions.create(**kwargs), served from the cache when possible."""
+        key = request_key(**kwargs) if self.enabled else None
+        if key:
+            try:
+                cached = self.get(key)
+            except sqlite3.Error as e:
+                self.errors += 1
+                current_app.logger.warning(f"⚠️ LLM cache read failed: {e}")
+                cached = None
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        response = client.chat.completions.create(**kwargs)
+        content = response.choices[0].message.content
+
+        if key and content is not None:
+            try:
+                self.set(key, content, model=kwargs.get("model"), tags=tags)
+            except sqlite3.Error as e:
+                self.errors += 1
+                current_app.logger.warning(f"⚠️ LLM cache write failed: {e}")
+        return content
+
+    def stats(self):
+        entries = None
+        if self.enabled and self._schema_ready:
+            try:
+                with closing(self._connect()) as conn:
+                    entries = conn.execute("SELECT count(*) FROM llm_cache").fetchone()[0]
+            except sqlite3.Error:
+                pass
+        return {
+            "enabled": self.enabled,
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidated": self.invalidated,
+            "errors": self.errors,
+        }
+
+
+llm_cache = LLMCache()
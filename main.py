@@ -3,18 +3,39 @@ import logging
 import json
 from flask import Flask, render_template, redirect, url_for, request, flash, jsonify, send_file, session
 from pathlib import Path
+from string import Template
 from datetime import datetime, timezone, timedelta
 from dotenv import load_dotenv
-from sqlalchemy import text, func, select, inspect
-from sqlalchemy.orm import joinedload, aliased
+from sqlalchemy import text, func, select
+from sqlalchemy.orm import joinedload, selectinload, aliased
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 
 load_dotenv()
 
 # Import local modules
 from extensions import db
-from models import Contact, Message, Property, Tenant, NotificationHistory, PropertyCustomField, PropertyAttachment, PropertyContact, Vendor, VendorJob, VendorInvoiceData, VendorComment
+from models import Contact, Message, MessageMedia, Property, Tenant, NotificationHistory, PropertyCustomField, PropertyAttachment, PropertyContact, Vendor, VendorJob, VendorInvoiceData, VendorComment
 from webhook_route import webhook_bp
+from media_jobs import media_job_runner
+from webhook_spool import webhook_spool
+from contact_cache import contact_cache, lookup_contact, remember_contact, invalidate_contact
+from sid_filter import recent_sids
+from backfill import backfill_webhooks
+from media_store import download_to_store, stored_paths_exist, cas_sha256, media_abspath
+from media_http import media_sender
+from pagination import keyset_paginate, InvalidCursor
+from message_stats import message_stats
+from gallery_overview import gallery_overview
+from property_summary import load_property_summaries, load_property_summary
+from search_index import search_index, reindex_search_command
+from semantic_index import semantic_index, rebuild_semantic_index_command
+from llm_cache import llm_cache, property_tags
+from notification_fanout import notification_fanout
+from outbox import outbox
+from email_utils import wrap_email_html, send_email_batch, smtp_pool_stats, SENDGRID_MAX_PERSONALIZATIONS
+from thumbnails import thumbnail_service, SIZES as THUMBNAIL_SIZES
+from media_catalog import parse_media_paths, has_media, replace_message_media, sync_media_property, ensure_converted, migrate_message_media_command
 
 app = Flask(__name__)
 
@@ -42,12 +63,89 @@ app.jinja_env.auto_reload = True
 UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", os.path.join(app.instance_path, "uploads"))
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 
+MAX_PER_PAGE = 200 # Upper bound for per_page on message lists
+CONVERSATION_LIMIT = 100 # Threads shown in the conversation view
+GALLERY_PAGE_SIZE = 48 # Images per gallery page / infinite-scroll fetch
+AI_CONTEXT_MESSAGES = 30 # Messages sent to the LLM by the AI search
+ASK_CONTEXT_MESSAGES = 20 # Messages sent to the LLM by /ask
+
 # Ensure upload directory exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.logger.info(f"✅ Upload folder configured: {UPLOAD_FOLDER}")
 
 # Initialize Extensions
 db.init_app(app)
+media_job_runner.init_app(app)
+webhook_spool.init_app(app)
+search_index.init_app(app)
+semantic_index.init_app(app)
+llm_cache.init_app(app)
+outbox.init_app(app)
+notification_fanout.init_app(app)
+thumbnail_service.init_app(app)
+media_sender.init_app(app)
+media_sender.add_root("uploads", UPLOAD_FOLDER)
+media_sender.add_root("derivatives", thumbnail_service.folder)
+
+# Helper functions for notifications
+def send_openphone_sms(recipient_phone, message_body):
+    """Send SMS using OpenPhone API - not implemented yet.
+
+    Raises instead of pretending to send, so the outbox records SMS notifications as failed (retried with
+    backoff, then 'failed') rather than as sent.
+    """
+    raise NotImplementedError("OpenPhone SMS sending is not implemented")
+
+def load_outbox_attachments(specs):
+    """Attachment dicts for send_email_batch from outbox payload entries ({"path", "type", "filename"})."""
+    upload_dir = app.config.get("UPLOAD_FOLDER") or ""
+    attachments = []
+    for spec in specs or []:
+        full_path = media_abspath(spec["path"], upload_dir)
+        try:
+            with open(full_path, "rb") as f:
+                attachments.append({"content_bytes": f.read(), "type": spec["type"], "filename": spec["filename"]})
+        except OSError as e:
+            app.logger.warning(f"   ⚠️ Skipping email attachment {full_path}: {e}")
+    return attachments
+
+def send_outbox_emails(items):
+    """Outbox email sender: one SendGrid request per batch (or pooled SMTP with EMAIL_BACKEND=smtp), personalized per recipient.
+
+    Items of a batch share their HTML and attachments; each has its own subject and substitutions.
+    """
+    first = items[0][1]
+    messages = [
+        {"to": recipient, "subject": payload["subject"], "substitutions": payload.get("substitutions")}
+        for recipient, payload in items
+    ]
+    results = send_email_batch(messages, first["html"], attachments=load_outbox_attachments(first.get("attachments")))
+    return [results.get(recipient, "No result from provider") for recipient, _ in items]
+
+def send_outbox_sms(items):
+    """Outbox SMS sender: one OpenPhone message per item."""
+    return [None if send_openphone_sms(recipient_phone=recipient, message_body=payload["body"]) else "Failed"
+            for recipient, payload in items]
+
+# Outbox channels, paced to each provider's rate limit. Registered before any dispatcher can run.
+outbox.register_channel(
+    "email",
+    send_outbox_emails,
+    rate=float(os.getenv("SENDGRID_RATE_PER_SECOND", "10")),
+    workers=int(os.getenv("NOTIFY_EMAIL_WORKERS", "4")),
+    batch_size=int(os.getenv("SENDGRID_BATCH_SIZE", str(SENDGRID_MAX_PERSONALIZATIONS))),
+)
+outbox.register_channel(
+    "sms",
+    send_outbox_sms,
+    rate=float(os.getenv("OPENPHONE_RATE_PER_SECOND", "5")),
+    workers=int(os.getenv("NOTIFY_SMS_WORKERS", "4")),
+)
+
+app.cli.add_command(backfill_webhooks)
+app.cli.add_command(reindex_search_command)
+app.cli.add_command(rebuild_semantic_index_command)
+app.cli.add_command(migrate_message_media_command)
 
 # Initialize Database
 with app.app_context():
@@ -211,6 +309,17 @@ with app.app_context():
             else:
                 app.logger.warning(f"⚠️ Could not add 'aka_business_name' column: {e}")
                 
+        # Postgres gets thumbnail_path with the enhanced Property fields above; older SQLite files may lack it
+        if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgresql"):
+            try:
+                db.session.execute(text("ALTER TABLE properties ADD COLUMN thumbnail_path TEXT"))
+                db.session.commit()
+                app.logger.info("✅ Added properties.thumbnail_path column.")
+            except Exception as e:
+                db.session.rollback()
+                if "duplicate column" not in str(e).lower():
+                    app.logger.warning(f"⚠️ Could not add 'thumbnail_path' column to properties: {e}")
+                
         # Create vendor_comments table if it doesn't exist
         try:
             db.session.execute(text("""
@@ -230,12 +339,61 @@ with app.app_context():
                 app.logger.info("✅ vendor_comments table already exists.")
             else:
                 app.logger.warning(f"⚠️ Could not create vendor_comments table: {e}")
+        
+        # Composite indexes for keyset pagination of the message list (create_all skips existing tables)
+        message_list_indexes = [
+            "CREATE INDEX IF NOT EXISTS ix_messages_timestamp_id ON messages (timestamp, id)",
+            "CREATE INDEX IF NOT EXISTS ix_messages_property_timestamp_id ON messages (property_id, timestamp, id)"
+        ]
+        for sql in message_list_indexes:
+            try:
+                db.session.execute(text(sql))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.warning(f"⚠️ {sql} - {e}")
+        
+        # Full-text search index for the message list (tsvector + GIN on Postgres, FTS5 on SQLite)
+        try:
+            search_index.ensure_schema()
+            app.logger.info(f"✅ Message search backend: {search_index.backend or 'ILIKE fallback'}")
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"⚠️ Could not set up message search index: {e}")
+        
+        # One-time conversion of legacy local_media_paths text into message_media rows
+        try:
+            ensure_converted()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.warning(f"⚠️ Could not convert legacy media paths (run `flask migrate-message-media`): {e}")
             
         app.logger.info("✅ Database initialization complete.")
     except Exception as e:
         db.session.rollback()
         app.logger.critical(f"❌ Database initialization error: {e}")
 
+def start_background_workers():
+    """Start the threads that work through queued jobs in a serving process.
+
+    Called from gunicorn.conf.py (post_worker_init) and from __main__ below, never at import: CLI commands
+    (flask db upgrade, flask migrate-message-media, ...) import main too and must not claim work they won't finish.
+    """
+    outbox.start_dispatcher()
+    # Pick up media jobs a previous process left unfinished
+    with app.app_context():
+        try:
+            resumed = media_job_runner.resume_pending()
+            app.logger.info(f"✅ Media job runner ready ({media_job_runner.max_workers} workers, {resumed} pending job(s) resumed).")
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"❌ Could not resume pending media jobs: {e}")
+    if webhook_spool.enabled:
+        webhook_spool.start_consumer()
+    # Embed messages that arrived while the app was down; syncs hold a file lock, so one worker embeds
+    # them and the others load its result
+    semantic_index.schedule_sync()
+
 # Define all routes first, then print URL map at the end
 
 @app.context_processor
@@ -260,8 +418,7 @@ def index():
         start_today_utc = datetime.combine(now_utc.date(), datetime.min.time(), tzinfo=timezone.utc)
         start_week_utc = start_today_utc - timedelta(days=start_today_utc.weekday())
         
-        count_today = db.session.query(func.count(Message.id)).filter(Message.timestamp >= start_today_utc).scalar() or 0
-        count_week = db.session.query(func.count(Message.id)).filter(Message.timestamp >= start_week_utc).scalar() or 0
+        count_today, count_week = message_stats.count_since(start_today_utc, start_week_utc)
         
         summary_today = f"{count_today} messages today."
         summary_week = f"{count_week} messages this week."
@@ -302,6 +459,7 @@ def vendors_list():
         
         # Get all vendors
         vendors = query.order_by(Vendor.company_name).all()
+        Vendor.load_job_stats(vendors)  # One grouped query instead of four per vendor card
         
         # Get vendor types for filter dropdown
         vendor_types = db.session.query(Vendor.vendor_type).distinct().filter(
@@ -455,7 +613,9 @@ def vendor_create():
             )
             
             db.session.add(vendor)
+            search_index.reindex_phone(phone_number)
             db.session.commit()
+            invalidate_contact(phone_number)
             
             flash(f"Vendor '{company_name or contact_name}' created successfully", "success")
             return redirect(url_for('vendor_detail', vendor_id=vendor.id))
@@ -536,8 +696,10 @@ def vendor_edit(vendor_id):
             contact_name = request.form.get('contact_name', '').strip()
             if contact_name and vendor.contact:
                 vendor.contact.contact_name = contact_name
+                search_index.reindex_phone(vendor.contact_id)
             
             db.session.commit()
+            invalidate_contact(vendor.contact_id)
             flash("Vendor updated successfully", "success")
             return redirect(url_for('vendor_detail', vendor_id=vendor_id))
             
@@ -741,7 +903,9 @@ def process_vendor_invoice(vendor_id):
         
         Return only valid JSON, no other text."""
         
-        response = client.chat.completions.create(
+        # Cached by prompt, so re-processing the same invoice text skips the API
+        response_text = llm_cache.chat_completion(
+            client,
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a data extraction assistant specializing in vendor invoices. Extract the VENDOR/COMPANY information (not customer/service location). Look for letterhead, 'From' sections, company info. Return only valid JSON."},
@@ -752,7 +916,7 @@ def process_vendor_invoice(vendor_id):
         )
         
         # Parse the extracted data
-        extracted_data = json.loads(response.choices[0].message.content)
+        extracted_data = json.loads(response_text)
         
         # Log extracted data for debugging
         app.logger.info(f"Extracted vendor data: {extracted_data}")
@@ -832,7 +996,8 @@ def process_vendor_invoice(vendor_id):
             Invoice text: {extracted_text[:2000]}"""
             
             try:
-                alt_response = client.chat.completions.create(
+                alt_response_text = llm_cache.chat_completion(
+                    client,
                     model="gpt-3.5-turbo",
                     messages=[
                         {"role": "system", "content": "Extract alternative vendor addresses."},
@@ -841,7 +1006,7 @@ def process_vendor_invoice(vendor_id):
                     temperature=0.1,
                     max_tokens=500
                 )
-                alt_data = json.loads(alt_response.choices[0].message.content)
+                alt_data = json.loads(alt_response_text)
                 if alt_data.get('alternative_addresses'):
                     # Use the first alternative address if found
                     alt_addr = alt_data['alternative_addresses'][0]
@@ -1050,6 +1215,7 @@ def vendor_review_invoice(vendor_id):
 @app.route("/contact/update", methods=["POST"])
 def update_contact():
     """Update contact name for a phone number."""
+    phone_number = None
     try:
         data = request.get_json()
         phone_number = data.get('phone_number')
@@ -1061,12 +1227,12 @@ def update_contact():
         if not new_name:
             return jsonify({"success": False, "error": "Contact name required"}), 400
         
-        # Check if contact exists
-        contact = Contact.query.filter_by(phone_number=phone_number).first()
+        # Check if contact exists (cached lookup shared with the webhook)
+        old_name, exists = lookup_contact(phone_number)
+        contact = db.session.get(Contact, phone_number) if exists else None
         
         if contact:
             # Update existing contact
-            old_name = contact.contact_name
             contact.contact_name = new_name
             app.logger.info(f"Updated contact {phone_number}: '{old_name}' -> '{new_name}'")
         else:
@@ -1078,7 +1244,10 @@ def update_contact():
             db.session.add(contact)
             app.logger.info(f"Created new contact {phone_number}: '{new_name}'")
         
+        # Search documents carry the contact name
+        search_index.reindex_phone(phone_number)
         db.session.commit()
+        remember_contact(phone_number, new_name)
         
         return jsonify({
             "success": True, 
@@ -1091,9 +1260,210 @@ def update_contact():
         
     except Exception as e:
         db.session.rollback()
+        if phone_number:
+            invalidate_contact(phone_number)
         app.logger.error(f"Error updating contact: {e}")
         return jsonify({"success": False, "error": str(e)}), 500
 
+def filtered_messages_query(filter_type='all', property_filter=None, search_query=''):
+    """Message query with the /messages list filters applied (no ordering or paging)."""
+    # Start with base query
+    query = Message.query.options(
+        joinedload(Message.property), 
+        joinedload(Message.contact),
+        selectinload(Message.media)
+    )
+    
+    # Apply search filter if provided (full-text index when available, ILIKE otherwise)
+    search_ids = search_index.match_ids(search_query) if search_query else None
+    if search_ids is not None:
+        query = query.filter(Message.id.in_(search_ids))
+    elif search_query:
+        query = query.filter(
+            db.or_(
+                Message.message.ilike(f'%{search_query}%'),
+                Message.phone_number.ilike(f'%{search_query}%'),
+                Message.contact_name.ilike(f'%{search_query}%')
+            )
+        )
+    
+    # Apply filters
+    if filter_type == 'with_media':
+        # Only messages with media
+        query = query.filter(has_media())
+    elif filter_type == 'unsorted_media':
+        # Messages with media but no property
+        query = query.filter(has_media(), Message.property_id.is_(None))
+    elif filter_type == 'no_property':
+        # All messages without property
+        query = query.filter(Message.property_id.is_(None))
+    
+    # Property filter
+    if property_filter:
+        query = query.filter(Message.property_id == property_filter)
+    return query
+
+
+@app.route("/messages/api")
+def messages_api():
+    """Keyset-paginated message list as JSON; accepts the /messages filters plus after/before cursors."""
+    per_page = max(1, min(request.args.get('per_page', 50, type=int), MAX_PER_PAGE))
+    query = filtered_messages_query(
+        request.args.get('filter', 'all'),
+        request.args.get('property_id', type=int),
+        request.args.get('search', '')
+    )
+    try:
+        page = keyset_paginate(query, Message.timestamp, Message.id, per_page=per_page,
+                               after=request.args.get('after'), before=request.args.get('before'))
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+    
+    return jsonify({
+        "messages": [{
+            "id": msg.id,
+            "sid": msg.sid,
+            "phone_number": msg.phone_number,
+            "contact_name": msg.contact.contact_name if msg.contact and msg.contact.contact_name else msg.contact_name,
+            "direction": msg.direction,
+            "message": msg.message,
+            "timestamp": msg.timestamp.isoformat(),
+            "property_id": msg.property_id,
+            "property_name": msg.property.name if msg.property else None,
+            "media_paths": [media.path for media in msg.media],
+        } for msg in page.items],
+        "per_page": per_page,
+        "next_cursor": page.next_cursor,
+        "prev_cursor": page.prev_cursor,
+    })
+
+
+def conversation_summaries(property_filter=None, limit=CONVERSATION_LIMIT):
+    """Latest message per phone number for the conversation sidebar, newest threads first.
+
+    One query: ROW_NUMBER() OVER (PARTITION BY phone_number ...) picks each thread's last
+    message and COUNT(*) OVER the same partition sizes it. With a property filter, threads
+    that have any message for that property are included (showing their overall last message).
+    """
+    ranked = select(
+        Message.id.label('id'),
+        func.row_number().over(
+            partition_by=Message.phone_number,
+            order_by=(Message.timestamp.desc(), Message.id.desc())
+        ).label('rn'),
+        func.count(Message.id).over(partition_by=Message.phone_number).label('message_count')
+    )
+    if property_filter:
+        ranked = ranked.where(Message.phone_number.in_(
+            select(Message.phone_number).where(Message.property_id == property_filter)
+        ))
+    ranked = ranked.subquery()
+    
+    rows = db.session.query(Message, ranked.c.message_count).join(
+        ranked, Message.id == ranked.c.id
+    ).filter(ranked.c.rn == 1).options(
+        joinedload(Message.property),
+        joinedload(Message.contact)
+    ).order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit).all()
+    
+    conversations = []
+    for last_msg, message_count in rows:
+        contact = last_msg.contact
+        conversations.append({
+            'phone_number': last_msg.phone_number,
+            'contact_name': contact.contact_name if contact and contact.contact_name else last_msg.phone_number,
+            'property_name': last_msg.property.name if last_msg.property else None,
+            'property_id': last_msg.property_id,
+            'last_message': (last_msg.message[:50] + '...') if last_msg.message and len(last_msg.message) > 50 else last_msg.message or '',
+            'last_message_time': last_msg.timestamp.strftime('%I:%M %p') if last_msg.timestamp else '',
+            'last_direction': last_msg.direction,
+            'message_count': message_count,
+            'unread_count': 0,  # You can implement unread logic later
+        })
+    return conversations
+
+
+@app.route("/messages/search")
+def search_messages_api():
+    """Ranked full-text message search as JSON: q plus optional property_id, since/until (YYYY-MM-DD), limit."""
+    query_text = request.args.get('q', '').strip()
+    property_id = request.args.get('property_id', type=int)
+    limit = max(1, min(request.args.get('limit', 50, type=int), MAX_PER_PAGE))
+    try:
+        since = datetime.strptime(request.args['since'], '%Y-%m-%d') if request.args.get('since') else None
+        until = datetime.strptime(request.args['until'], '%Y-%m-%d') + timedelta(days=1) if request.args.get('until') else None
+    except ValueError:
+        return jsonify({"error": "Dates must be YYYY-MM-DD"}), 400
+    if not query_text:
+        return jsonify({"error": "No query provided"}), 400
+    
+    ranked = search_index.search(query_text, property_id=property_id, since=since, until=until, limit=limit)
+    if ranked is None:
+        # No built index (or nothing searchable in q): unranked substring match, newest first
+        query = filtered_messages_query('all', property_id, query_text)
+        if since:
+            query = query.filter(Message.timestamp >= since)
+        if until:
+            query = query.filter(Message.timestamp < until)
+        ranked = [(msg.id, None) for msg in query.order_by(Message.timestamp.desc()).limit(limit).all()]
+    
+    messages = {msg.id: msg for msg in Message.query.options(
+        joinedload(Message.property), joinedload(Message.contact)
+    ).filter(Message.id.in_([message_id for message_id, _ in ranked])).all()}
+    
+    results = []
+    for message_id, score in ranked:
+        msg = messages.get(message_id)
+        if not msg:
+            continue
+        results.append({
+            "id": msg.id,
+            "score": round(score, 6) if score is not None else None,
+            "phone_number": msg.phone_number,
+            "contact_name": msg.contact.contact_name if msg.contact and msg.contact.contact_name else msg.contact_name,
+            "direction": msg.direction,
+            "message": msg.message,
+            "timestamp": msg.timestamp.isoformat() if msg.timestamp else None,
+            "property_id": msg.property_id,
+            "property_name": msg.property.name if msg.property else None,
+        })
+    return jsonify({"query": query_text, "backend": search_index.backend if search_index.ready() else "ilike", "results": results})
+
+
+@app.route("/messages/conversation/<phone_number>")
+def conversation_messages_api(phone_number):
+    """One page of a thread's messages (oldest first within the page); `after` cursor loads earlier ones."""
+    per_page = max(1, min(request.args.get('per_page', 50, type=int), MAX_PER_PAGE))
+    query = Message.query.options(joinedload(Message.contact), selectinload(Message.media)).filter(
+        Message.phone_number == phone_number
+    )
+    try:
+        page = keyset_paginate(query, Message.timestamp, Message.id, per_page=per_page,
+                               after=request.args.get('after'))
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+    
+    messages = []
+    for msg in reversed(page.items):  # Chronological order for the chat view
+        contact = msg.contact
+        messages.append({
+            'id': msg.id,
+            'message': msg.message or '',
+            'timestamp': msg.timestamp.isoformat(),
+            'direction': msg.direction,
+            'contact_name': contact.contact_name if contact and contact.contact_name else phone_number,
+            'media_urls': [url_for('serve_media', filename=media.path.replace('\\', '/').replace('uploads/', '', 1))
+                           for media in msg.media],
+            'media_thumbs': [url_for('serve_media', filename=media.path.replace('\\', '/').replace('uploads/', '', 1), size='thumb')
+                             for media in msg.media]
+        })
+    return jsonify({
+        "phone_number": phone_number,
+        "messages": messages,
+        "next_cursor": page.next_cursor,  # Earlier messages
+    })
+
+
 @app.route("/messages")
 def messages_view():
     """Displays message overview or detail for a specific number."""
@@ -1137,167 +1507,58 @@ def messages_view():
             property_filter = request.args.get('property_id', type=int)
             search_query = request.args.get('search', '')
             
-            # Start with base query
-            query = Message.query.options(
-                joinedload(Message.property), 
-                joinedload(Message.contact)
-            )
-            
-            # Apply search filter if provided
-            if search_query:
-                query = query.filter(
-                    db.or_(
-                        Message.message.ilike(f'%{search_query}%'),
-                        Message.phone_number.ilike(f'%{search_query}%'),
-                        Message.contact_name.ilike(f'%{search_query}%')
-                    )
-                )
-            
-            # Apply filters
-            if filter_type == 'with_media':
-                # Only messages with media
-                query = query.filter(
-                    Message.local_media_paths.isnot(None),
-                    Message.local_media_paths != '',
-                    Message.local_media_paths != '[]'
-                )
-            elif filter_type == 'unsorted_media':
-                # Messages with media but no property
-                query = query.filter(
-                    Message.local_media_paths.isnot(None),
-                    Message.local_media_paths != '',
-                    Message.local_media_paths != '[]',
-                    Message.property_id.is_(None)
-                )
-            elif filter_type == 'no_property':
-                # All messages without property
-                query = query.filter(Message.property_id.is_(None))
-            
-            # Property filter
-            if property_filter:
-                query = query.filter(Message.property_id == property_filter)
-            
-            # Order and paginate
-            query = query.order_by(Message.timestamp.desc())
-            pagination = query.paginate(page=page, per_page=per_page, error_out=False)
-            
-            # Parse media paths for each message
-            import json
-            for msg in pagination.items:
-                msg.parsed_media_paths = []
-                if msg.local_media_paths and msg.local_media_paths.startswith('['):
-                    try:
-                        msg.parsed_media_paths = json.loads(msg.local_media_paths)
-                    except:
-                        pass
-            
-            # Get properties for filter dropdown
-            properties_list = Property.query.order_by(Property.name).all()
-            
-            # Get known contact phones for the template
-            known_contacts = Contact.query.all()
-            known_contact_phones = {c.phone_number for c in known_contacts}
-            
-            # Count statistics
-            total_messages = Message.query.count()
-            messages_with_media = Message.query.filter(
-                Message.local_media_paths.isnot(None),
-                Message.local_media_paths != '',
-                Message.local_media_paths != '[]'
-            ).count()
-            unsorted_media = Message.query.filter(
-                Message.local_media_paths.isnot(None),
-                Message.local_media_paths != '',
-                Message.local_media_paths != '[]',
-                Message.property_id.is_(None)
-            ).count()
-            
-            # Check if conversation view is requested
+            # Conversation view: one windowed query for the thread summaries; messages load per thread via JSON
             if view_type == "conversation":
                 try:
-                    # Group messages by phone number for conversation view
-                    from collections import defaultdict
-                    conversations = []
-                    
-                    # Get all unique phone numbers with their latest message
-                    phone_numbers = db.session.query(
-                        Message.phone_number,
-                        func.max(Message.timestamp).label('last_message_time')
-                    ).group_by(Message.phone_number)
-                    
-                    # Apply property filter if needed
-                    if property_filter:
-                        phone_numbers = phone_numbers.filter(Message.property_id == property_filter)
-                    
-                    phone_numbers = phone_numbers.limit(100).all()  # Limit to 100 conversations for performance
-                    
-                    for phone, last_time in phone_numbers:
-                        # Get all messages for this phone number (limit to last 50 for performance)
-                        conv_messages = Message.query.filter_by(phone_number=phone).options(
-                            joinedload(Message.property),
-                            joinedload(Message.contact)
-                        ).order_by(Message.timestamp.desc()).limit(50).all()
-                        
-                        # Reverse to get chronological order
-                        conv_messages.reverse()
-                        
-                        if conv_messages:
-                            last_msg = conv_messages[-1]
-                            contact = last_msg.contact
-                            
-                            # Format messages for JavaScript
-                            formatted_messages = []
-                            for msg in conv_messages:
-                                formatted_msg = {
-                                    'id': msg.id,
-                                    'message': msg.message or '',
-                                    'timestamp': msg.timestamp.isoformat(),
-                                    'direction': msg.direction,
-                                    'contact_name': contact.contact_name if contact and contact.contact_name else phone,
-                                    'media_urls': []
-                                }
-                                
-                                # Parse media URLs
-                                if msg.local_media_paths and msg.local_media_paths.startswith('['):
-                                    try:
-                                        import json
-                                        media_paths = json.loads(msg.local_media_paths)
-                                        formatted_msg['media_urls'] = [url_for('serve_media', filename=path.replace('\\', '/')) for path in media_paths]
-                                    except:
-                                        pass
-                                
-                                formatted_messages.append(formatted_msg)
-                            
-                            conversation = {
-                                'phone_number': phone,
-                                'contact_name': contact.contact_name if contact and contact.contact_name else phone,
-                                'property_name': last_msg.property.name if last_msg.property else None,
-                                'property_id': last_msg.property_id,
-                                'last_message': (last_msg.message[:50] + '...') if last_msg.message and len(last_msg.message) > 50 else last_msg.message or '',
-                                'last_message_time': last_msg.timestamp.strftime('%I:%M %p'),
-                                'last_direction': last_msg.direction,
-                                'unread_count': 0,  # You can implement unread logic later
-                                'messages': formatted_messages
-                            }
-                            conversations.append(conversation)
-                    
-                    # Sort conversations by last message time
-                    conversations.sort(key=lambda x: x['messages'][-1]['timestamp'], reverse=True)
-                    
+                    conversations = conversation_summaries(property_filter)
                     return render_template("messages_conversation.html",
                                          conversations=conversations,
-                                         properties=properties_list,
+                                         properties=Property.query.order_by(Property.name).all(),
                                          property_filter=property_filter)
                 except Exception as e:
+                    db.session.rollback()
                     app.logger.error(f"Error in conversation view: {e}")
                     flash(f"Error loading conversations: {e}", "danger")
                     # Fall back to list view
                     view_type = "list"
             
+            query = filtered_messages_query(filter_type, property_filter, search_query)
+            
+            # Keyset (cursor) pagination by default; ?page=N keeps the old OFFSET paging for existing links
+            per_page = max(1, min(per_page, MAX_PER_PAGE))
+            pagination = keyset = None
+            if 'page' in request.args:
+                query = query.order_by(Message.timestamp.desc())
+                pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+                page_messages = pagination.items
+            else:
+                try:
+                    keyset = keyset_paginate(query, Message.timestamp, Message.id, per_page=per_page,
+                                             after=request.args.get('after'), before=request.args.get('before'))
+                except InvalidCursor:
+                    flash("That page link has expired; showing the newest messages.", "warning")
+                    keyset = keyset_paginate(query, Message.timestamp, Message.id, per_page=per_page)
+                page_messages = keyset.items
+            
+            # Get properties for filter dropdown
+            properties_list = Property.query.order_by(Property.name).all()
+            
+            # Get known contact phones for the template
+            known_contacts = Contact.query.all()
+            known_contact_phones = {c.phone_number for c in known_contacts}
+            
+            # Count statistics (cached; see message_stats)
+            totals = message_stats.totals()
+            total_messages = totals["total"]
+            messages_with_media = totals["with_media"]
+            unsorted_media = totals["unsorted_media"]
+            
             # Default list view
             return render_template("messages_overview.html", 
-                                 messages=pagination.items,
+                                 messages=page_messages,
                                  pagination=pagination,
+                                 keyset=keyset,
+                                 per_page=per_page,
                                  properties=properties_list,
                                  known_contact_phones=known_contact_phones,
                                  filter_type=filter_type,
@@ -1352,78 +1613,40 @@ def ai_search_messages():
                 target_property = prop
                 break
         
-        # Build query for messages
-        messages_query = Message.query.options(
-            joinedload(Message.property),
-            joinedload(Message.contact)
-        ).filter(Message.message.isnot(None))
-        
-        # If we identified a specific property, filter by it
-        if target_property:
-            messages_query = messages_query.filter(Message.property_id == target_property.id)
-            app.logger.info(f"AI Search filtered to property: {target_property.name}")
-        
         # Check if query is asking for recent/time-based information
         time_indicators = ['week', 'recent', 'lately', 'today', 'yesterday', 'past', 'last']
         is_time_query = any(indicator in query_lower for indicator in time_indicators)
-        
-        if is_time_query:
-            # For time-based queries, get messages from the last 2 weeks
-            two_weeks_ago = datetime.now() - timedelta(days=14)
-            messages_query = messages_query.filter(Message.timestamp >= two_weeks_ago)
-            app.logger.info(f"AI Search filtered to messages since: {two_weeks_ago}")
-        
-        # Get messages (more for time-based queries)
-        message_limit = 100 if is_time_query else 50
-        messages = messages_query.order_by(Message.timestamp.desc()).limit(message_limit).all()
-        
-        app.logger.info(f"Found {len(messages)} messages to analyze")
-        
-        # For broad queries like "problems this week", include most messages
-        broad_indicators = ['general', 'problems', 'issues', 'what', 'anything', 'tell me about']
-        is_broad_query = any(indicator in query_lower for indicator in broad_indicators)
-        
-        relevant_messages = []
-        
-        if is_broad_query or is_time_query:
-            # For broad/time queries, include most messages with minimal filtering
-            relevant_messages = messages[:30]
-            app.logger.info(f"Broad/time query - using {len(relevant_messages)} messages")
+        since = datetime.now() - timedelta(days=14) if is_time_query else None
+        if target_property:
+            app.logger.info(f"AI Search filtered to property: {target_property.name}")
+        if since:
+            app.logger.info(f"AI Search filtered to messages since: {since}")
+        
+        # The messages closest in meaning to the query, from any date unless the query is time-based
+        ranked = semantic_index.search(query, k=AI_CONTEXT_MESSAGES,
+                                       property_id=target_property.id if target_property else None,
+                                       since=since)
+        if ranked is not None:
+            by_id = {msg.id: msg for msg in Message.query.options(
+                joinedload(Message.property),
+                joinedload(Message.contact)
+            ).filter(Message.id.in_([mid for mid, _ in ranked]), Message.message.isnot(None))}
+            relevant_messages = [by_id[mid] for mid, _ in ranked if mid in by_id]
+            query_type = "semantic"
+            app.logger.info(f"Semantic search found {len(relevant_messages)} relevant messages")
         else:
-            # For specific queries, do keyword filtering
-            issue_keywords = []
-            common_issues = {
-                'ac': ['ac', 'air conditioning', 'hvac', 'cooling', 'heat pump', 'hot', 'cold'],
-                'refrigerator': ['fridge', 'refrigerator', 'freezer', 'ice'],
-                'microwave': ['microwave'],
-                'appliance': ['appliance', 'dishwasher', 'washer', 'dryer', 'oven', 'stove'],
-                'plumbing': ['plumbing', 'leak', 'water', 'toilet', 'sink', 'faucet', 'pipe', 'drain'],
-                'electrical': ['electrical', 'power', 'outlet', 'light', 'switch', 'breaker'],
-                'lawn': ['lawn', 'grass', 'yard', 'landscaping', 'mowing'],
-                'roof': ['roof', 'roofing', 'shingle', 'gutter'],
-                'security': ['security', 'camera', 'alarm', 'lock'],
-                'repair': ['repair', 'fix', 'broken', 'maintenance', 'replace', 'install'],
-                'problem': ['problem', 'issue', 'trouble', 'concern', 'complaint', 'broken', 'not working']
-            }
-            
-            for category, keywords in common_issues.items():
-                if any(keyword in query_lower for keyword in keywords):
-                    issue_keywords.extend(keywords)
-            
-            # Filter messages by keywords
-            for msg in messages:
-                if msg.message:
-                    msg_lower = msg.message.lower()
-                    if any(keyword in msg_lower for keyword in issue_keywords):
-                        relevant_messages.append(msg)
-            
-            app.logger.info(f"Keyword filtering found {len(relevant_messages)} relevant messages")
-            
-            # If very few found, add recent messages
-            if len(relevant_messages) < 5:
-                recent_additions = [msg for msg in messages[:20] if msg not in relevant_messages]
-                relevant_messages.extend(recent_additions[:10])
-                app.logger.info(f"Added {len(recent_additions[:10])} recent messages as context")
+            # No semantic index (or nothing in it yet): fall back to the newest matching messages
+            messages_query = Message.query.options(
+                joinedload(Message.property),
+                joinedload(Message.contact)
+            ).filter(Message.message.isnot(None))
+            if target_property:
+                messages_query = messages_query.filter(Message.property_id == target_property.id)
+            if since:
+                messages_query = messages_query.filter(Message.timestamp >= since)
+            relevant_messages = messages_query.order_by(Message.timestamp.desc()).limit(AI_CONTEXT_MESSAGES).all()
+            query_type = "recent"
+            app.logger.info(f"Using {len(relevant_messages)} recent messages as context")
         
         # Build context for AI
         message_context = []
@@ -1441,7 +1664,7 @@ def ai_search_messages():
                 "response": "No relevant messages found for your query. Try broadening your search terms or check if there are any messages in the selected time period.",
                 "relevant_messages": [],
                 "messages_analyzed": 0,
-                "debug_info": f"Total messages in DB: {Message.query.count()}, Messages after filtering: {len(messages)}"
+                "debug_info": f"Total messages in DB: {Message.query.count()}, Search type: {query_type}"
             })
         
         # Create AI prompt
@@ -1466,8 +1689,10 @@ def ai_search_messages():
         5. Provide actionable insights when possible
         """
         
-        # Call OpenAI
-        response = client.chat.completions.create(
+        # Call OpenAI (answers are reused until messages for this property change)
+        ai_response = llm_cache.chat_completion(
+            client,
+            tags=property_tags(target_property.id if target_property else None),
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": "You are a helpful property management assistant. Analyze the provided messages and give useful insights."},
@@ -1477,7 +1702,6 @@ def ai_search_messages():
             temperature=0.2
         )
         
-        ai_response = response.choices[0].message.content
         relevant_msg_ids = [msg.id for msg in relevant_messages]
         
         result = {
@@ -1485,8 +1709,7 @@ def ai_search_messages():
             "relevant_messages": relevant_msg_ids,
             "property_filtered": target_property.name if target_property else None,
             "messages_analyzed": len(relevant_messages),
-            "total_messages_found": len(messages),
-            "query_type": "broad/time" if (is_broad_query or is_time_query) else "specific"
+            "query_type": query_type
         }
         
         app.logger.info(f"AI Search returning: {len(ai_response)} char response, {len(relevant_msg_ids)} relevant messages")
@@ -1532,7 +1755,12 @@ def assign_property_to_message():
         # Update the message
         old_property_id = message.property_id
         message.property_id = property_id
+        sync_media_property(message.id, property_id)
         db.session.commit()
+        message_stats.record_property_change(bool(message.media), old_property_id, property_id)
+        gallery_overview.invalidate()
+        llm_cache.invalidate_property(old_property_id)
+        llm_cache.invalidate_property(property_id)
         
         property_name = "Unassigned"
         if property_id:
@@ -1569,22 +1797,10 @@ def set_property_thumbnail(property_id):
         if not property_obj:
             return jsonify({"error": "Property not found"}), 404
         
-        # Add thumbnail_path column if it doesn't exist (for migration)
-        try:
-            # Check if the column exists
-            inspector = inspect(db.engine)
-            columns = [column['name'] for column in inspector.get_columns('properties')]
-            if 'thumbnail_path' not in columns:
-                # Add the column
-                db.session.execute(text("ALTER TABLE properties ADD COLUMN thumbnail_path TEXT"))
-                db.session.commit()
-                app.logger.info("Added thumbnail_path column to properties table")
-        except Exception as e:
-            app.logger.warning(f"Could not add thumbnail_path column: {e}")
-        
         # Update the property thumbnail
         property_obj.thumbnail_path = thumbnail_path
         db.session.commit()
+        gallery_overview.invalidate()
         
         app.logger.info(f"Set thumbnail for property {property_obj.name}: {thumbnail_path}")
         
@@ -1608,9 +1824,10 @@ def remove_property_thumbnail(property_id):
             return jsonify({"error": "Property not found"}), 404
         
         # Remove the thumbnail
-        old_thumbnail = getattr(property_obj, 'thumbnail_path', None)
+        old_thumbnail = property_obj.thumbnail_path
         property_obj.thumbnail_path = None
         db.session.commit()
+        gallery_overview.invalidate()
         
         app.logger.info(f"Removed thumbnail for property {property_obj.name}: {old_thumbnail}")
         
@@ -1689,12 +1906,24 @@ def properties_list_view():
     """Displays a list of all properties."""
     try:
         properties = Property.query.order_by(Property.name).all()
-        return render_template('properties_list.html', properties=properties)
+        summaries = load_property_summaries()
+        return render_template('properties_list.html', properties=properties, summaries=summaries)
     except Exception as e:
         app.logger.error(f"Error loading properties: {e}")
         flash(f"Error loading properties: {e}", "danger")
         return redirect(url_for('index'))
 
+@app.route('/api/properties/summary')
+def api_property_summaries():
+    """Dashboard counters for many properties at once: ?ids=1,2,3 (all properties when omitted)."""
+    ids = request.args.get('ids', '').strip()
+    try:
+        property_ids = [int(i) for i in ids.split(',') if i.strip()] if ids else None
+    except ValueError:
+        return jsonify({"error": "ids must be a comma-separated list of integers"}), 400
+    summaries = load_property_summaries(property_ids)
+    return jsonify({"summaries": {str(pid): counters for pid, counters in summaries.items()}})
+
 @app.route('/property/<int:property_id>')
 def property_detail_view(property_id):
     """Displays detailed information for a specific property."""
@@ -1713,21 +1942,19 @@ def property_detail_view(property_id):
             .all()
         )
         
-        # Get custom fields count
-        custom_fields_count = PropertyCustomField.query.filter_by(property_id=property_id).count()
+        # All dashboard counters in one query
+        summary = load_property_summary(property_id)
         
-        # Get attachments count
-        attachments_count = PropertyAttachment.query.filter_by(property_id=property_id).count()
-        
-        # Get contacts count
-        contacts_count = PropertyContact.query.filter_by(property_id=property_id).count()
+        current_tenants = property_obj.current_tenants
         
         return render_template('property_detail.html', 
                              property=property_obj,
                              recent_messages=recent_messages,
-                             custom_fields_count=custom_fields_count,
-                             attachments_count=attachments_count,
-                             contacts_count=contacts_count)
+                             summary=summary,
+                             current_tenants=current_tenants,
+                             custom_fields_count=summary['custom_fields'],
+                             attachments_count=summary['attachments'],
+                             contacts_count=summary['contacts'])
         
     except Exception as e:
         db.session.rollback()
@@ -1750,121 +1977,92 @@ def contacts_view():
 def galleries_overview():
     """Display galleries overview with thumbnails."""
     try:
-        # Get properties that have media
-        property_ids_with_media = (
-            db.session.query(Message.property_id)
-            .filter(
-                Message.property_id.isnot(None), 
-                Message.local_media_paths.isnot(None)
-            )
-            .distinct()
-            .all()
-        )
-        prop_ids = [pid for (pid,) in property_ids_with_media]
-        
-        properties_with_galleries = []
-        if prop_ids:
-            properties_with_galleries = (
-                Property.query.filter(Property.id.in_(prop_ids))
-                .order_by(Property.name)
-                .all()
-            )
-        
-        # Get sample images for properties and set thumbnail info
-        for prop in properties_with_galleries:
-            # Check if property has thumbnail_path attribute and value
-            thumbnail_path = getattr(prop, 'thumbnail_path', None)
-            prop.has_thumbnail = bool(thumbnail_path)
-            
-            if not thumbnail_path:
-                # Get the first available image for this property
-                sample_message = (
-                    Message.query.filter(
-                        Message.property_id == prop.id,
-                        Message.local_media_paths.isnot(None),
-                        Message.local_media_paths != '',
-                        Message.local_media_paths != '[]'
-                    )
-                    .order_by(Message.timestamp.desc())
-                    .first()
-                )
-                
-                if sample_message and sample_message.local_media_paths:
-                    try:
-                        import json
-                        if sample_message.local_media_paths.startswith('['):
-                            media_paths = json.loads(sample_message.local_media_paths)
-                        else:
-                            media_paths = [sample_message.local_media_paths]
-                        
-                        if media_paths and media_paths[0]:
-                            prop.sample_image = media_paths[0]
-                        else:
-                            prop.sample_image = None
-                    except:
-                        prop.sample_image = None
-                else:
-                    prop.sample_image = None
-            else:
-                prop.sample_image = thumbnail_path
-        
-        # Count unsorted media
-        unsorted_count = db.session.query(func.count(Message.id)).filter(
-            Message.property_id.is_(None), 
-            Message.local_media_paths.isnot(None)
-        ).scalar() or 0
-        
+        # One windowed query (cached) for every property's image count and cover image
+        overview = gallery_overview.snapshot()
         return render_template("galleries_overview.html",
-                             gallery_summaries=properties_with_galleries,
-                             unsorted_count=unsorted_count)
+                             gallery_summaries=overview["properties"],
+                             unsorted_count=overview["unsorted_count"])
     except Exception as e:
+        db.session.rollback()
         app.logger.error(f"Error loading galleries: {e}")
         flash(f"Error loading galleries: {e}", "danger")
         return redirect(url_for('index'))
     
+def gallery_page(criteria, per_page=GALLERY_PAGE_SIZE, after=None):
+    """One keyset page of gallery images (newest message first) matching a message_media criterion.
+
+    Rows are flat column tuples (no ORM objects), so a page costs the same however large the gallery is.
+    """
+    query = (
+        db.session.query(
+            MessageMedia.id.label("id"),
+            MessageMedia.path.label("path"),
+            MessageMedia.width.label("width"),
+            MessageMedia.height.label("height"),
+            Message.id.label("message_id"),
+            Message.timestamp.label("timestamp"),
+            Message.phone_number.label("phone_number"),
+            func.coalesce(Contact.contact_name, Message.contact_name).label("contact_name"),
+            Property.name.label("property_name"),
+        )
+        .join(Message, Message.id == MessageMedia.message_id)
+        .outerjoin(Contact, Contact.phone_number == Message.phone_number)
+        .outerjoin(Property, Property.id == Message.property_id)
+        .filter(criteria)
+    )
+    return keyset_paginate(query, Message.timestamp, MessageMedia.id, per_page=per_page, after=after)
+
+
+def gallery_item_json(row):
+    filename = row.path.replace('\\', '/').replace('uploads/', '', 1)
+    return {
+        "id": row.id,
+        "path": row.path,
+        "url": url_for('serve_media', filename=filename),
+        "thumb_url": url_for('serve_media', filename=filename, size='thumb'),
+        "width": row.width,
+        "height": row.height,
+        "message_id": row.message_id,
+        "timestamp": row.timestamp.isoformat(),
+        "sender": row.contact_name or row.phone_number,
+        "property_name": row.property_name,
+    }
+
+
+@app.route("/gallery/api/unsorted")
+@app.route("/gallery/api/<int:property_id>")
+def gallery_api(property_id=None):
+    """Keyset-paginated gallery images as JSON (the grid's infinite scroll); `after` continues a page."""
+    per_page = max(1, min(request.args.get('per_page', GALLERY_PAGE_SIZE, type=int), MAX_PER_PAGE))
+    criteria = MessageMedia.property_id == property_id if property_id else MessageMedia.property_id.is_(None)
+    try:
+        page = gallery_page(criteria, per_page=per_page, after=request.args.get('after'))
+    except InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({
+        "items": [gallery_item_json(row) for row in page.items],
+        "per_page": per_page,
+        "next_cursor": page.next_cursor,
+    })
+
+
+def render_gallery(criteria, prop, title):
+    """First page of a gallery; the template fetches later pages from gallery_api as the user scrolls."""
+    page = gallery_page(criteria)
+    total_images = db.session.query(func.count(MessageMedia.id)).filter(criteria).scalar()
+    return render_template("gallery.html",
+                         image_items=page.items,
+                         next_cursor=page.next_cursor,
+                         total_images=total_images,
+                         api_url=url_for('gallery_api', property_id=prop.id) if prop else url_for('gallery_api'),
+                         property=prop,
+                         gallery_title=title)
+
 @app.route("/gallery/unsorted")
 def unsorted_gallery():
     """Display gallery for unsorted media (messages without property assignment)."""
     try:
-        # Get messages with media but no property assignment
-        unsorted_messages = (
-            Message.query.options(joinedload(Message.contact))
-            .filter(
-                Message.property_id.is_(None),
-                Message.local_media_paths.isnot(None)
-            )
-            .order_by(Message.timestamp.desc())
-            .all()
-        )
-        
-        # Process media paths for display
-        image_items = []
-        for msg in unsorted_messages:
-            if msg.local_media_paths:
-                # Parse the media paths (assuming they're stored as JSON or comma-separated)
-                try:
-                    import json
-                    if msg.local_media_paths.startswith('['):
-                        media_paths = json.loads(msg.local_media_paths)
-                    else:
-                        media_paths = [path.strip() for path in msg.local_media_paths.split(',')]
-                    
-                    for path in media_paths:
-                        if path:  # Skip empty paths
-                            image_items.append({
-                                'path': path,
-                                'message': msg,
-                                'contact': msg.contact,
-                                'timestamp': msg.timestamp
-                            })
-                except (json.JSONDecodeError, AttributeError):
-                    # Handle parsing errors gracefully
-                    pass
-        
-        return render_template("gallery.html", 
-                             image_items=image_items, 
-                             property=None, 
-                             gallery_title="Unsorted Media")
+        return render_gallery(MessageMedia.property_id.is_(None), None, "Unsorted Media")
     except Exception as e:
         app.logger.error(f"Error loading unsorted gallery: {e}")
         flash(f"Error loading unsorted gallery: {e}", "danger")
@@ -1879,52 +2077,8 @@ def gallery_for_property(property_id):
             flash("Property not found.", "warning")
             return redirect(url_for("galleries_overview"))
         
-        # Add thumbnail info to property object
-        thumbnail_path = getattr(prop, 'thumbnail_path', None)
-        prop.has_thumbnail = bool(thumbnail_path)
-        # Ensure thumbnail_path is accessible even if None
-        if not hasattr(prop, 'thumbnail_path'):
-            prop.thumbnail_path = None
-        
-        # Get messages with media for this property
-        messages_with_media = (
-            Message.query.options(joinedload(Message.contact))
-            .filter(
-                Message.property_id == property_id,
-                Message.local_media_paths.isnot(None),
-                Message.local_media_paths != '',
-                Message.local_media_paths != '[]'
-            )
-            .order_by(Message.timestamp.desc())
-            .all()
-        )
-        
-        # Process media paths for display
-        image_items = []
-        for msg in messages_with_media:
-            if msg.local_media_paths:
-                try:
-                    import json
-                    if msg.local_media_paths.startswith('['):
-                        media_paths = json.loads(msg.local_media_paths)
-                    else:
-                        media_paths = [path.strip() for path in msg.local_media_paths.split(',')]
-                    
-                    for path in media_paths:
-                        if path:
-                            image_items.append({
-                                'path': path,
-                                'message': msg,
-                                'contact': msg.contact,
-                                'timestamp': msg.timestamp
-                            })
-                except (json.JSONDecodeError, AttributeError):
-                    pass
-        
-        return render_template("gallery.html", 
-                             image_items=image_items, 
-                             property=prop, 
-                             gallery_title=f"Gallery for {prop.name}")
+        prop.has_thumbnail = bool(prop.thumbnail_path)
+        return render_gallery(MessageMedia.property_id == property_id, prop, f"Gallery for {prop.name}")
     except Exception as e:
         app.logger.error(f"Error loading gallery for property {property_id}: {e}")
         flash(f"Error loading gallery: {e}", "danger")
@@ -1932,12 +2086,22 @@ def gallery_for_property(property_id):
 
 @app.route("/media/<path:filename>")
 def serve_media(filename):
-    """Serve uploaded media files."""
+    """Serve uploaded media files; ?size=thumb|medium serves a cached resized copy of images."""
     try:
-        from flask import send_from_directory
         # Use the configured UPLOAD_FOLDER which is now /app/static/uploads
         upload_folder = app.config.get("UPLOAD_FOLDER", "/app/static/uploads")
-        return send_from_directory(upload_folder, filename)
+        full_path = safe_join(upload_folder, filename)
+        if not full_path or not os.path.isfile(full_path):
+            return "File not found", 404
+        rel_path = f"{os.path.basename(upload_folder.rstrip('/'))}/{filename}"
+        sha256 = cas_sha256(rel_path) # Content-addressed files never change: cache them for good
+        size = request.args.get('size')
+        if size in THUMBNAIL_SIZES:
+            derivative = thumbnail_service.get(rel_path, size)
+            if derivative:
+                return media_sender.send(derivative, etag=f"{sha256}-{size}" if sha256 else None,
+                                         immutable=bool(sha256), mimetype="image/jpeg")
+        return media_sender.send(full_path, etag=sha256, immutable=bool(sha256))
     except Exception as e:
         app.logger.error(f"Error serving media file {filename}: {e}")
         return "File not found", 404
@@ -2026,15 +2190,26 @@ def ask_view():
                     
                     response = property_summary
                 else:
-                    # Get messages for analysis
-                    messages = messages_query.order_by(Message.timestamp.desc()).limit(50).all()
+                    # Messages most relevant to the question (any date unless it asks about a period)
+                    ranked = semantic_index.search(query, k=ASK_CONTEXT_MESSAGES,
+                                                   since=time_filter if is_time_query else None)
+                    if ranked is not None:
+                        by_id = {msg.id: msg for msg in Message.query.options(
+                            joinedload(Message.property),
+                            joinedload(Message.contact)
+                        ).filter(Message.id.in_([mid for mid, _ in ranked]), Message.message.isnot(None))}
+                        messages = [by_id[mid] for mid, _ in ranked if mid in by_id]
+                        if not is_time_query:
+                            time_desc = "any date"
+                    else:
+                        messages = messages_query.order_by(Message.timestamp.desc()).limit(50).all()
                     
                     if not messages:
                         response = f"No messages found for {time_desc}."
                     else:
                         # Prepare context for AI
                         message_context = f"Analyzing {len(messages)} messages from {time_desc}:\n\n"
-                        for msg in messages[:20]:  # Limit context size
+                        for msg in messages[:ASK_CONTEXT_MESSAGES]:  # Limit context size
                             contact_name = msg.contact.contact_name if msg.contact else "Unknown"
                             property_name = msg.property.name if msg.property else "No Property"
                             timestamp = msg.timestamp.strftime("%Y-%m-%d %H:%M")
@@ -2049,7 +2224,9 @@ Context:
 
 Provide a helpful, concise answer focusing on the specific question asked."""
                         
-                        completion = client.chat.completions.create(
+                        completion = llm_cache.chat_completion(
+                            client,
+                            tags=property_tags(),
                             model="gpt-3.5-turbo",
                             messages=[
                                 {"role": "system", "content": "You are a helpful assistant analyzing property management messages. Be concise and specific."},
@@ -2059,7 +2236,7 @@ Provide a helpful, concise answer focusing on the specific question asked."""
                             max_tokens=500
                         )
                         
-                        response = completion.choices[0].message.content.strip()
+                        response = completion.strip()
                 
                 return render_template('ask.html', response=response)
                 
@@ -2139,139 +2316,85 @@ def notifications_view():
                 db.session.commit()
                 return redirect(url_for('notifications_view'))
             
-            # Initialize counters
-            email_success_count = 0
-            sms_success_count = 0
-            email_errors = []
-            sms_errors = []
-            channels_attempted = []
-            
-            # Send emails if requested
-            if 'email' in channels and emails_to_send:
-                channels_attempted.append("Email")
-                app.logger.info(f"Attempting email to {len(emails_to_send)} addresses...")
-                
+            recipients = {"email": emails_to_send, "sms": phones_to_send}
+            
+            # Per-recipient values for $tenant_name, $property_name and $property_address in the subject and body
+            properties_by_id = {p.id: p for p in target_properties}
+            recipient_values = {}
+            for tenant in sorted(target_tenants, key=lambda t: t.name or ""):
+                prop = properties_by_id.get(tenant.property_id)
+                values = {
+                    "tenant_name": tenant.name or "",
+                    "property_name": prop.name if prop else "",
+                    "property_address": (prop.address or "") if prop else "",
+                }
+                for address in (tenant.email, tenant.phone):
+                    if address:
+                        recipient_values.setdefault(address, values)
+            channels_attempted = [c for c in ("email", "sms") if c in channels and recipients[c]]
+            contents = {}
+            
+            if "email" in channels_attempted:
                 email_subject = subject if subject else message_body[:50] + ("..." if len(message_body) > 50 else "")
+                properties_html = "<br>".join(f"{p.name} - {p.address}" for p in target_properties) or "All Properties"
                 
-                for email in emails_to_send:
-                    try:
-                        # Import wrap_email_html for better formatting
-                        from email_utils import wrap_email_html
-                        
-                        # Get property names for this email recipient
-                        tenant_properties = []
-                        for prop_id in property_ids:
-                            prop = Property.query.get(prop_id)
-                            if prop:
-                                tenant_properties.append(f"{prop.name} - {prop.address}")
-                        
-                        properties_html = "<br>".join(tenant_properties) if tenant_properties else "All Properties"
-                        
-                        # Format the email content
-                        html_content = wrap_email_html(f"""
-                            <h3 style="color: #212529; margin-bottom: 20px;">Property Management Notification</h3>
-                            
-                            <div style="background-color: #f8f9fa; padding: 15px; border-radius: 4px; margin-bottom: 20px;">
-                                <div class="info-row">
-                                    <span class="info-label">Properties:</span>
-                                    <span class="info-value">{properties_html}</span>
-                                </div>
-                                <div class="info-row" style="border-bottom: none;">
-                                    <span class="info-label">Date:</span>
-                                    <span class="info-value">{datetime.now().strftime('%B %d, %Y at %I:%M %p')}</span>
-                                </div>
-                            </div>
-                            
-                            <div class="message-box">
-                                <h4 style="margin: 0 0 10px 0; color: #495057; font-size: 14px;">Message:</h4>
-                                <p class="message-text">{message_body}</p>
-                            </div>
-                            
-                            <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e9ecef;">
-                                <p style="color: #6c757d; font-size: 14px; margin: 0;">
-                                    This notification was sent via the Sin City Rentals property management system.
-                                </p>
-                            </div>
-                        """)
-                        
-                        # Use your existing send_email function
-                        email_sent_successfully = send_email(
-                            to_emails=[email], 
-                            subject=email_subject, 
-                            html_content=html_content,
-                            attachments=[]  # Handle attachments later if needed
-                        )
-                        if email_sent_successfully:
-                            email_success_count += 1
-                        else:
-                            email_errors.append(f"{email}: Failed")
-                    except Exception as e:
-                        app.logger.error(f"Email Exception for {email}: {e}")
-                        email_errors.append(f"{email}: Exception")
+                # Rendered once for the whole fan-out; each recipient only gets its $placeholders filled in
+                html_content = wrap_email_html(f"""
+                    <h3 style="color: #212529; margin-bottom: 20px;">Property Management Notification</h3>
+                    
+                    <div style="background-color: #f8f9fa; padding: 15px; border-radius: 4px; margin-bottom: 20px;">
+                        <div class="info-row">
+                            <span class="info-label">Properties:</span>
+                            <span class="info-value">{properties_html}</span>
+                        </div>
+                        <div class="info-row" style="border-bottom: none;">
+                            <span class="info-label">Date:</span>
+                            <span class="info-value">{datetime.now().strftime('%B %d, %Y at %I:%M %p')}</span>
+                        </div>
+                    </div>
+                    
+                    <div class="message-box">
+                        <h4 style="margin: 0 0 10px 0; color: #495057; font-size: 14px;">Message:</h4>
+                        <p class="message-text">{message_body}</p>
+                    </div>
+                    
+                    <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e9ecef;">
+                        <p style="color: #6c757d; font-size: 14px; margin: 0;">
+                            This notification was sent via the Sin City Rentals property management system.
+                        </p>
+                    </div>
+                """)
+                contents["email"] = {
+                    "subject": Template(email_subject),
+                    "html": Template(html_content),
+                    "attachments": [],  # Handle attachments later if needed
+                    "values": recipient_values,
+                }
+            if "sms" in channels_attempted:
+                contents["sms"] = {"body": Template(message_body), "values": recipient_values}
             
-            # Send SMS if requested
-            if 'sms' in channels and phones_to_send:
-                channels_attempted.append("SMS")
-                app.logger.info(f"Attempting SMS to {len(phones_to_send)} numbers...")
-                
-                for phone in phones_to_send:
-                    try:
-                        # Use your existing send_openphone_sms function
-                        sms_sent = send_openphone_sms(
-                            recipient_phone=phone, 
-                            message_body=message_body
-                        )
-                        if sms_sent:
-                            sms_success_count += 1
-                        else:
-                            sms_errors.append(f"{phone}: Failed")
-                    except Exception as e:
-                        app.logger.error(f"SMS Exception for {phone}: {e}")
-                        sms_errors.append(f"{phone}: Exception")
-            
-            # Calculate status and summary
-            total_email_attempts = len(emails_to_send) if 'Email' in channels_attempted else 0
-            total_sms_attempts = len(phones_to_send) if 'SMS' in channels_attempted else 0
-            total_successes = email_success_count + sms_success_count
-            total_attempts = total_email_attempts + total_sms_attempts
-            
-            recipients_summary = f"Email: {email_success_count}/{total_email_attempts}. SMS: {sms_success_count}/{total_sms_attempts}."
-            
-            # Determine final status
-            if total_attempts == 0:
-                final_status = "No Recipients Found"
-            elif email_errors or sms_errors:
-                if total_successes > 0:
-                    final_status = "Partial Failure"
-                    flash(f"Notifications sent with some failures. ({recipients_summary})", "warning")
-                else:
-                    final_status = "Failed"
-                    flash("All notifications failed to send. Check logs.", "danger")
-            else:
-                final_status = "Sent"
-                flash(f"Notifications sent successfully! ({recipients_summary})", "success")
-            
-            # Log to history
-            error_details = []
-            if email_errors:
-                error_details.append(f"{len(email_errors)} Email failure(s)")
-            if sms_errors:
-                error_details.append(f"{len(sms_errors)} SMS failure(s)")
-            error_info_str = "; ".join(error_details) + " (See logs)" if error_details else None
-            
-            history_log = NotificationHistory(
-                subject=subject if 'Email' in channels_attempted else None,
+            # Record the notification, one pending delivery per recipient and their outbox messages in one
+            # transaction; the outbox dispatcher sends them in the background
+            history_log = notification_fanout.create(
+                subject=subject if "email" in channels_attempted else None,
                 body=message_body,
-                channels=", ".join(channels_attempted),
-                status=final_status,
+                channels=channels_attempted,
                 properties_targeted=properties_targeted_str,
-                recipients_summary=recipients_summary,
-                error_info=error_info_str
+                recipients=recipients,
+                contents=contents,
             )
-            db.session.add(history_log)
             db.session.commit()
+            queued = notification_fanout.submit(history_log.id)
+            
+            app.logger.info(f"Notification {history_log.id} queued for {queued} deliveries")
             
-            app.logger.info(f"Notification logged (ID: {history_log.id}, Status: {final_status})")
+            if request.accept_mimetypes.best == "application/json":
+                return jsonify({
+                    "job_id": history_log.id,
+                    "queued": queued,
+                    "status_url": url_for("notification_job_status", notification_id=history_log.id),
+                }), 202
+            flash(f"Sending notification #{history_log.id} to {queued} recipient(s)... progress is shown below.", "info")
             
         except Exception as ex:
             db.session.rollback()
@@ -2298,6 +2421,14 @@ def notifications_view():
                          history=history, 
                          error=error_message)
 
+@app.route("/notifications/<int:notification_id>/status")
+def notification_job_status(notification_id):
+    """Progress of a notification's fan-out (per-recipient results) for polling."""
+    progress = notification_fanout.progress(notification_id)
+    if progress is None:
+        return jsonify({"error": "Notification not found"}), 404
+    return jsonify(progress)
+
 # Property management routes
 @app.route('/property/<int:property_id>/custom-fields', methods=['GET', 'POST'])
 def property_custom_fields(property_id):
@@ -2664,7 +2795,8 @@ def download_attachment(property_id, attachment_id):
         return redirect(url_for('property_attachments', property_id=property_id))
     
     try:
-        return send_file(attachment.file_path, as_attachment=True, download_name=attachment.original_filename)
+        return media_sender.send(attachment.file_path, private=True, mimetype=attachment.file_type or None,
+                                 as_attachment=True, download_name=attachment.original_filename)
     except Exception as e:
         app.logger.error(f"Error downloading attachment: {e}")
         flash("Error downloading file.", "danger")
@@ -2811,6 +2943,31 @@ def ping_route():
         app.logger.error(f"DB Ping Failed: {e}")
         return f"Pong! DB Error: {e}", 503
 
+@app.route("/metrics")
+def metrics():
+    """Ingestion and background-worker counters as JSON."""
+    try:
+        return jsonify({
+            "webhook_ingest": webhook_spool.stats(),
+            "media_jobs": media_job_runner.stats(),
+            "contact_cache": contact_cache.stats(),
+            "sid_filter": recent_sids.stats(),
+            "message_stats": message_stats.stats(),
+            "gallery_overview": gallery_overview.stats(),
+            "search_index": search_index.stats(),
+            "semantic_index": semantic_index.stats(),
+            "llm_cache": llm_cache.stats(),
+            "notifications": notification_fanout.stats(),
+            "outbox": outbox.stats(),
+            "smtp_pool": smtp_pool_stats(),
+            "thumbnails": thumbnail_service.stats(),
+            "media_http": media_sender.stats(),
+        })
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Error collecting metrics: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route("/debug/volume")
 def debug_volume():
     """Check what's actually in the volume"""
@@ -2880,10 +3037,12 @@ def fix_database_paths():
                     if message:
                         # Create paths relative to static folder
                         paths = [f"uploads/{filename}" for filename in sorted(filenames)]
-                        message.local_media_paths = json.dumps(paths)
+                        replace_message_media(message, [(None, path) for path in paths], upload_folder)
                         fixed_count += 1
                 
                 db.session.commit()
+                message_stats.invalidate()
+                gallery_overview.invalidate()
                 flash(f"Fixed {fixed_count} messages with {len(files)} total files!", "success")
             else:
                 flash("Upload folder not found!", "danger")
@@ -3033,10 +3192,11 @@ def redownload_from_google():
         
         success_count = 0
         fail_count = 0
+        skipped_count = 0
         
         try:
             # Get messages with Google URLs but no local paths
-            messages = Message.query.filter(
+            messages = Message.query.options(selectinload(Message.media)).filter(
                 Message.media_urls.isnot(None),
                 Message.media_urls != '',
                 Message.media_urls != '[]'
@@ -3048,47 +3208,46 @@ def redownload_from_google():
                     if msg.media_urls.startswith('['):
                         urls = json.loads(msg.media_urls)
                     else:
-                        urls = [msg.media_urls]
+                        urls = [u.strip() for u in msg.media_urls.split(',')]
                     
+                    # Already stored locally - nothing to fetch
+                    existing_paths = [media.path for media in msg.media] or parse_media_paths(msg.local_media_paths)
+                    if stored_paths_exist(existing_paths, upload_folder):
+                        skipped_count += 1
+                        continue
+
                     local_paths = []
                     
-                    for i, url in enumerate(urls):
+                    for url in urls:
                         if not url or not url.startswith('http'):
                             continue
                         
-                        # Generate filename
-                        ext = 'jpg'
-                        if '.png' in url.lower():
-                            ext = 'png'
-                        elif '.gif' in url.lower():
-                            ext = 'gif'
-                        
-                        filename = f"msg{msg.id}_{i+1}_{msg.id:08x}.{ext}"
-                        filepath = os.path.join(upload_folder, filename)
-                        
-                        # Download if not exists
-                        if not os.path.exists(filepath):
-                            response = requests.get(url, timeout=30)
-                            if response.status_code == 200:
-                                with open(filepath, 'wb') as f:
-                                    f.write(response.content)
-                                success_count += 1
-                            else:
-                                fail_count += 1
-                                continue
+                        # Hashed while streaming; content already in the store isn't written again
+                        try:
+                            rel_path, _, _, created = download_to_store(url, upload_folder)
+                        except requests.exceptions.RequestException as dl_err:
+                            app.logger.warning(f"Download failed for msg {msg.id} ({url}): {dl_err}")
+                            fail_count += 1
+                            continue
+                        if created:
+                            success_count += 1
+                        else:
+                            skipped_count += 1
                         
-                        local_paths.append(f"uploads/{filename}")
+                        local_paths.append((url, rel_path))
                     
                     # Update database
                     if local_paths:
-                        msg.local_media_paths = json.dumps(local_paths)
+                        replace_message_media(msg, local_paths, upload_folder)
                         
                 except Exception as e:
                     app.logger.error(f"Error processing msg {msg.id}: {e}")
                     fail_count += 1
             
             db.session.commit()
-            flash(f"Downloaded {success_count} images, {fail_count} failed", "success")
+            message_stats.invalidate()
+            gallery_overview.invalidate()
+            flash(f"Downloaded {success_count} images, {skipped_count} already stored, {fail_count} failed", "success")
             
         except Exception as e:
             db.session.rollback()
@@ -3125,27 +3284,6 @@ def redownload_from_google():
 # Register webhook blueprint
 app.register_blueprint(webhook_bp)
 
-# Helper functions for notifications
-def send_email(to_emails, subject, html_content, attachments=None):
-    """Send email using SendGrid - placeholder implementation"""
-    app.logger.info(f"send_email called: {to_emails}, {subject}")
-    try:
-        # Add your SendGrid implementation here
-        return True  # Placeholder - replace with actual implementation
-    except Exception as e:
-        app.logger.error(f"Email send error: {e}")
-        return False
-
-def send_openphone_sms(recipient_phone, message_body):
-    """Send SMS using OpenPhone API - placeholder implementation"""
-    app.logger.info(f"send_openphone_sms called: {recipient_phone}, {message_body}")
-    try:
-        # Add your OpenPhone implementation here
-        return True  # Placeholder - replace with actual implementation
-    except Exception as e:
-        app.logger.error(f"SMS send error: {e}")
-        return False
-
 # Print URL Map after all routes are defined
 with app.app_context():
     app.logger.info("\n--- URL MAP ---")
@@ -3159,4 +3297,6 @@ if __name__ == "__main__":
     host = os.getenv("HOST", "0.0.0.0")
     port = int(os.getenv("PORT", 8080))
     debug_mode = os.getenv("FLASK_DEBUG", "false").lower() in ["true", "1", "t"]
+    # Only the serving process works through queued jobs (under gunicorn: gunicorn.conf.py)
+    start_background_workers()
     app.run(host=host, port=port, debug=debug_mode)
\ No newline at end of file
@@ -0,0 +1,214 @@
+# media_catalog.py
+# message_media rows: writing them for downloaded files, converting the legacy text columns, and shared query helpers.
+#
+# Like the other tables added since the initial migration, message_media is created by db.create_all() at
+# startup and filled from the legacy columns by ensure_converted(); there is no Alembic revision for it.
+
+import os
+import json
+import struct
+import hashlib
+import mimetypes
+import click
+
+from datetime import datetime
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import exists
+
+from extensions import db
+from models import Message, MessageMedia
+from media_store import media_abspath, cas_sha256
+
+CONVERT_BATCH_SIZE = 500
+
+
+def parse_media_paths(value):
+    """Legacy local_media_paths / media_urls text (JSON list, comma-separated or single path) -> list."""
+    if not value:
+        return []
+    value = value.strip()
+    if value.startswith('['):
+        try:
+            return [p.strip() for p in json.loads(value) if isinstance(p, str) and p.strip()]
+        except ValueError:
+            return []
+    return [p.strip().strip('"').strip("'") for p in value.split(',') if p.strip()]
+
+
+def has_media():
+    """Indexed EXISTS clause: the message has at least one message_media row."""
+    return exists().where(MessageMedia.message_id == Message.id)
+
+
+def image_dimensions(path):
+    """(width, height) read from a PNG, GIF or JPEG header, or (None, None)."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(26)
+            if head.startswith(b"\x89PNG\r\n\x1a\n") and len(head) >= 24:
+                return struct.unpack(">II", head[16:24])
+            if head[:6] in (b"GIF87a", b"GIF89a"):
+                return struct.unpack("<HH", head[6:10])
+            if head.startswith(b"\xff\xd8"):
+                f.seek(2)
+                while True:
+                    marker = f.read(2)
+                    if len(marker) < 2 or marker[0] != 0xFF:
+                        break
+                    if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                        continue # Markers without a length
+                    length = struct.unpack(">H", f.read(2))[0]
+                    if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                        height, width = struct.unpack(">xHH", f.read(5))
+                        return width, height
+                    f.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        pass
+    return None, None
+
+
+def describe_file(rel_path, upload_dir):
+    """mime/size/dimensions/sha256 for a stored file; fields stay None when the file is missing."""
+    info = {"mime": mimetypes.guess_type(rel_path)[0], "size_bytes": None, "width": None, "height": None, "sha256": None}
+    info["sha256"] = cas_sha256(rel_path) # Content-addressed files carry their hash in the name
+    if not upload_dir:
+        return info
+    full_path = media_abspath(rel_path, upload_dir)
+    try:
+        info["size_bytes"] = os.path.getsize(full_path)
+    except OSError:
+        return info
+    if info["sha256"] is None:
+        digest = hashlib.sha256()
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                digest.update(chunk)
+        info["sha256"] = digest.hexdigest()
+    if (info["mime"] or "").startswith("image/"):
+        info["width"], info["height"] = image_dimensions(full_path)
+    return info
+
+
+def build_media_rows(message_id, property_id, items, upload_dir=None):
+    """message_media row dicts for [(source_url or None, rel_path)]; upload_dir enables file inspection."""
+    now = datetime.utcnow()
+    rows = []
+    for position, (source_url, rel_path) in enumerate(items):
+        row = {
+            "message_id": message_id,
+            "property_id": property_id,
+            "position": position,
+            "path": rel_path,
+            "source_url": source_url,
+            "created_at": now,
+        }
+        row.update(describe_file(rel_path, upload_dir))
+        rows.append(row)
+    return rows
+
+
+def replace_message_media(message, items, upload_dir=None):
+    """Set a message's media to [(source_url, rel_path)] in the current session (the caller commits).
+
+    The legacy local_media_paths column is still written (comma-separated) for older readers.
+    """
+    db.session.query(MessageMedia).filter(MessageMedia.message_id == message.id).delete(synchronize_session=False)
+    rows = build_media_rows(message.id, message.property_id, items, upload_dir)
+    if rows:
+        db.session.execute(db.insert(MessageMedia), rows)
+    message.local_media_paths = ",".join(path for _, path in items) or None
+    db.session.expire(message, ["media"])
+    return rows
+
+
+def sync_media_property(message_id, property_id):
+    """Copy a message's new property assignment onto its media rows (the caller commits)."""
+    db.session.query(MessageMedia).filter(MessageMedia.message_id == message_id).update(
+        {"property_id": property_id}, synchronize_session=False
+    )
+
+
+def convert_legacy_media(batch_size=CONVERT_BATCH_SIZE, upload_dir=None, progress=None):
+    """Create message_media rows for messages that only have legacy local_media_paths text.
+
+    Safe to re-run: messages that already have media rows are skipped. Commits per batch.
+    With upload_dir the files are inspected for size, hash and dimensions.
+    """
+    converted, last_id = 0, 0
+    while True:
+        batch = (
+            db.session.query(Message.id, Message.property_id, Message.local_media_paths, Message.media_urls)
+            .filter(
+                Message.id > last_id,
+                Message.local_media_paths.isnot(None),
+                Message.local_media_paths != '',
+                ~has_media()
+            )
+            .order_by(Message.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+        rows = []
+        for message_id, property_id, local_paths, media_urls in batch:
+            paths = parse_media_paths(local_paths)
+            urls = parse_media_paths(media_urls)
+            # URLs only line up with paths when every download succeeded
+            sources = urls if len(urls) == len(paths) else [None] * len(paths)
+            rows.extend(build_media_rows(message_id, property_id, list(zip(sources, paths)), upload_dir))
+        if rows:
+            db.session.execute(db.insert(MessageMedia), rows)
+        db.session.commit()
+        last_id = batch[-1][0]
+        converted += len(batch)
+        if progress:
+            progress(converted)
+    return converted
+
+
+def fill_missing_file_info(upload_dir, batch_size=CONVERT_BATCH_SIZE, progress=None):
+    """Inspect files for media rows converted without size/hash information."""
+    updated, last_id = 0, 0
+    while True:
+        batch = MessageMedia.query.filter(MessageMedia.id > last_id, MessageMedia.size_bytes.is_(None)).order_by(
+            MessageMedia.id
+        ).limit(batch_size).all()
+        if not batch:
+            break
+        for media in batch:
+            info = describe_file(media.path, upload_dir)
+            if info["size_bytes"] is not None:
+                for key, value in info.items():
+                    setattr(media, key, value)
+                updated += 1
+        db.session.commit()
+        last_id = batch[-1].id
+        if progress:
+            progress(updated)
+    return updated
+
+
+def ensure_converted():
+    """Startup hook: convert legacy columns once, when message_media is still empty."""
+    if db.session.query(MessageMedia.id).first() is not None:
+        return 0
+    converted = convert_legacy_media()
+    if converted:
+        current_app.logger.info(f"✅ Converted legacy media columns for {converted} message(s) into message_media.")
+    return converted
+
+
+@click.command("migrate-message-media")
+@click.option("--inspect-files", is_flag=True, help="Also read files for size, SHA-256 and image dimensions.")
+@click.option("--batch-size", default=CONVERT_BATCH_SIZE, show_default=True)
+@with_appcontext
+def migrate_message_media_command(inspect_files, batch_size):
+    """Convert legacy local_media_paths text into message_media rows."""
+    upload_dir = current_app.config.get("UPLOAD_FOLDER") if inspect_files else None
+    converted = convert_legacy_media(batch_size, upload_dir, progress=lambda n: click.echo(f"converted {n} messages..."))
+    click.echo(f"converted {converted} message(s)")
+    if inspect_files:
+        updated = fill_missing_file_info(upload_dir, batch_size, progress=lambda n: click.echo(f"inspected {n} files..."))
+        click.echo(f"filled file details for {updated} media row(s)")
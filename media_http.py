@@ -0,0 +1,119 @@
+# media_http.py
+# Cache-friendly file responses for /media and attachment downloads.
+#
+# Every response carries a strong ETag (the SHA-256 for content-addressed files, mtime+size otherwise),
+# answers If-None-Match with 304 and serves Range requests with 206 so audio/video can seek.
+# Content-addressed files never change, so they are sent with a one-year `immutable` Cache-Control.
+#
+# MEDIA_OFFLOAD hands the byte streaming to the front-end server instead of a gunicorn worker:
+#   x-accel     nginx X-Accel-Redirect. Files under a registered root are redirected to
+#               MEDIA_X_ACCEL_PREFIX/<root name>/<path>, e.g. for the uploads root:
+#                   location /_protected/uploads/ { internal; alias /app/static/uploads/; }
+#   x-sendfile  Apache mod_xsendfile / lighttpd (Flask's USE_X_SENDFILE).
+
+import os
+import mimetypes
+
+from flask import current_app, request, send_file, Response
+
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class MediaSender:
+    """Sends stored files with validators, Range support and optional front-end offload."""
+
+    def __init__(self, app=None):
+        self.offload = ""
+        self.accel_prefix = "/_protected"
+        self.max_age = 3600
+        self.roots = {} # name -> absolute directory that X-Accel-Redirect may expose
+        self.sent = 0
+        self.not_modified = 0
+        self.partial = 0
+        self.offloaded = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.offload = os.getenv("MEDIA_OFFLOAD", "").strip().lower()
+        self.accel_prefix = "/" + os.getenv("MEDIA_X_ACCEL_PREFIX", "/_protected").strip("/")
+        self.max_age = int(os.getenv("MEDIA_CACHE_SECONDS", "3600"))
+        if self.offload == "x-sendfile":
+            app.config["USE_X_SENDFILE"] = True
+        elif self.offload and self.offload != "x-accel":
+            app.logger.warning(f"⚠️ Unknown MEDIA_OFFLOAD '{self.offload}'; serving files from the app.")
+            self.offload = ""
+        app.extensions["media_sender"] = self
+
+    def add_root(self, name, directory):
+        """Register a directory that X-Accel-Redirect can expose as <prefix>/<name>/."""
+        if directory:
+            self.roots[name] = os.path.realpath(directory)
+
+    def _accel_path(self, path):
+        real_path = os.path.realpath(path)
+        for name, root in self.roots.items():
+            if real_path.startswith(root + os.sep):
+                return f"{self.accel_prefix}/{name}/{os.path.relpath(real_path, root).replace(os.sep, '/')}"
+        return None
+
+    def send(self, path, etag=None, immutable=False, private=False, mimetype=None,
+             as_attachment=False, download_name=None):
+        """Response for the file at path; raises FileNotFoundError when it doesn't exist.
+
+        etag defaults to mtime+size. immutable adds a one-year `immutable` Cache-Control (only for
+        content that can never change under this URL); private files are revalidated on every use.
+        """
+        stat = os.stat(path)
+        etag = etag or f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        accel_path = self._accel_path(path) if self.offload == "x-accel" else None
+
+        if accel_path:
+            # nginx streams the file (and handles Range); only validators are answered here
+            mimetype = mimetype or mimetypes.guess_type(download_name or path)[0] or "application/octet-stream"
+            rv = Response(status=200, mimetype=mimetype)
+            rv.set_etag(etag)
+            rv.last_modified = stat.st_mtime
+            if as_attachment:
+                rv.headers.set("Content-Disposition", "attachment", filename=download_name or os.path.basename(path))
+            rv = rv.make_conditional(request)
+            if rv.status_code == 200:
+                rv.headers["X-Accel-Redirect"] = accel_path
+                self.offloaded += 1
+        else:
+            rv = send_file(path, mimetype=mimetype, as_attachment=as_attachment, download_name=download_name,
+                           etag=etag, conditional=True, max_age=None)
+            if current_app.config.get("USE_X_SENDFILE") and rv.status_code == 200:
+                self.offloaded += 1
+
+        rv.cache_control.no_cache = None # send_file marks responses without max_age as no-cache
+        if immutable:
+            rv.cache_control.public = True
+            rv.cache_control.max_age = IMMUTABLE_MAX_AGE
+            rv.cache_control.immutable = True
+        elif private:
+            rv.cache_control.private = True
+            rv.cache_control.no_cache = True
+        else:
+            rv.cache_control.public = True
+            rv.cache_control.max_age = self.max_age
+        rv.headers.setdefault("Accept-Ranges", "bytes")
+
+        if rv.status_code == 304:
+            self.not_modified += 1
+        elif rv.status_code == 206:
+            self.partial += 1
+        self.sent += 1
+        return rv
+
+    def stats(self):
+        return {
+            "offload": self.offload or None,
+            "responses": self.sent,
+            "not_modified": self.not_modified,
+            "partial": self.partial,
+            "offloaded": self.offloaded,
+        }
+
+
+media_sender = MediaSender()
@@ -0,0 +1,323 @@
+# media_jobs.py
+# Background pipeline for webhook messages: media download, message_media rows and the email notification
+# (queued on the outbox, which sends and retries it).
+# The webhook only records the Message plus a MediaJob row; the work itself runs here in a bounded thread pool.
+
+import os
+import time
+import mimetypes
+import threading
+import traceback
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from extensions import db
+from models import MediaJob
+from email_utils import wrap_email_html
+from media_store import download_to_store, media_abspath
+from media_catalog import replace_message_media
+from thumbnails import thumbnail_service
+from message_stats import message_stats
+from gallery_overview import gallery_overview
+from outbox import outbox
+
+DASHBOARD_CONVERSATION_URL = "https://openphone-monitor-production.up.railway.app/messages?view=conversation"
+
+
+class MediaDownloadError(Exception):
+    """A media URL could not be stored after its in-thread retries."""
+
+
+def download_media(message_id, urls, upload_dir, retries=2, skip_failed=True):
+    """Download each media URL for a message into the content-addressed store under upload_dir.
+
+    Returns (url, stored path) pairs, the path relative to the static root (e.g. "uploads/cas/ab/ab12...ef.jpg").
+    Content already on disk (the same photo re-sent in another thread) is not written again.
+    Each URL gets its own small retry loop; a URL that still fails is logged and skipped, or raises
+    MediaDownloadError when skip_failed is False (so a MediaJob can retry later with backoff).
+    """
+    saved_paths = []
+    for idx, url in enumerate(urls):
+        last_error = stored = None
+        for attempt in range(1, retries + 2):
+            try:
+                current_app.logger.debug(f"   Downloading media {idx+1}/{len(urls)} (attempt {attempt}) from: {url}")
+                rel_path, sha256, size, created = download_to_store(url, upload_dir)
+                if created:
+                    current_app.logger.info(f"   ✅ File saved successfully: {rel_path} ({size} bytes)")
+                else:
+                    current_app.logger.info(f"   ♻️ Media {idx+1} for message {message_id} already stored as {rel_path}")
+                saved_paths.append((url, rel_path))
+                stored = True
+                break
+            except requests.exceptions.RequestException as req_ex:
+                last_error = req_ex
+                current_app.logger.warning(f"   ⚠️ Network/HTTP error downloading media {idx+1} ({url}): {req_ex}")
+                if attempt <= retries:
+                    time.sleep(min(2 ** attempt, 10))
+            except IOError as io_err:
+                last_error = io_err
+                current_app.logger.error(f"   ⚠️ File system error saving media {idx+1} ({url}): {io_err}")
+                traceback.print_exc()
+                break
+        if not stored and not skip_failed:
+            raise MediaDownloadError(f"Media {idx+1}/{len(urls)} for message {message_id} ({url}): {last_error}")
+    return saved_paths
+
+
+def build_notification_html(msg, contact_name, phone, attachment_count):
+    """Build the 'New Message' notification email body for an incoming message."""
+    property_info = ""
+    if msg.property:
+        property_info = f"""
+                    <div class="info-row">
+                        <span class="info-label">Property:</span>
+                        <span class="info-value">{msg.property.name} - {msg.property.address}</span>
+                    </div>
+                    """
+
+    return wrap_email_html(f"""
+                    <h3 style="color: #212529; margin-bottom: 20px;">New Message from {contact_name}</h3>
+
+                    <div style="background-color: #f8f9fa; padding: 15px; border-radius: 4px; margin-bottom: 20px;">
+                        <div class="info-row">
+                            <span class="info-label">From:</span>
+                            <span class="info-value">{contact_name} ({phone})</span>
+                        </div>
+                        {property_info}
+                        <div class="info-row">
+                            <span class="info-label">Time:</span>
+                            <span class="info-value">{msg.timestamp.strftime('%B %d, %Y at %I:%M %p')}</span>
+                        </div>
+                        <div class="info-row" style="border-bottom: none;">
+                            <span class="info-label">Message ID:</span>
+                            <span class="info-value">#{msg.id}</span>
+                        </div>
+                    </div>
+
+                    <div class="message-box">
+                        <h4 style="margin: 0 0 10px 0; color: #495057; font-size: 14px;">Message Content:</h4>
+                        <p class="message-text">{msg.message or '(No text content)'}</p>
+                    </div>
+
+                    {f'<div class="attachment-notice"><strong>📎 {attachment_count} Attachment(s) included</strong></div>' if attachment_count else ''}
+
+                    <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e9ecef;">
+                        <p style="color: #6c757d; font-size: 14px; margin: 0;">
+                            <strong>Quick Actions:</strong><br>
+                            View this conversation in your dashboard:
+                            <a href="{DASHBOARD_CONVERSATION_URL}" style="color: #3a8bab;">
+                                Open Conversation View
+                            </a>
+                        </p>
+                    </div>
+                """)
+
+
+def enqueue_message_alert(msg, phone, upload_dir):
+    """Queue the email to SENDGRID_TO_EMAIL about an incoming message, with its downloaded media attached.
+
+    The outbox row is added to the current session; the caller commits (then wakes the outbox).
+    Returns the row, or None when no recipient is configured.
+    """
+    to_addr = os.getenv("SENDGRID_TO_EMAIL")
+    if not to_addr:
+        current_app.logger.warning("⚠️ No SENDGRID_TO_EMAIL configured; skipping email notification.")
+        return None
+
+    # Files are referenced by their stored path and read when the email is actually sent
+    attachments = []
+    for media in msg.media:
+        full_path = media_abspath(media.path, upload_dir)
+        if not os.path.exists(full_path):
+            current_app.logger.warning(f"   ⚠️ Media file not found on disk for email attachment: {full_path}")
+            continue
+        attachments.append({
+            "path": media.path,
+            "type": media.mime or mimetypes.guess_type(full_path)[0] or "application/octet-stream",
+            "filename": os.path.basename(full_path),
+        })
+
+    contact_name = msg.contact.contact_name if msg.contact and msg.contact.contact_name else phone
+    current_app.logger.info(f"   Queueing email to {to_addr}...")
+    return outbox.enqueue(
+        "email",
+        to_addr,
+        {
+            "subject": f"New message from {contact_name}",
+            "html": build_notification_html(msg, contact_name, phone, len(attachments)),
+            "attachments": attachments,
+        },
+        kind="message_alert",
+    )
+
+
+class MediaJobRunner:
+    """Runs MediaJob rows in a bounded thread pool with retries and exponential backoff.
+
+    Jobs are persisted in the media_jobs table, so anything pending when a worker dies is
+    picked up again by resume_pending() on the next start. A job is claimed with a conditional
+    UPDATE, so several gunicorn workers can share the table without running a job twice.
+    """
+
+    def __init__(self, app=None):
+        self._app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self.max_workers = 4
+        self.max_attempts = 5
+        self.retry_base_seconds = 30
+        self.stale_after = timedelta(minutes=10)
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.max_workers = int(os.getenv("MEDIA_WORKERS", "4"))
+        self.max_attempts = int(os.getenv("MEDIA_JOB_MAX_ATTEMPTS", "5"))
+        self.retry_base_seconds = float(os.getenv("MEDIA_JOB_RETRY_SECONDS", "30"))
+        app.extensions["media_jobs"] = self
+
+    def _get_executor(self):
+        # Created lazily so the pool's threads belong to the (possibly forked) serving process
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="media-job")
+            return self._executor
+
+    def enqueue(self, message_id, phone=None):
+        """Add a MediaJob for a message to the current session and flush it; the caller commits."""
+        job = MediaJob(message_id=message_id, phone=phone, status='pending', stage='download')
+        db.session.add(job)
+        db.session.flush()
+        return job
+
+    def submit(self, job_id, delay=0):
+        """Schedule a committed job on the pool, optionally after delay seconds."""
+        if delay > 0:
+            timer = threading.Timer(delay, self.submit, args=(job_id,))
+            timer.daemon = True
+            timer.start()
+            return
+        self._get_executor().submit(self._run, job_id)
+
+    def resume_pending(self):
+        """Re-schedule jobs left pending (or stuck running) by a previous process."""
+        now = datetime.utcnow()
+        MediaJob.query.filter(
+            MediaJob.status == 'running',
+            MediaJob.updated_at < now - self.stale_after
+        ).update({"status": "pending"}, synchronize_session=False)
+        db.session.commit()
+
+        pending = MediaJob.query.filter_by(status='pending').all()
+        for job in pending:
+            wait = (job.next_attempt_at - now).total_seconds() if job.next_attempt_at else 0
+            self.submit(job.id, delay=max(0, wait))
+        return len(pending)
+
+    def stats(self):
+        counts = dict(db.session.query(MediaJob.status, db.func.count(MediaJob.id)).group_by(MediaJob.status).all())
+        return {
+            "workers": self.max_workers,
+            "pending": counts.get('pending', 0),
+            "running": counts.get('running', 0),
+            "done": counts.get('done', 0),
+            "failed": counts.get('failed', 0),
+            "completed_this_process": self.completed,
+            "failed_this_process": self.failed,
+            "retries_this_process": self.retried,
+        }
+
+    def _claim(self, job_id):
+        claimed = MediaJob.query.filter_by(id=job_id, status='pending').update(
+            {"status": "running", "updated_at": datetime.utcnow()}, synchronize_session=False
+        )
+        db.session.commit()
+        return claimed == 1
+
+    def _run(self, job_id):
+        with self._app.app_context():
+            try:
+                if not self._claim(job_id):
+                    return
+                self.process(db.session.get(MediaJob, job_id))
+            except Exception:
+                current_app.logger.critical(f"❌ Unhandled error running media job {job_id}")
+                traceback.print_exc()
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+    def process(self, job):
+        """Run the remaining stages of a claimed job, recording a retry or failure on error."""
+        msg = job.message
+        upload_dir = current_app.config.get('UPLOAD_FOLDER')
+        try:
+            if job.stage == 'download':
+                saved_paths = []
+                urls = [u for u in (msg.media_urls or "").split(",") if u]
+                if urls and upload_dir:
+                    current_app.logger.info(f"⏳ Media job {job.id}: downloading {len(urls)} URL(s) for message {msg.id}...")
+                    # A URL that fails raises and the job retries with backoff; the last attempt keeps
+                    # whatever could be stored so the alert still goes out
+                    last_attempt = job.attempts + 1 >= self.max_attempts
+                    saved_paths = download_media(msg.id, urls, upload_dir, skip_failed=last_attempt)
+                    if len(saved_paths) < len(urls):
+                        current_app.logger.error(f"❌ Media job {job.id}: giving up on {len(urls) - len(saved_paths)} of {len(urls)} media URL(s) for message {msg.id}.")
+                    if saved_paths:
+                        had_media = bool(msg.media)
+                        replace_message_media(msg, saved_paths, upload_dir)
+                    else:
+                        current_app.logger.info(f"ℹ️ No media paths were successfully saved for message {msg.id}.")
+                elif urls:
+                    current_app.logger.error("❌ UPLOAD_FOLDER is not configured in the app! Skipping media download.")
+                job.stage = 'notify'
+                db.session.commit()
+                if saved_paths:
+                    gallery_overview.invalidate()
+                    if not had_media:
+                        message_stats.record_media_saved(msg.property_id is not None)
+                # Grid thumbnails render in the background so the first gallery view is already cheap
+                thumbnail_service.schedule(path for _, path in saved_paths)
+
+            alert = None
+            if job.stage == 'notify':
+                # Queued in the same commit that completes the job; the outbox retries the send itself
+                alert = enqueue_message_alert(msg, job.phone or msg.phone_number, upload_dir or "")
+                job.stage = 'done'
+
+            job.status = 'done'
+            job.completed_at = datetime.utcnow()
+            job.last_error = None
+            db.session.commit()
+            if alert is not None:
+                outbox.wake()
+            self.completed += 1
+            current_app.logger.info(f"✅ Media job {job.id} for message {msg.id} completed.")
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(MediaJob, job.id)
+            job.attempts += 1
+            job.last_error = str(e)
+            if job.attempts >= self.max_attempts:
+                job.status = 'failed'
+                self.failed += 1
+                current_app.logger.error(f"❌ Media job {job.id} failed permanently after {job.attempts} attempt(s): {e}")
+                db.session.commit()
+                return
+            delay = self.retry_base_seconds * (2 ** (job.attempts - 1))
+            job.status = 'pending'
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            db.session.commit()
+            self.retried += 1
+            current_app.logger.warning(f"⚠️ Media job {job.id} attempt {job.attempts} failed ({e}); retrying in {delay:.0f}s.")
+            self.submit(job.id, delay=delay)
+
+
+media_job_runner = MediaJobRunner()
@@ -0,0 +1,92 @@
+# media_store.py
+# Content-addressed storage for downloaded media: files live once under UPLOAD_FOLDER/cas/<ab>/<sha256><ext>.
+
+import os
+import uuid
+import hashlib
+import mimetypes
+import requests
+
+CAS_DIR = "cas"
+CHUNK_SIZE = 64 * 1024
+
+
+def extension_for(content_type, url=""):
+    """File extension for a response Content-Type, falling back to the URL's suffix."""
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type == "audio/mpeg":
+        return ".mp3"
+    extension = mimetypes.guess_extension(content_type) if content_type else None
+    if not extension:
+        extension = os.path.splitext(url.split("?")[0])[1].lower() or ".dat"
+    return ".jpg" if extension in (".jpe", ".jpeg") else extension
+
+
+def cas_relpath(upload_dir, sha256, extension):
+    """Stored path for a hash, relative to the static root (e.g. "uploads/cas/ab/ab12...ef.jpg")."""
+    return "/".join([os.path.basename(upload_dir.rstrip("/")), CAS_DIR, sha256[:2], sha256 + extension])
+
+
+def cas_sha256(rel_path):
+    """The SHA-256 a content-addressed path is named after, or None for other (legacy) paths."""
+    rel_path = rel_path.replace("\\", "/")
+    name = os.path.splitext(os.path.basename(rel_path))[0]
+    if f"{CAS_DIR}/{name[:2]}/" in rel_path and len(name) == 64:
+        return name
+    return None
+
+
+def media_abspath(rel_path, upload_dir):
+    """Filesystem path for a stored media path ("uploads/..." relative to the static root)."""
+    rel_path = rel_path.strip().lstrip("/")
+    prefix = os.path.basename(upload_dir.rstrip("/")) + "/"
+    if rel_path.startswith(prefix):
+        rel_path = rel_path[len(prefix):]
+    return os.path.join(upload_dir, rel_path)
+
+
+def store_chunks(chunks, upload_dir, extension):
+    """Hash chunks while writing them to a temp file, then keep one copy per SHA-256.
+
+    Returns (rel_path, sha256, size, created); created is False when the content was already stored,
+    in which case the temp file is simply discarded.
+    """
+    tmp_dir = os.path.join(upload_dir, CAS_DIR, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                if chunk:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        sha256 = digest.hexdigest()
+        final_path = os.path.join(upload_dir, CAS_DIR, sha256[:2], sha256 + extension)
+        if os.path.exists(final_path):
+            os.remove(tmp_path)
+            created = False
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(tmp_path, final_path) # Atomic, so readers never see a partial file
+            created = True
+        return cas_relpath(upload_dir, sha256, extension), sha256, size, created
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def download_to_store(url, upload_dir, timeout=30):
+    """Stream url into the content-addressed store. Raises requests exceptions on HTTP errors."""
+    with requests.get(url, stream=True, timeout=timeout) as resp:
+        resp.raise_for_status()
+        extension = extension_for(resp.headers.get("Content-Type"), url)
+        return store_chunks(resp.iter_content(chunk_size=CHUNK_SIZE), upload_dir, extension)
+
+
+def stored_paths_exist(rel_paths, upload_dir):
+    """True when every stored path is present on disk (used to skip re-downloads)."""
+    return bool(rel_paths) and all(os.path.exists(media_abspath(p, upload_dir)) for p in rel_paths)
@@ -0,0 +1,106 @@
+# message_stats.py
+# Cached message counters for the dashboard and /messages stat cards.
+#
+# Each counter is computed with one aggregate query on a miss and then kept current in this
+# worker by the code that changes messages (webhook, batch ingest, media jobs, property
+# assignment). Changes made by other gunicorn workers show up when the entry's TTL expires.
+
+import os
+import threading
+
+from datetime import timezone
+from sqlalchemy import case, func, select
+
+from extensions import db
+from models import Message, MessageMedia
+from cache_utils import LRUCache
+
+TOTALS_KEY = "totals"
+
+
+def _as_naive_utc(value):
+    """Messages store naive UTC timestamps; compare and key on the same representation."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class MessageStats:
+    """TTL-cached message counters, adjusted in place on writes and recomputed on expiry."""
+
+    def __init__(self, ttl=60):
+        self._cache = LRUCache(maxsize=64, ttl=ttl)
+        self._lock = threading.Lock() # Serializes delta updates against one another
+        self.recomputes = 0
+
+    def totals(self):
+        """{'total', 'with_media', 'unsorted_media'} - one query on a miss (message count as a scalar subquery)."""
+        cached = self._cache.get(TOTALS_KEY)
+        if cached is not None:
+            return dict(cached)
+        total, with_media, unsorted = db.session.query(
+            select(func.count(Message.id)).scalar_subquery(),
+            func.count(func.distinct(MessageMedia.message_id)),
+            func.count(func.distinct(case((MessageMedia.property_id.is_(None), MessageMedia.message_id)))),
+        ).select_from(MessageMedia).one()
+        value = {"total": total or 0, "with_media": with_media or 0, "unsorted_media": unsorted or 0}
+        self.recomputes += 1
+        self._cache.set(TOTALS_KEY, value)
+        return dict(value)
+
+    def count_since(self, *starts):
+        """Messages with timestamp >= each start, as a list in the same order (one query for all misses)."""
+        starts = [_as_naive_utc(s) for s in starts]
+        results = {s: self._cache.get(("since", s)) for s in starts}
+        missing = [s for s, v in results.items() if v is None]
+        if missing:
+            counts = db.session.query(*[
+                func.sum(case((Message.timestamp >= s, 1), else_=0)) for s in missing
+            ]).filter(Message.timestamp >= min(missing)).one()
+            self.recomputes += 1
+            for s, n in zip(missing, counts):
+                results[s] = n or 0
+                self._cache.set(("since", s), results[s])
+        return [results[s] for s in starts]
+
+    # --- Deltas (call after the commit that made the change) ---
+
+    def record_new_messages(self, timestamps):
+        """Messages were inserted (without media yet) at the given timestamps."""
+        timestamps = [_as_naive_utc(t) for t in timestamps if t is not None]
+        if not timestamps:
+            return
+        with self._lock:
+            self._cache.update(TOTALS_KEY, lambda v: dict(v, total=v["total"] + len(timestamps)))
+            for key in self._cache.keys():
+                if isinstance(key, tuple) and key[0] == "since":
+                    added = sum(1 for t in timestamps if t >= key[1])
+                    if added:
+                        self._cache.update(key, lambda n: n + added)
+
+    def record_media_saved(self, has_property):
+        """A message that had no local media now has some."""
+        with self._lock:
+            self._cache.update(TOTALS_KEY, lambda v: dict(
+                v,
+                with_media=v["with_media"] + 1,
+                unsorted_media=v["unsorted_media"] + (0 if has_property else 1),
+            ))
+
+    def record_property_change(self, has_media, old_property_id, new_property_id):
+        """A message moved between 'no property' and a property."""
+        if not has_media or bool(old_property_id) == bool(new_property_id):
+            return
+        delta = 1 if old_property_id else -1
+        with self._lock:
+            self._cache.update(TOTALS_KEY, lambda v: dict(v, unsorted_media=v["unsorted_media"] + delta))
+
+    def invalidate(self):
+        """Drop every counter (bulk changes where a delta isn't practical)."""
+        self._cache.clear()
+
+    def stats(self):
+        return dict(self._cache.stats(), recomputes=self.recomputes)
+
+
+message_stats = MessageStats(ttl=float(os.getenv("MESSAGE_STATS_TTL", "60")))
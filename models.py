@@ -76,6 +76,7 @@ class Property(db.Model):
     garage_code = db.Column(db.String(20))
     wifi_network = db.Column(db.String(100))
     wifi_password = db.Column(db.String(100))
+    thumbnail_path = db.Column(db.Text, nullable=True) # Gallery cover image chosen by the user ("uploads/...")
     
     # Metadata
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
@@ -94,7 +95,9 @@ class Property(db.Model):
     @property
     def media_count(self):
         """Count of messages with media for this property"""
-        return self.messages.filter(Message.local_media_paths.isnot(None)).count()
+        return db.session.query(db.func.count(db.distinct(MessageMedia.message_id))).filter(
+            MessageMedia.property_id == self.id
+        ).scalar()
     
     @property
     def recent_messages_count(self):
@@ -148,6 +151,63 @@ class NotificationHistory(db.Model):
         return f"<NotificationHistory {self.id} ({self.timestamp.strftime('%Y-%m-%d %H:%M')}) - Status: {self.status}>"
 
 
+# Defines the 'notification_deliveries' table (one row per recipient and channel of a notification)
+class NotificationDelivery(db.Model):
+    __tablename__ = "notification_deliveries"
+    id = db.Column(db.Integer, primary_key=True)
+    notification_id = db.Column(db.Integer, db.ForeignKey("notification_history.id", ondelete="CASCADE"), nullable=False, index=True)
+    channel = db.Column(db.String(10), nullable=False) # 'email' or 'sms'
+    recipient = db.Column(db.String(255), nullable=False) # Email address or phone number
+    status = db.Column(db.String(20), default='pending', nullable=False) # 'pending', 'sent', 'failed'
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    notification = db.relationship("NotificationHistory", backref=db.backref("deliveries", lazy="dynamic", passive_deletes=True))
+
+    def __repr__(self):
+        return f"<NotificationDelivery {self.id} {self.channel} to {self.recipient} ({self.status})>"
+
+
+# Defines the 'outbox' table (emails and SMS waiting to be sent by the outbox dispatcher)
+class OutboxMessage(db.Model):
+    __tablename__ = "outbox"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False) # 'notification', 'message_alert'
+    channel = db.Column(db.String(10), nullable=False) # 'email' or 'sms'
+    recipient = db.Column(db.String(255), nullable=False)
+    payload = db.Column(db.Text, nullable=False) # JSON: subject/html/substitutions/attachments for email, body for SMS
+    batch_key = db.Column(db.String(100), nullable=True) # Rows with the same key share their content and may be sent in one request
+    delivery_id = db.Column(db.Integer, db.ForeignKey("notification_deliveries.id", ondelete="CASCADE"), nullable=True, index=True)
+    status = db.Column(db.String(20), default='pending', nullable=False) # 'pending', 'sending', 'sent', 'failed'
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    claimed_by = db.Column(db.String(64), nullable=True)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index("ix_outbox_due", "status", "next_attempt_at"),
+        db.Index("ix_outbox_claimed_by", "claimed_by"),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage {self.id} {self.kind}/{self.channel} to {self.recipient} ({self.status}, attempts={self.attempts})>"
+
+
+# Defines the 'outbox_batches' table (content shared by all outbox rows of a batch_key, e.g. a notification's HTML)
+class OutboxBatch(db.Model):
+    __tablename__ = "outbox_batches"
+    batch_key = db.Column(db.String(100), primary_key=True)
+    payload = db.Column(db.Text, nullable=False) # JSON merged under each row's own payload when sending
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<OutboxBatch {self.batch_key}>"
+
+
 # Defines the 'messages' table (Keep as is, relationship to Contact already defined)
 class Message(db.Model):
     __tablename__ = "messages"
@@ -161,13 +221,68 @@ class Message(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     property_id = db.Column(db.Integer, db.ForeignKey("properties.id"), nullable=True, index=True)
     property = db.relationship("Property", backref=db.backref("messages", lazy="dynamic")) # Relationship to Property
-    local_media_paths = db.Column(db.Text, nullable=True)
+    local_media_paths = db.Column(db.Text, nullable=True) # Legacy comma-separated copy of message_media paths, still written for older readers
     # Contact relationship defined via Contact.messages backref
 
+    # (timestamp, id) ordering backs keyset pagination of the message list, optionally per property
+    __table_args__ = (
+        db.Index("ix_messages_timestamp_id", "timestamp", "id"),
+        db.Index("ix_messages_property_timestamp_id", "property_id", "timestamp", "id"),
+    )
+
     def __repr__(self):
         return f"<Message {self.id} from {self.contact_name or self.phone_number}>"
 
 
+# Defines the 'message_media' table (one row per stored media file; the source of truth for "has media")
+class MessageMedia(db.Model):
+    __tablename__ = "message_media"
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey("messages.id", ondelete="CASCADE"), nullable=False, index=True)
+    property_id = db.Column(db.Integer, db.ForeignKey("properties.id", ondelete="SET NULL"), nullable=True, index=True) # Copy of the message's property, kept in sync on assignment
+    position = db.Column(db.Integer, default=0, nullable=False) # Order within the message
+    path = db.Column(db.String(500), nullable=False) # Relative to the static root, e.g. "uploads/cas/ab/ab12...ef.jpg"
+    source_url = db.Column(db.Text, nullable=True)
+    mime = db.Column(db.String(100), nullable=True)
+    size_bytes = db.Column(db.Integer, nullable=True)
+    width = db.Column(db.Integer, nullable=True)
+    height = db.Column(db.Integer, nullable=True)
+    sha256 = db.Column(db.String(64), nullable=True, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    message = db.relationship("Message", backref=db.backref(
+        "media", order_by="MessageMedia.position", cascade="all, delete-orphan"
+    ))
+
+    __table_args__ = (
+        db.Index("ix_message_media_property_message", "property_id", "message_id"),
+    )
+
+    def __repr__(self):
+        return f"<MessageMedia {self.id} for message {self.message_id}: {self.path}>"
+
+
+# Defines the 'media_jobs' table (background media download + email notification per webhook message)
+class MediaJob(db.Model):
+    __tablename__ = "media_jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey("messages.id", ondelete="CASCADE"), nullable=False, index=True)
+    phone = db.Column(db.String(25), nullable=True) # Raw sender phone as received, used in the notification email
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True) # 'pending', 'running', 'done', 'failed'
+    stage = db.Column(db.String(20), default='download', nullable=False) # 'download', 'notify', 'done' - retries resume here
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    message = db.relationship("Message", backref=db.backref("media_jobs", lazy="dynamic", passive_deletes=True))
+
+    def __repr__(self):
+        return f"<MediaJob {self.id} for message {self.message_id} ({self.status}/{self.stage}, attempts={self.attempts})>"
+
+
 # ====== NEW MODELS FOR FLEXIBLE PROPERTY INFORMATION ======
 
 class PropertyCustomField(db.Model):
@@ -286,19 +401,53 @@ class Vendor(db.Model):
     jobs = db.relationship('VendorJob', backref='vendor', lazy='dynamic', cascade='all, delete-orphan')
     comments = db.relationship('VendorComment', backref='vendor', lazy='dynamic', cascade='all, delete-orphan', order_by='VendorComment.created_at.desc()')
     
+    # Set by load_job_stats() on list pages; the properties below query per vendor when it is absent
+    _job_stats = None
+
+    @classmethod
+    def load_job_stats(cls, vendors):
+        """Attach job statistics to each vendor using one grouped query over vendor_jobs."""
+        by_id = {vendor.id: vendor for vendor in vendors}
+        if not by_id:
+            return vendors
+        completed = VendorJob.status == 'completed'
+        rows = db.session.query(
+            VendorJob.vendor_id,
+            db.func.count(VendorJob.id),
+            db.func.count(db.case((completed, VendorJob.id))),
+            db.func.sum(db.case((completed, VendorJob.cost))),
+            db.func.avg(VendorJob.rating),
+        ).filter(VendorJob.vendor_id.in_(by_id)).group_by(VendorJob.vendor_id).all()
+        stats = {vendor_id: (total, done, revenue, avg) for vendor_id, total, done, revenue, avg in rows}
+        for vendor_id, vendor in by_id.items():
+            total, done, revenue, avg = stats.get(vendor_id, (0, 0, None, None))
+            vendor._job_stats = {
+                'total_jobs': total,
+                'completed_jobs': done,
+                'total_revenue': revenue or 0,
+                'average_job_rating': round(avg, 1) if avg else None,
+            }
+        return vendors
+
     @property
     def total_jobs(self):
         """Total number of jobs for this vendor"""
+        if self._job_stats is not None:
+            return self._job_stats['total_jobs']
         return self.jobs.count()
     
     @property
     def completed_jobs(self):
         """Number of completed jobs"""
+        if self._job_stats is not None:
+            return self._job_stats['completed_jobs']
         return self.jobs.filter_by(status='completed').count()
     
     @property
     def total_revenue(self):
         """Total revenue from this vendor"""
+        if self._job_stats is not None:
+            return self._job_stats['total_revenue']
         return db.session.query(db.func.sum(VendorJob.cost)).filter(
             VendorJob.vendor_id == self.id,
             VendorJob.status == 'completed'
@@ -307,6 +456,8 @@ class Vendor(db.Model):
     @property
     def average_job_rating(self):
         """Average rating across all jobs"""
+        if self._job_stats is not None:
+            return self._job_stats['average_job_rating']
         avg = db.session.query(db.func.avg(VendorJob.rating)).filter(
             VendorJob.vendor_id == self.id,
             VendorJob.rating.isnot(None)
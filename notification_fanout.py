@@ -0,0 +1,202 @@
+# notification_fanout.py
+# Tenant notifications (/notifications): every recipient is a NotificationDelivery row, and its message is
+# an outbox row written in the same transaction (see outbox.py), so the form returns as soon as both are
+# committed and nothing is lost if the process dies mid-send. The outbox dispatcher sends email as
+# SendGrid batches and SMS one by one, each paced to its provider's rate limit, retrying failures with
+# backoff; this module turns its results into per-recipient delivery status and the history summary.
+# The notification id doubles as the job id for progress polling.
+
+import threading
+
+from flask import current_app
+from markupsafe import escape
+
+from extensions import db
+from models import NotificationHistory, NotificationDelivery, OutboxMessage
+from outbox import outbox
+
+CHANNEL_LABELS = {"email": "Email", "sms": "SMS"}
+
+
+def shared_payload(channel, content):
+    """Outbox payload common to every recipient of a channel (stored once per batch), or None."""
+    if channel == "email":
+        return {"html": content["html"].template, "attachments": content.get("attachments") or []}
+    return None
+
+
+def render_payload(channel, content, values):
+    """Outbox payload for one recipient of a notification channel.
+
+    Email recipients get their subject and their values as (HTML-escaped) substitutions into the shared
+    HTML template; the SMS body is filled in here.
+    """
+    if channel == "email":
+        substitutions = {}
+        for key, value in values.items():
+            substitutions[f"${key}"] = substitutions[f"${{{key}}}"] = str(escape(value))
+        return {"subject": content["subject"].safe_substitute(values), "substitutions": substitutions}
+    return {"body": content["body"].safe_substitute(values)}
+
+
+class NotificationFanout:
+    """Queues a notification's deliveries on the outbox and records each recipient's result."""
+
+    def __init__(self, app=None):
+        self._app = None
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        outbox.add_listener(self._on_outbox_finished)
+        app.extensions["notification_fanout"] = self
+
+    def create(self, subject, body, channels, properties_targeted, recipients, contents):
+        """Add a notification, its pending deliveries and their outbox messages to the session; the caller commits.
+
+        recipients maps a channel name to an iterable of addresses; contents maps a channel to its
+        templates ({"subject", "html", "attachments"} for email, {"body"} for SMS) and "values", the
+        per-address placeholder values.
+        """
+        history = NotificationHistory(
+            subject=subject,
+            body=body,
+            channels=", ".join(CHANNEL_LABELS.get(c, c) for c in channels),
+            status="Sending",
+            properties_targeted=properties_targeted,
+        )
+        db.session.add(history)
+        db.session.flush()
+        deliveries = [
+            NotificationDelivery(notification_id=history.id, channel=channel, recipient=recipient)
+            for channel in channels for recipient in sorted(recipients.get(channel, ()))
+        ]
+        db.session.add_all(deliveries)
+        db.session.flush()
+        for channel in {d.channel for d in deliveries}:
+            shared = shared_payload(channel, contents[channel])
+            if shared is not None:
+                outbox.add_batch(f"notification:{history.id}:{channel}", shared)
+        for delivery in deliveries:
+            content = contents[delivery.channel]
+            outbox.enqueue(
+                delivery.channel,
+                delivery.recipient,
+                render_payload(delivery.channel, content, content["values"].get(delivery.recipient, {})),
+                kind="notification",
+                batch_key=f"notification:{history.id}:{delivery.channel}",
+                delivery_id=delivery.id,
+            )
+        return history
+
+    def submit(self, notification_id):
+        """Start sending a committed notification. Returns the number of pending deliveries."""
+        pending = NotificationDelivery.query.filter_by(notification_id=notification_id, status='pending').count()
+        if pending:
+            outbox.wake()
+        else:
+            self._finalize(notification_id)
+        return pending
+
+    def _on_outbox_finished(self, rows):
+        """Outbox listener: copy final results to the deliveries and close finished notifications."""
+        results = {row.delivery_id: row for row in rows if row.kind == "notification" and row.delivery_id}
+        if not results:
+            return
+        deliveries = NotificationDelivery.query.filter(NotificationDelivery.id.in_(list(results))).all()
+        for delivery in deliveries:
+            row = results[delivery.id]
+            delivery.status = row.status # 'sent' or 'failed'
+            delivery.error = row.last_error if row.status == 'failed' else None
+            delivery.sent_at = row.sent_at
+        db.session.commit()
+        with self._lock:
+            self.sent += sum(1 for d in deliveries if d.status == 'sent')
+            self.failed += sum(1 for d in deliveries if d.status == 'failed')
+
+        for notification_id in {d.notification_id for d in deliveries}:
+            still_pending = NotificationDelivery.query.filter_by(notification_id=notification_id, status='pending').count()
+            if not still_pending:
+                try:
+                    self._finalize(notification_id)
+                except Exception as e:
+                    db.session.rollback()
+                    current_app.logger.error(f"❌ Could not finalize notification {notification_id}: {e}")
+
+    def _counts(self, notification_id):
+        """{channel: {status: n}} for a notification's deliveries."""
+        counts = {}
+        rows = db.session.query(NotificationDelivery.channel, NotificationDelivery.status, db.func.count()).filter_by(
+            notification_id=notification_id
+        ).group_by(NotificationDelivery.channel, NotificationDelivery.status).all()
+        for channel, status, n in rows:
+            counts.setdefault(channel, {})[status] = n
+        return counts
+
+    def _finalize(self, notification_id):
+        """Write the final status and per-channel summary once no delivery is pending."""
+        history = db.session.get(NotificationHistory, notification_id)
+        counts = self._counts(notification_id)
+        sent = sum(c.get('sent', 0) for c in counts.values())
+        failed = sum(c.get('failed', 0) for c in counts.values())
+
+        history.recipients_summary = " ".join(
+            f"{CHANNEL_LABELS.get(ch, ch)}: {counts.get(ch, {}).get('sent', 0)}/{sum(counts.get(ch, {}).values())}."
+            for ch in ("email", "sms")
+        )
+        if sent + failed == 0:
+            history.status = "No Recipients Found"
+        elif failed:
+            history.status = "Partial Failure" if sent else "Failed"
+            history.error_info = "; ".join(
+                f"{c.get('failed')} {CHANNEL_LABELS.get(ch, ch)} failure(s)" for ch, c in counts.items() if c.get('failed')
+            ) + " (See logs)"
+        else:
+            history.status = "Sent"
+        db.session.commit()
+        current_app.logger.info(f"✅ Notification {notification_id} finished: {history.status} ({history.recipients_summary})")
+
+    def progress(self, notification_id):
+        """Job status for polling, or None for an unknown id."""
+        history = db.session.get(NotificationHistory, notification_id)
+        if history is None:
+            return None
+        counts = self._counts(notification_id)
+        deliveries = NotificationDelivery.query.filter_by(notification_id=notification_id).order_by(NotificationDelivery.id).all()
+        # Attempts so far and the latest error of deliveries the outbox is still retrying
+        outbox_rows = {
+            row.delivery_id: row for row in db.session.query(
+                OutboxMessage.delivery_id, OutboxMessage.attempts, OutboxMessage.last_error
+            ).filter(OutboxMessage.delivery_id.in_([d.id for d in deliveries])).all()
+        } if deliveries else {}
+        return {
+            "job_id": history.id,
+            "status": history.status,
+            "total": len(deliveries),
+            "pending": sum(c.get('pending', 0) for c in counts.values()),
+            "sent": sum(c.get('sent', 0) for c in counts.values()),
+            "failed": sum(c.get('failed', 0) for c in counts.values()),
+            "channels": counts,
+            "recipients_summary": history.recipients_summary,
+            "recipients": [
+                {"channel": d.channel, "recipient": d.recipient, "status": d.status,
+                 "error": d.error or (outbox_rows[d.id].last_error if d.id in outbox_rows else None),
+                 "attempts": outbox_rows[d.id].attempts if d.id in outbox_rows else None,
+                 "sent_at": d.sent_at.isoformat() if d.sent_at else None}
+                for d in deliveries
+            ],
+        }
+
+    def stats(self):
+        return {
+            "jobs_in_progress": NotificationHistory.query.filter_by(status="Sending").count(),
+            "sent_this_process": self.sent,
+            "failed_this_process": self.failed,
+        }
+
+
+notification_fanout = NotificationFanout()
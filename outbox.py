@@ -0,0 +1,387 @@
+# outbox.py
+# Transactional outbox for outgoing email and SMS (tenant notifications, new-message alerts).
+#
+# Callers add OutboxMessage rows in the same transaction as the record they belong to (NotificationHistory
+# and its deliveries, a finished MediaJob), so a send is never lost between the commit and the provider
+# call, and a crash mid-send leaves rows to pick up rather than an unknown set of recipients. A dispatcher
+# thread in every serving process (started by gunicorn.conf.py, never on import) claims due rows with a
+# conditional UPDATE (several gunicorn workers can share the table), sends them from per-channel thread
+# pools paced by a token bucket, and records the result.
+# Each channel is claimed on its own, at most what it can send in half of OUTBOX_CLAIM_TIMEOUT at its rate.
+# Rows with the same batch_key go out in one provider request when the channel takes batches (SendGrid
+# personalizations); content they all share (a notification's HTML) is stored once in outbox_batches. A failed row is retried with exponential backoff until OUTBOX_MAX_ATTEMPTS; rows
+# stuck in 'sending' longer than OUTBOX_CLAIM_TIMEOUT (the process died) are sent again, so delivery is
+# at-least-once.
+#
+# Listeners (see add_listener) are told about rows that reached a final status - the notification
+# fan-out uses this to update per-recipient deliveries.
+
+import os
+import json
+import time
+import uuid
+import threading
+import traceback
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+
+from extensions import db
+from models import OutboxMessage, OutboxBatch
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second on average, with bursts up to `capacity`. rate <= 0 means unlimited."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class _Channel:
+    def __init__(self, name, sender, rate, workers, batch_size=None):
+        self.name = name
+        self.sender = sender # sender([(recipient, payload), ...]) -> [None on success or an error string, ...]
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.executor = None
+        self.in_flight = 0 # Groups of the current claim not yet sent
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.requests = 0
+
+
+class Outbox:
+    """Durable queue of outgoing messages and the dispatcher that drains it."""
+
+    def __init__(self, app=None):
+        self._app = None
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._listeners = []
+        self._thread = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._recent = deque() # (finished_at, messages sent) for the rolling throughput window
+        self._last_recovery = 0
+        self.poll_seconds = 2
+        self.claim_limit = 1000
+        self.max_attempts = 6
+        self.retry_base_seconds = 30
+        self.retry_max_seconds = 3600
+        self.claim_timeout = 600
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.recovered = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.poll_seconds = float(os.getenv("OUTBOX_POLL_SECONDS", "2"))
+        self.claim_limit = int(os.getenv("OUTBOX_CLAIM_LIMIT", "1000"))
+        self.max_attempts = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+        self.retry_base_seconds = float(os.getenv("OUTBOX_RETRY_SECONDS", "30"))
+        self.retry_max_seconds = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "3600"))
+        self.claim_timeout = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "600"))
+        app.extensions["outbox"] = self
+
+    def register_channel(self, name, sender, rate, workers=4, batch_size=None):
+        """Add a delivery channel paced to rate provider requests per second.
+
+        sender receives a list of (recipient, payload) - one item, or up to batch_size items sharing a
+        batch_key - and returns an error (None on success) for each item, in order.
+        """
+        self._channels[name] = _Channel(name, sender, rate, workers, batch_size)
+
+    def add_listener(self, listener):
+        """listener(rows) is called with OutboxMessage rows that were sent or failed for good."""
+        self._listeners.append(listener)
+
+    def enqueue(self, channel, recipient, payload, kind, batch_key=None, delivery_id=None):
+        """Add a message to the current session; the caller commits (then calls wake())."""
+        row = OutboxMessage(
+            kind=kind,
+            channel=channel,
+            recipient=recipient,
+            payload=json.dumps(payload),
+            batch_key=batch_key,
+            delivery_id=delivery_id,
+            status='pending',
+            next_attempt_at=datetime.utcnow(),
+        )
+        db.session.add(row)
+        return row
+
+    def add_batch(self, batch_key, payload):
+        """Store content shared by every row of batch_key once (the caller commits with the rows).
+
+        When sending, each row's payload is this payload updated with the row's own.
+        """
+        batch = OutboxBatch(batch_key=batch_key, payload=json.dumps(payload))
+        db.session.add(batch)
+        return batch
+
+    def wake(self):
+        """Dispatch now instead of at the next poll (call after committing new rows)."""
+        self._wake.set()
+
+    def _get_executor(self, channel):
+        # Created lazily so the pool's threads belong to the (possibly forked) serving process
+        with self._lock:
+            if channel.executor is None:
+                channel.executor = ThreadPoolExecutor(max_workers=channel.workers, thread_name_prefix=f"outbox-{channel.name}")
+            return channel.executor
+
+    def _recover_stale(self):
+        """Return rows left in 'sending' by a process that died to the queue."""
+        now = datetime.utcnow()
+        recovered = OutboxMessage.query.filter(
+            OutboxMessage.status == 'sending',
+            OutboxMessage.claimed_at < now - timedelta(seconds=self.claim_timeout),
+        ).update({"status": "pending", "claimed_by": None, "claimed_at": None}, synchronize_session=False)
+        db.session.commit()
+        if recovered:
+            self.recovered += recovered
+            current_app.logger.warning(f"⚠️ Outbox: {recovered} message(s) stuck in 'sending' returned to the queue.")
+        return recovered
+
+    def _claim_limit(self, channel):
+        """Rows one claim may take for a channel: no more than it can send in half the claim timeout,
+        so rows still queued in this process are never mistaken for ones a dead process left behind."""
+        per_request = channel.batch_size or 1
+        if channel.bucket.rate <= 0:
+            return self.claim_limit
+        sendable = int(channel.bucket.rate * self.claim_timeout / 2) * per_request
+        return max(per_request, min(self.claim_limit, sendable))
+
+    def _claim(self, channel_name, limit):
+        now = datetime.utcnow()
+        claim_id = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        due = db.session.query(OutboxMessage.id).filter(
+            OutboxMessage.channel == channel_name,
+            OutboxMessage.status == 'pending',
+            OutboxMessage.next_attempt_at <= now,
+        ).order_by(OutboxMessage.id).limit(limit)
+        # status is checked again by the UPDATE itself, so a row another worker claimed first is skipped
+        OutboxMessage.query.filter(
+            OutboxMessage.id.in_(due.scalar_subquery()),
+            OutboxMessage.status == 'pending',
+        ).update({"status": "sending", "claimed_by": claim_id, "claimed_at": now}, synchronize_session=False)
+        db.session.commit()
+        return OutboxMessage.query.filter_by(claimed_by=claim_id, status='sending').order_by(OutboxMessage.id).all()
+
+    def dispatch_once(self):
+        """Claim due messages for every idle channel and hand them to its pool.
+
+        Returns the number of messages claimed (0 when idle). Channels are claimed independently and
+        sending doesn't block the dispatcher, so a long SMS run doesn't hold up email; a channel is
+        claimed for again once its previous claim has been sent.
+        """
+        if time.monotonic() - self._last_recovery > 60:
+            self._last_recovery = time.monotonic()
+            self._recover_stale()
+
+        claimed = 0
+        for channel in list(self._channels.values()):
+            with self._lock:
+                if channel.in_flight:
+                    continue
+            rows = self._claim(channel.name, self._claim_limit(channel))
+            if not rows:
+                continue
+            claimed += len(rows)
+            claim_id = rows[0].claimed_by
+
+            groups = {}
+            for row in rows:
+                groups.setdefault(row.batch_key or f"row:{row.id}", []).append(row.id)
+            step = channel.batch_size or 1
+            chunks = [ids[start:start + step] for ids in groups.values() for start in range(0, len(ids), step)]
+            with self._lock:
+                channel.in_flight = len(chunks)
+            for ids in chunks:
+                self._get_executor(channel).submit(self._run_group, channel, ids, claim_id)
+        return claimed
+
+    def _run_group(self, channel, ids, claim_id):
+        with self._app.app_context():
+            try:
+                self._send_group(channel, ids)
+            except Exception as e:
+                current_app.logger.critical(f"❌ Unhandled error sending outbox messages {ids}")
+                traceback.print_exc()
+                db.session.rollback()
+                self._fail_group(channel, ids, claim_id, e)
+            finally:
+                db.session.remove()
+                with self._lock:
+                    channel.in_flight -= 1
+                    if not channel.in_flight:
+                        self._wake.set() # Claim the channel's next rows right away
+
+    def _send_group(self, channel, ids):
+        rows = OutboxMessage.query.filter(OutboxMessage.id.in_(ids)).order_by(OutboxMessage.id).all()
+        batch_keys = {row.batch_key for row in rows if row.batch_key}
+        shared = {
+            batch.batch_key: json.loads(batch.payload)
+            for batch in OutboxBatch.query.filter(OutboxBatch.batch_key.in_(batch_keys)).all()
+        } if batch_keys else {}
+        items = [(row.recipient, {**shared.get(row.batch_key, {}), **json.loads(row.payload)}) for row in rows]
+        channel.bucket.acquire()
+        channel.requests += 1
+        try:
+            errors = list(channel.sender(items))
+            if len(errors) != len(rows):
+                raise RuntimeError(f"Sender returned {len(errors)} results for {len(rows)} messages")
+        except Exception as e:
+            errors = [str(e)[:500]] * len(rows)
+            current_app.logger.error(f"❌ Outbox {channel.name} send to {len(rows)} recipient(s) failed: {e}")
+        self._record(channel, rows, errors)
+
+    def _fail_group(self, channel, ids, claim_id, error):
+        """Retry a group with the usual backoff after an error outside the sender (loading rows, recording
+        results), instead of leaving it in 'sending' until stale recovery claim_timeout seconds later."""
+        try:
+            rows = OutboxMessage.query.filter(
+                OutboxMessage.id.in_(ids),
+                OutboxMessage.claimed_by == claim_id,
+                OutboxMessage.status == 'sending',
+            ).order_by(OutboxMessage.id).all()
+            self._record(channel, rows, [str(error)[:500]] * len(rows))
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"❌ Could not release outbox messages {ids}; stale recovery will requeue them: {e}")
+
+    def _record(self, channel, rows, errors):
+        """Store each row's result: sent, retry later with backoff, or failed for good."""
+        now = datetime.utcnow()
+        finished = []
+        sent = failed = retried = 0
+        for row, error in zip(rows, errors):
+            row.claimed_by = None
+            row.claimed_at = None
+            if not error:
+                row.status = 'sent'
+                row.sent_at = now
+                row.last_error = None
+                finished.append(row)
+                sent += 1
+                continue
+            row.attempts += 1
+            row.last_error = str(error)[:1000]
+            if row.attempts >= self.max_attempts:
+                row.status = 'failed'
+                finished.append(row)
+                failed += 1
+                current_app.logger.error(f"❌ Outbox message {row.id} to {row.recipient} failed permanently after {row.attempts} attempt(s): {error}")
+            else:
+                delay = min(self.retry_base_seconds * (2 ** (row.attempts - 1)), self.retry_max_seconds)
+                row.status = 'pending'
+                row.next_attempt_at = now + timedelta(seconds=delay)
+                retried += 1
+        db.session.commit()
+
+        with self._lock:
+            self.sent += sent
+            self.failed += failed
+            self.retries += retried
+            if sent:
+                self._recent.append((time.time(), sent))
+        channel.sent += sent
+        channel.failed += failed
+        channel.retries += retried
+        if retried:
+            current_app.logger.warning(f"⚠️ Outbox: {retried} message(s) failed and will be retried with backoff.")
+
+        for listener in self._listeners:
+            try:
+                listener(finished)
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error(f"❌ Outbox listener {getattr(listener, '__name__', listener)} failed: {e}")
+
+    def _dispatch_forever(self):
+        backoff = self.poll_seconds
+        while not self._stop.is_set():
+            with self._app.app_context():
+                try:
+                    handled = self.dispatch_once()
+                    backoff = self.poll_seconds
+                except Exception as e:
+                    handled = 0
+                    backoff = min(max(backoff * 2, 1), 60)
+                    current_app.logger.error(f"❌ Outbox dispatcher error (next try in {backoff:.0f}s): {e}")
+                    traceback.print_exc()
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            if not handled:
+                self._wake.wait(backoff)
+                self._wake.clear()
+
+    def start_dispatcher(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._dispatch_forever, name="outbox-dispatcher", daemon=True)
+            self._thread.start()
+
+    def stop_dispatcher(self, timeout=5):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            while self._recent and self._recent[0][0] < now - 60:
+                self._recent.popleft()
+            sent_1m = sum(n for _, n in self._recent)
+        counts = dict(db.session.query(OutboxMessage.status, db.func.count(OutboxMessage.id)).group_by(OutboxMessage.status).all())
+        oldest_pending = db.session.query(db.func.min(OutboxMessage.created_at)).filter(OutboxMessage.status == 'pending').scalar()
+        retrying = OutboxMessage.query.filter(OutboxMessage.status == 'pending', OutboxMessage.attempts > 0).count()
+        return {
+            "pending": counts.get('pending', 0),
+            "sending": counts.get('sending', 0),
+            "sent": counts.get('sent', 0),
+            "failed": counts.get('failed', 0),
+            "retrying": retrying,
+            "oldest_pending_age_sec": round((datetime.utcnow() - oldest_pending).total_seconds(), 1) if oldest_pending else None,
+            "sent_this_process": self.sent,
+            "failed_this_process": self.failed,
+            "retries_this_process": self.retries,
+            "recovered_this_process": self.recovered,
+            "messages_per_sec_1m": round(sent_1m / 60.0, 2),
+            "channels": {
+                name: {"rate_per_second": c.bucket.rate, "workers": c.workers, "batch_size": c.batch_size,
+                       "claim_limit": self._claim_limit(c), "in_flight": c.in_flight, "requests": c.requests, "sent": c.sent, "failed": c.failed, "retries": c.retries}
+                for name, c in self._channels.items()
+            },
+            "dispatcher_alive": bool(self._thread and self._thread.is_alive()),
+        }
+
+
+outbox = Outbox()
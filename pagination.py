@@ -0,0 +1,80 @@
+# pagination.py
+# Keyset (seek) pagination over (timestamp, id) - constant cost per page no matter how deep, and no COUNT(*).
+
+import base64
+from datetime import datetime
+
+from extensions import db
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded."""
+
+
+def encode_cursor(timestamp, row_id):
+    """Opaque URL-safe cursor for a (timestamp, id) position."""
+    raw = f"{timestamp.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises InvalidCursor for anything malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        timestamp, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}") from e
+
+
+class KeysetPage:
+    """One page of newest-first rows plus cursors for the neighbouring pages."""
+
+    def __init__(self, items, next_cursor, prev_cursor, per_page):
+        self.items = items
+        self.next_cursor = next_cursor # Older rows
+        self.prev_cursor = prev_cursor # Newer rows
+        self.per_page = per_page
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, timestamp_col, id_col, per_page=50, after=None, before=None):
+    """Page `query` newest-first by (timestamp, id).
+
+    `after` is a cursor from next_cursor (continue with older rows); `before` one from
+    prev_cursor (step back to newer rows). Each page is a single indexed range scan of
+    per_page + 1 rows - the extra row only tells whether another page exists. Rows with a
+    NULL timestamp have no position in the ordering and are left out.
+    """
+    query = query.filter(timestamp_col.isnot(None))
+    if before:
+        ts, row_id = decode_cursor(before)
+        rows = (
+            query.filter(db.tuple_(timestamp_col, id_col) > db.tuple_(ts, row_id))
+            .order_by(timestamp_col.asc(), id_col.asc())
+            .limit(per_page + 1)
+            .all()
+        )
+        has_more_newer = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_more_older = True # We came from an older page
+    else:
+        if after:
+            ts, row_id = decode_cursor(after)
+            query = query.filter(db.tuple_(timestamp_col, id_col) < db.tuple_(ts, row_id))
+        rows = query.order_by(timestamp_col.desc(), id_col.desc()).limit(per_page + 1).all()
+        has_more_older = len(rows) > per_page
+        items = rows[:per_page]
+        has_more_newer = after is not None
+
+    key = lambda row: encode_cursor(getattr(row, timestamp_col.key), getattr(row, id_col.key))
+    next_cursor = key(items[-1]) if items and has_more_older else None
+    prev_cursor = key(items[0]) if items and has_more_newer else None
+    return KeysetPage(items, next_cursor, prev_cursor, per_page)
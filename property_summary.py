@@ -0,0 +1,55 @@
+# property_summary.py
+# Dashboard counters for properties (tenants, messages, media, custom fields, contacts, attachments),
+# computed for any number of properties in one round trip: each counter is a GROUP BY property_id
+# subquery outer-joined to properties, so the cost doesn't grow with the number of properties shown.
+#
+# The per-instance Property properties (media_count, recent_messages_count, current_tenants) still
+# work for one-off use; pages that show counters should load them from here instead.
+
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func
+
+from extensions import db
+from models import (Message, MessageMedia, Property, PropertyAttachment, PropertyContact,
+                    PropertyCustomField, Tenant)
+
+RECENT_DAYS = 30
+
+
+def _counts(column, property_ids, *criteria, distinct=None):
+    """Subquery of (property_id, n) for rows of column's table matching criteria."""
+    counted = func.count(func.distinct(distinct)) if distinct is not None else func.count()
+    query = db.session.query(column.label("property_id"), counted.label("n")).filter(column.isnot(None), *criteria)
+    if property_ids is not None:
+        query = query.filter(column.in_(property_ids)) # Keep the aggregates to the requested properties
+    return query.group_by(column).subquery()
+
+
+def load_property_summaries(property_ids=None):
+    """{property_id: {counter: n}} for the given properties (all properties when None)."""
+    if property_ids is not None:
+        property_ids = list(property_ids)
+    recent_cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=RECENT_DAYS) # Messages store naive UTC
+    counters = {
+        "current_tenants": _counts(Tenant.property_id, property_ids, Tenant.status == "current"),
+        "recent_messages": _counts(Message.property_id, property_ids, Message.timestamp >= recent_cutoff),
+        "media_messages": _counts(MessageMedia.property_id, property_ids, distinct=MessageMedia.message_id),
+        "custom_fields": _counts(PropertyCustomField.property_id, property_ids),
+        "contacts": _counts(PropertyContact.property_id, property_ids),
+        "attachments": _counts(PropertyAttachment.property_id, property_ids),
+    }
+
+    query = db.session.query(
+        Property.id, *(func.coalesce(sub.c.n, 0).label(name) for name, sub in counters.items())
+    )
+    for sub in counters.values():
+        query = query.outerjoin(sub, sub.c.property_id == Property.id)
+    if property_ids is not None:
+        query = query.filter(Property.id.in_(property_ids))
+
+    return {row[0]: dict(zip(counters, row[1:])) for row in query.all()}
+
+
+def load_property_summary(property_id):
+    """Counters for one property (all zero when it has no related rows)."""
+    return load_property_summaries([property_id]).get(property_id)
@@ -0,0 +1,314 @@
+# search_index.py
+# Full-text search over messages: Postgres tsvector side table with a GIN index, SQLite FTS5 locally.
+#
+# Each message gets one search document (current contact name, message text, phone number).
+# Writers keep it in sync inside their own transaction: the webhook and batch ingest index new
+# messages, contact renames re-index that phone's messages. `flask reindex-search` builds or rebuilds it.
+#
+# Startup only creates the empty structures. Until a full build has been recorded in
+# message_search_built, searches use the ILIKE fallback (workers re-check every RECHECK_SECONDS), so a
+# first deploy doesn't have every gunicorn worker indexing the whole messages table while it boots.
+
+import re
+import time
+import click
+
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text, select, literal_column, bindparam
+
+from extensions import db
+
+REBUILD_BATCH_SIZE = 2000
+RECHECK_SECONDS = 60
+
+# Phone is indexed whole and by its last 7 and 4 digits so partial numbers match
+_PG_DOCUMENT = """
+    setweight(to_tsvector('simple', coalesce(c.contact_name, m.contact_name, '')), 'A') ||
+    setweight(to_tsvector('simple', coalesce(m.message, '')), 'B') ||
+    setweight(to_tsvector('simple', m.phone_number || ' ' || right(m.phone_number, 7) || ' ' || right(m.phone_number, 4)), 'C')
+"""
+_SQLITE_COLUMNS = """
+    coalesce(c.contact_name, m.contact_name, ''),
+    coalesce(m.message, ''),
+    m.phone_number || ' ' || substr(m.phone_number, -7) || ' ' || substr(m.phone_number, -4)
+"""
+
+_TOKEN_RE = re.compile(r'(-?)"([^"]*)"|(-?)([^\s"]+)')
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def parse_search_query(query_text):
+    """Split user input into terms: {'words': [...], 'phrase': bool, 'prefix': bool, 'negate': bool}.
+
+    "quoted text" is a phrase, word* a prefix, -word excludes. The last bare word is also
+    treated as a prefix so results follow search-as-you-type. Punctuation inside terms is
+    dropped, except that digit groups are joined (555-1234 searches for 5551234).
+    """
+    terms = []
+    for match in _TOKEN_RE.finditer(query_text or ""):
+        quoted_neg, quoted, bare_neg, bare = match.groups()
+        raw = quoted if quoted is not None else bare
+        words = [w.lower() for w in _WORD_RE.findall(raw)]
+        if not words:
+            continue
+        if quoted is None and all(w.isdigit() for w in words):
+            words = ["".join(words)] # Phone fragments: 555-1234 -> 5551234
+        terms.append({
+            "words": words,
+            "phrase": quoted is not None or len(words) > 1,
+            "prefix": quoted is None and raw.endswith("*"),
+            "negate": bool(quoted_neg or bare_neg),
+        })
+    if terms and not terms[-1]["phrase"] and not terms[-1]["negate"]:
+        terms[-1]["prefix"] = True
+    if not any(not t["negate"] for t in terms):
+        return [] # Exclusions alone can't be answered from an inverted index
+    return terms
+
+
+def to_tsquery(terms):
+    parts = []
+    for t in terms:
+        if t["phrase"]:
+            part = " <-> ".join(t["words"][:-1] + [t["words"][-1] + (":*" if t["prefix"] else "")])
+            part = f"({part})"
+        else:
+            part = t["words"][0] + (":*" if t["prefix"] else "")
+        parts.append(("!" if t["negate"] else "") + part)
+    return " & ".join(parts)
+
+
+def to_fts5_query(terms):
+    positive, negative = [], []
+    for t in terms:
+        part = '"' + " ".join(t["words"]) + '"' + ("*" if t["prefix"] else "")
+        (negative if t["negate"] else positive).append(part)
+    query = " AND ".join(positive)
+    for part in negative:
+        query += f" NOT {part}"
+    return query
+
+
+class SearchIndex:
+    """Dialect-specific message search index. backend is 'postgresql', 'sqlite' or None (ILIKE fallback)."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.complete = False # A full build is recorded; otherwise searches fall back to ILIKE
+        self._checked_at = 0
+        self.searches = 0
+        self.total_search_ms = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["search_index"] = self
+
+    # --- Schema ---
+
+    def ensure_schema(self):
+        """Create the (empty) index structures if missing. Filling them is `flask reindex-search`'s job."""
+        dialect = db.engine.dialect.name
+        inspector = db.inspect(db.engine)
+        existed = inspector.has_table("message_search" if dialect == "postgresql" else "message_search_fts")
+        marker_existed = inspector.has_table("message_search_built")
+        if dialect == "postgresql":
+            db.session.execute(text("""
+                CREATE TABLE IF NOT EXISTS message_search (
+                    message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+                    search_vector TSVECTOR NOT NULL
+                )
+            """))
+            db.session.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_message_search_vector ON message_search USING GIN (search_vector)"
+            ))
+        elif dialect == "sqlite":
+            try:
+                db.session.execute(text(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS message_search_fts USING fts5(contact_name, body, phone, tokenize='unicode61')"
+                ))
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.warning(f"⚠️ SQLite FTS5 unavailable, message search falls back to ILIKE: {e}")
+                return
+        else:
+            return
+        db.session.execute(text("CREATE TABLE IF NOT EXISTS message_search_built (built_at TIMESTAMP NOT NULL)"))
+        db.session.commit()
+        self.backend = dialect
+        if not marker_existed:
+            # Indexes created by earlier versions were built on creation; a new one over no messages is complete too
+            has_messages = db.session.execute(text("SELECT 1 FROM messages LIMIT 1")).first() is not None
+            if existed or not has_messages:
+                self._mark_built()
+        self.complete = self._is_built()
+        if not self.complete:
+            current_app.logger.warning("⚠️ Message search index is not built yet; run `flask reindex-search` (searching uses ILIKE until then).")
+
+    def _is_built(self):
+        self._checked_at = time.monotonic()
+        return db.session.execute(text("SELECT 1 FROM message_search_built LIMIT 1")).first() is not None
+
+    def _mark_built(self):
+        db.session.execute(text("DELETE FROM message_search_built"))
+        db.session.execute(text("INSERT INTO message_search_built (built_at) VALUES (CURRENT_TIMESTAMP)"))
+        db.session.commit()
+        self.complete = True
+
+    def ready(self):
+        """True when the index covers every message (re-checked periodically while it doesn't)."""
+        if self.backend and not self.complete and time.monotonic() - self._checked_at > RECHECK_SECONDS:
+            self.complete = self._is_built()
+        return bool(self.backend) and self.complete
+
+    # --- Sync (run inside the writer's transaction; the caller commits) ---
+
+    def _index_where(self, where_sql, params):
+        def stmt(sql):
+            # "ids" is an expanding IN list so one statement covers a whole batch
+            return text(sql).bindparams(bindparam("ids", expanding=True)) if "ids" in params else text(sql)
+
+        if self.backend == "postgresql":
+            db.session.execute(stmt(f"""
+                INSERT INTO message_search (message_id, search_vector)
+                SELECT m.id, {_PG_DOCUMENT}
+                FROM messages m LEFT JOIN contacts c ON c.phone_number = m.phone_number
+                WHERE {where_sql}
+                ON CONFLICT (message_id) DO UPDATE SET search_vector = EXCLUDED.search_vector
+            """), params)
+        elif self.backend == "sqlite":
+            db.session.execute(stmt(f"DELETE FROM message_search_fts WHERE rowid IN (SELECT m.id FROM messages m WHERE {where_sql})"), params)
+            db.session.execute(stmt(f"""
+                INSERT INTO message_search_fts (rowid, contact_name, body, phone)
+                SELECT m.id, {_SQLITE_COLUMNS}
+                FROM messages m LEFT JOIN contacts c ON c.phone_number = m.phone_number
+                WHERE {where_sql}
+            """), params)
+
+    def index_messages(self, message_ids):
+        """(Re)index the given messages."""
+        message_ids = list(message_ids)
+        if self.backend and message_ids:
+            db.session.flush()
+            self._index_where("m.id IN :ids", {"ids": message_ids})
+
+    def reindex_phone(self, phone_number):
+        """Re-index one contact's messages after a rename."""
+        if self.backend and phone_number:
+            db.session.flush()
+            self._index_where("m.phone_number = :phone", {"phone": phone_number})
+
+    def rebuild(self, batch_size=REBUILD_BATCH_SIZE, progress=None):
+        """Re-index every message in id batches, committing after each. Returns the number indexed."""
+        if not self.backend:
+            return 0
+        db.session.execute(text("DELETE FROM message_search_built")) # Searches fall back to ILIKE meanwhile
+        if self.backend == "sqlite":
+            db.session.execute(text("DELETE FROM message_search_fts"))
+        else:
+            db.session.execute(text("DELETE FROM message_search"))
+        db.session.commit()
+        self.complete = False
+        last_id, indexed = 0, 0
+        while True:
+            ids = db.session.execute(
+                text("SELECT id FROM messages WHERE id > :last ORDER BY id LIMIT :n"), {"last": last_id, "n": batch_size}
+            ).scalars().all()
+            if not ids:
+                break
+            self._index_where("m.id > :lo AND m.id <= :hi", {"lo": last_id, "hi": ids[-1]})
+            db.session.commit()
+            last_id = ids[-1]
+            indexed += len(ids)
+            if progress:
+                progress(indexed)
+        self._mark_built()
+        return indexed
+
+    # --- Querying ---
+
+    def match_ids(self, query_text):
+        """Select of message ids matching query_text, usable in Message.id.in_(...); None if not searchable."""
+        terms = parse_search_query(query_text)
+        if not terms or not self.ready():
+            return None
+        if self.backend == "postgresql":
+            return select(literal_column("message_id")).select_from(text("message_search")).where(
+                text("search_vector @@ to_tsquery('simple', :tsq)").bindparams(tsq=to_tsquery(terms))
+            )
+        return select(literal_column("rowid")).select_from(text("message_search_fts")).where(
+            text("message_search_fts MATCH :ftsq").bindparams(ftsq=to_fts5_query(terms))
+        )
+
+    def search(self, query_text, property_id=None, since=None, until=None, limit=50):
+        """Ranked search: [(message_id, score)] best first (higher score = better match).
+
+        Returns None when the query has no searchable terms or no index backend is available.
+        """
+        terms = parse_search_query(query_text)
+        if not terms or not self.ready():
+            return None
+        filters, params = [], {"limit": limit}
+        if property_id:
+            filters.append("m.property_id = :property_id")
+            params["property_id"] = property_id
+        if since:
+            filters.append("m.timestamp >= :since")
+            params["since"] = since
+        if until:
+            filters.append("m.timestamp < :until")
+            params["until"] = until
+        extra = "".join(f" AND {f}" for f in filters)
+
+        started = time.perf_counter()
+        if self.backend == "postgresql":
+            params["tsq"] = to_tsquery(terms)
+            rows = db.session.execute(text(f"""
+                SELECT s.message_id, ts_rank(s.search_vector, q.query) AS score
+                FROM message_search s
+                JOIN messages m ON m.id = s.message_id,
+                     to_tsquery('simple', :tsq) AS q(query)
+                WHERE s.search_vector @@ q.query{extra}
+                ORDER BY score DESC, m.timestamp DESC
+                LIMIT :limit
+            """), params).all()
+        else:
+            params["ftsq"] = to_fts5_query(terms)
+            # bm25 is lower-is-better; weights favour contact name, then body, then phone
+            rows = db.session.execute(text(f"""
+                SELECT f.rowid, -bm25(message_search_fts, 4.0, 2.0, 1.0) AS score
+                FROM message_search_fts f
+                JOIN messages m ON m.id = f.rowid
+                WHERE message_search_fts MATCH :ftsq{extra}
+                ORDER BY score DESC, m.timestamp DESC
+                LIMIT :limit
+            """), params).all()
+        self.searches += 1
+        self.total_search_ms += (time.perf_counter() - started) * 1000
+        return [(row[0], float(row[1])) for row in rows]
+
+    def stats(self):
+        return {
+            "backend": self.backend or "ilike",
+            "complete": self.complete,
+            "searches": self.searches,
+            "avg_search_ms": round(self.total_search_ms / self.searches, 3) if self.searches else None,
+        }
+
+
+search_index = SearchIndex()
+
+
+@click.command("reindex-search")
+@click.option("--batch-size", default=REBUILD_BATCH_SIZE, show_default=True)
+@with_appcontext
+def reindex_search_command(batch_size):
+    """Rebuild the message full-text search index."""
+    if not search_index.backend:
+        search_index.ensure_schema()
+    if not search_index.backend:
+        raise click.ClickException("No full-text backend available for this database.")
+    started = time.time()
+    total = search_index.rebuild(batch_size, progress=lambda n: click.echo(f"indexed {n} messages..."))
+    click.echo(f"done: {total} messages indexed in {time.time() - started:.1f}s")
@@ -0,0 +1,428 @@
+# semantic_index.py
+# Vector index over message text for the AI search (/messages/ai-search) and /ask: finds the messages
+# closest in meaning to a question, however old, so only those are sent to the LLM.
+#
+# Vectors are stored in SEMANTIC_INDEX_FOLDER (default: "semantic_index" next to UPLOAD_FOLDER) as
+# vectors.npy (float32, one L2-normalised row per message, memory-mapped on load), ids.npy (message ids)
+# and meta.json. The index follows the messages table by id: sync() embeds messages newer than the last
+# indexed id; the webhook and batch ingest start a background sync after they commit, and so does each
+# query (which answers from what is already indexed). Files are replaced atomically, and syncs take an flock on
+# sync.lock so only one process embeds at a time; the others wait, reload its files and embed only what is left.
+# Messages that arrived while the app was down are caught up by gunicorn's post_worker_init (see gunicorn.conf.py).
+#
+# SEMANTIC_EMBEDDER selects the embedder: "hashing" (default; deterministic, local, no network) or
+# "openai" (OPENAI_EMBEDDING_MODEL, default text-embedding-3-small). Changing it starts a fresh index;
+# `flask rebuild-semantic-index` re-embeds everything up front. Hits scoring at or below the embedder's
+# min_score (SEMANTIC_MIN_SCORE overrides it) are unrelated and dropped, so a query with no relevant
+# messages returns []. numpy is optional - without it search()
+# returns None and the AI routes fall back to recent messages.
+
+import os
+import re
+import json
+import time
+import uuid
+import hashlib
+import threading
+import click
+
+from contextlib import contextmanager
+from flask import current_app
+from flask.cli import with_appcontext
+
+from extensions import db
+from models import Message
+
+try:
+    import numpy as np
+except ImportError: # pragma: no cover - optional dependency
+    np = None
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover - not on Windows; syncs are then only serialized within a process
+    fcntl = None
+
+SYNC_BATCH_SIZE = 256
+MAX_SEGMENTS = 16
+RECHECK_IDS = 200 # Postgres can commit a lower id after a higher one was synced; each sync looks back this far
+MAX_TEXT_CHARS = 2000
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SUFFIXES = ("ing", "ed", "es", "s")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by do for from has have i in is it me my of on or our so that the their "
+    "there this to was we were what when where which who will with you your".split()
+)
+
+
+def _stem(word):
+    """Crude suffix stripping so "leaks", "leaking" and "leaked" share a feature."""
+    for suffix in _SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+class HashingEmbedder:
+    """Feature-hashing bag of words: words, word pairs and in-word trigrams, hashed into dim signed buckets.
+
+    Deterministic and free of network calls, so indexes built offline and in tests are reproducible.
+    Stems and trigrams let "leaking" match "leaks"; word pairs favour phrases like "garbage disposal".
+    """
+
+    min_score = 0.15 # Texts sharing no words still score up to ~0.13 through trigram overlap and collisions
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = [w for w in _WORD_RE.findall(text.lower()) if w not in _STOPWORDS]
+        for word in words:
+            yield _stem(word), 1.0
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield "3:" + padded[i:i + 3], 0.4
+        for first, second in zip(words, words[1:]):
+            yield f"2:{_stem(first)} {_stem(second)}", 0.5
+
+    def embed(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text or ""):
+                h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                out[row, h % self.dim] += weight if h >> 63 else -weight # The sign bit spreads collisions
+        return _normalize(out)
+
+
+class OpenAIEmbedder:
+    """OpenAI embeddings API; one request per batch of texts."""
+
+    min_score = 0.25 # Unrelated texts typically score 0.05-0.2 with the text-embedding-3 models
+
+    def __init__(self, model="text-embedding-3-small", api_key=None):
+        self.model = model
+        self.name = f"openai:{model}"
+        self._api_key = api_key
+        self._client = None
+
+    def embed(self, texts):
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=self._api_key or os.getenv("OPENAI_API_KEY"))
+        response = self._client.embeddings.create(model=self.model, input=[t or " " for t in texts])
+        return _normalize(np.array([item.embedding for item in response.data], dtype=np.float32))
+
+
+def embedder_from_env():
+    kind = os.getenv("SEMANTIC_EMBEDDER", "hashing").strip().lower()
+    if kind == "openai":
+        return OpenAIEmbedder(model=os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small"))
+    if kind != "hashing":
+        current_app.logger.warning(f"⚠️ Unknown SEMANTIC_EMBEDDER '{kind}'; using the hashing embedder.")
+    return HashingEmbedder(dim=int(os.getenv("SEMANTIC_HASH_DIM", "1024")))
+
+
+class SemanticIndex:
+    """Top-k cosine similarity over message embeddings, kept in sync with the messages table by id."""
+
+    def __init__(self, app=None):
+        self._app = None
+        self._lock = threading.Lock() # Serializes load/sync/save within this process
+        self._sync_thread = None
+        self._sync_again = False
+        self.embedder = None
+        self.min_score = None # SEMANTIC_MIN_SCORE; None uses the embedder's own
+        self.folder = None
+        self._segments = None # [(ids, vectors)] - vectors are memory-mapped once loaded from disk
+        self._segment_files = []
+        self._last_id = 0 # Highest message id already considered (messages without text are skipped)
+        self._loaded_mtime = None
+        self.embedded = 0
+        self.searches = 0
+        self.total_search_ms = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        upload_dir = app.config.get("UPLOAD_FOLDER")
+        default_folder = os.path.join(os.path.dirname(upload_dir.rstrip("/")), "semantic_index") if upload_dir else None
+        self.folder = os.getenv("SEMANTIC_INDEX_FOLDER", default_folder)
+        min_score = os.getenv("SEMANTIC_MIN_SCORE")
+        self.min_score = float(min_score) if min_score else None
+        if np is not None:
+            with app.app_context():
+                self.embedder = embedder_from_env()
+        app.extensions["semantic_index"] = self
+
+    def use_embedder(self, embedder):
+        """Swap the embedder (anything with .name and .embed(texts) -> L2-normalised float32 rows)."""
+        with self._lock:
+            self.embedder = embedder
+            self._reset()
+
+    @property
+    def available(self):
+        return np is not None and self.embedder is not None and bool(self.folder)
+
+    @property
+    def size(self):
+        return sum(len(ids) for ids, _ in self._segments or ())
+
+    # --- Storage ---
+    # Each sync appends a segment (vectors-<token>.npy + ids-<token>.npy) and republishes meta.json, so a
+    # webhook costs a write of its own rows only. Once there are MAX_SEGMENTS they are merged into one.
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _meta_mtime(self):
+        try:
+            return os.stat(self._path("meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reset(self):
+        """Start empty; the files on disk are ignored until this process replaces them."""
+        self._segments = []
+        self._segment_files = []
+        self._last_id = 0
+        self._loaded_mtime = self._meta_mtime() if self.folder else None
+
+    def _load_if_changed(self):
+        """(Re)load the files when another process (or a rebuild) replaced them."""
+        mtime = self._meta_mtime()
+        if self._segments is None:
+            self._reset()
+            self._loaded_mtime = None
+        if mtime is None or mtime == self._loaded_mtime:
+            return
+        with open(self._path("meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("embedder") != self.embedder.name:
+            current_app.logger.warning(
+                f"⚠️ Semantic index was built with {meta.get('embedder')}, not {self.embedder.name}; re-embedding messages."
+            )
+            self._reset()
+            return
+        try:
+            segments = [(np.load(self._path(f["ids"])), np.load(self._path(f["vectors"]), mmap_mode="r"))
+                        for f in meta["segments"]]
+        except FileNotFoundError:
+            return # Caught between two writers; the next call sees the completed set
+        self._segments, self._segment_files = segments, meta["segments"]
+        self._last_id = meta["last_id"]
+        self._loaded_mtime = mtime
+
+    def _write_segment(self, ids, vectors):
+        token = uuid.uuid4().hex[:12]
+        files = {"ids": f"ids-{token}.npy", "vectors": f"vectors-{token}.npy"}
+        np.save(self._path(files["vectors"]), vectors)
+        np.save(self._path(files["ids"]), ids)
+        return files
+
+    def _save(self, ids=None, vectors=None):
+        """Append a segment (if given) and publish the file list and watermark atomically."""
+        os.makedirs(self.folder, exist_ok=True)
+        if ids is not None:
+            if len(self._segments) + 1 > MAX_SEGMENTS:
+                ids = np.concatenate([seg_ids for seg_ids, _ in self._segments] + [ids])
+                vectors = np.vstack([np.asarray(seg_vectors) for _, seg_vectors in self._segments] + [vectors])
+                self._segments, self._segment_files = [], []
+            self._segment_files = self._segment_files + [self._write_segment(ids, vectors)]
+            self._segments = self._segments + [(ids, vectors)]
+
+        tmp_meta = self._path(f"meta.json.{uuid.uuid4().hex[:12]}.tmp")
+        with open(tmp_meta, "w") as f:
+            json.dump({"embedder": self.embedder.name, "last_id": self._last_id, "count": self.size,
+                       "segments": self._segment_files}, f)
+        os.replace(tmp_meta, self._path("meta.json"))
+        self._loaded_mtime = self._meta_mtime()
+
+        # Drop unreferenced segments; recent ones may belong to another worker that is about to publish
+        referenced = {name for files in self._segment_files for name in files.values()}
+        stale_before = time.time() - 60
+        for name in os.listdir(self.folder):
+            if name.endswith(".npy") and name not in referenced and os.path.getmtime(self._path(name)) < stale_before:
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+
+    # --- Sync ---
+
+    @contextmanager
+    def _sync_file_lock(self):
+        """Serialize syncs across processes (gunicorn workers, CLI rebuilds)."""
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        with open(self._path("sync.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _embed_rows(self, rows):
+        texts = [(mid, body.strip()[:MAX_TEXT_CHARS]) for mid, body in rows if body and body.strip()]
+        if not texts:
+            return [], None
+        return [mid for mid, _ in texts], self.embedder.embed([body for _, body in texts])
+
+    def sync(self, limit=None, batch_size=SYNC_BATCH_SIZE):
+        """Embed messages added since the last sync (at most limit of them). Returns the number embedded."""
+        if not self.available:
+            return 0
+        with self._lock, self._sync_file_lock():
+            self._load_if_changed() # Picks up whatever the process that held the file lock just published
+            added_ids, added_vectors, considered = [], [], 0
+            if self._last_id:
+                # Ids committed out of order (or lost to a concurrent writer) just below the watermark
+                floor = self._last_id - RECHECK_IDS
+                indexed = {int(mid) for seg_ids, _ in self._segments for mid in seg_ids[seg_ids > floor]}
+                rows = db.session.query(Message.id, Message.message).filter(
+                    Message.id > floor, Message.id <= self._last_id
+                ).all()
+                ids, vectors = self._embed_rows([row for row in rows if row[0] not in indexed])
+                if ids:
+                    added_ids.extend(ids)
+                    added_vectors.append(vectors)
+            while limit is None or considered < limit:
+                n = batch_size if limit is None else min(batch_size, limit - considered)
+                rows = db.session.query(Message.id, Message.message).filter(
+                    Message.id > self._last_id
+                ).order_by(Message.id).limit(n).all()
+                if not rows:
+                    break
+                ids, vectors = self._embed_rows(rows)
+                if ids:
+                    added_ids.extend(ids)
+                    added_vectors.append(vectors)
+                self._last_id = rows[-1][0]
+                considered += len(rows)
+            if not considered and not added_ids:
+                return 0
+            if added_ids:
+                self._save(np.array(added_ids, dtype=np.int64), np.vstack(added_vectors))
+                self.embedded += len(added_ids)
+            else:
+                self._save() # Only messages without text; record the new watermark
+            return len(added_ids)
+
+    def schedule_sync(self):
+        """Embed new messages on a background thread (after a webhook or batch ingest commits)."""
+        if not self.available or self._app is None:
+            return
+        self._sync_again = True
+        if self._sync_thread is not None and self._sync_thread.is_alive():
+            return # The running thread loops once more and picks these messages up
+        self._sync_thread = threading.Thread(target=self._run_sync, name="semantic-sync", daemon=True)
+        self._sync_thread.start()
+
+    def _run_sync(self):
+        with self._app.app_context():
+            try:
+                while self._sync_again:
+                    self._sync_again = False
+                    self.sync()
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.warning(f"⚠️ Semantic index sync failed: {e}")
+            finally:
+                db.session.remove()
+
+    def rebuild(self, batch_size=SYNC_BATCH_SIZE):
+        """Drop the index and embed every message again. Returns the number embedded."""
+        if not self.available:
+            return 0
+        with self._lock:
+            self._reset()
+        return self.sync(batch_size=batch_size)
+
+    # --- Querying ---
+
+    def search(self, query_text, k=20, property_id=None, since=None, until=None):
+        """[(message_id, score)] for the k messages most similar to query_text, best first.
+
+        property_id/since/until are applied against the messages table, so property assignments made after
+        a message was embedded are respected. Messages scoring at or below the minimum score are left out,
+        so the result can be []. Returns None when the index is unavailable or still empty.
+        """
+        if not self.available or not (query_text or "").strip():
+            return None
+        # Search what is indexed (including other workers' syncs); embedding new messages is left to the
+        # background sync, so a query never waits on embedding calls
+        started = time.perf_counter()
+        if self._lock.acquire(blocking=False): # A running sync holds the lock while embedding; don't wait for it
+            try:
+                self._load_if_changed()
+            finally:
+                self._lock.release()
+        segments = list(self._segments or ())
+        self.schedule_sync()
+        segments = [(ids, vectors) for ids, vectors in segments if len(ids)]
+        if not segments:
+            return None # Nothing indexed yet; callers fall back to recent messages
+        query_vector = self.embedder.embed([query_text.strip()[:MAX_TEXT_CHARS]])[0]
+        ids = np.concatenate([seg_ids for seg_ids, _ in segments])
+        scores = np.concatenate([np.asarray(vectors) @ query_vector for _, vectors in segments])
+        min_score = self.min_score if self.min_score is not None else getattr(self.embedder, "min_score", 0.0)
+        scores = np.where(scores > min_score, scores, -np.inf)
+
+        if property_id or since or until:
+            allowed = db.session.query(Message.id)
+            if property_id:
+                allowed = allowed.filter(Message.property_id == property_id)
+            if since:
+                allowed = allowed.filter(Message.timestamp >= since)
+            if until:
+                allowed = allowed.filter(Message.timestamp < until)
+            allowed_ids = np.fromiter((row[0] for row in allowed), dtype=np.int64)
+            scores = np.where(np.isin(ids, allowed_ids), scores, -np.inf)
+
+        k = min(k, len(scores))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = [(int(ids[i]), float(scores[i])) for i in top if np.isfinite(scores[i])]
+        self.searches += 1
+        self.total_search_ms += (time.perf_counter() - started) * 1000
+        return results
+
+    def stats(self):
+        return {
+            "available": self.available,
+            "embedder": self.embedder.name if self.embedder else None,
+            "indexed": self.size,
+            "segments": len(self._segments or ()),
+            "last_message_id": self._last_id,
+            "embedded_this_process": self.embedded,
+            "searches": self.searches,
+            "avg_search_ms": round(self.total_search_ms / self.searches, 3) if self.searches else None,
+        }
+
+
+semantic_index = SemanticIndex()
+
+
+@click.command("rebuild-semantic-index")
+@click.option("--batch-size", default=SYNC_BATCH_SIZE, show_default=True)
+@with_appcontext
+def rebuild_semantic_index_command(batch_size):
+    """Re-embed every message into the semantic search index."""
+    if not semantic_index.available:
+        raise click.ClickException("Semantic index unavailable (is numpy installed?).")
+    started = time.time()
+    total = semantic_index.rebuild(batch_size)
+    click.echo(f"done: {total} messages embedded with {semantic_index.embedder.name} in {time.time() - started:.1f}s")
@@ -0,0 +1,87 @@
+# sid_filter.py
+# In-memory bloom filter of recently ingested message SIDs, checked before any database work.
+
+import os
+import math
+import hashlib
+import threading
+
+
+class RecentSidFilter:
+    """Rotating two-generation bloom filter of recently seen SIDs.
+
+    Each generation holds up to `capacity` SIDs at `error_rate` false positives. When the
+    current generation fills it becomes the previous one and a fresh generation starts, so
+    memory stays fixed and the filter always remembers at least the last `capacity` SIDs.
+    A false positive would drop a new message, which is why the default rate is one in a
+    million; set capacity to 0 to disable the filter entirely.
+    """
+
+    def __init__(self, capacity=100000, error_rate=1e-6):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.enabled = capacity > 0
+        self._lock = threading.Lock()
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))) if self.enabled else 0
+        self.num_hashes = max(1, int(round(self.num_bits / max(capacity, 1) * math.log(2))))
+        self._current = self._new_generation()
+        self._previous = None
+        self._count = 0
+        self.checks = 0
+        self.rejections = 0
+
+    def _new_generation(self):
+        return bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, sid):
+        digest = hashlib.blake2b(sid.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    @staticmethod
+    def _has_all(bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def add(self, sid):
+        if not self.enabled or not sid:
+            return
+        positions = self._positions(sid)
+        with self._lock:
+            if self._has_all(self._current, positions):
+                return
+            if self._count >= self.capacity:
+                self._previous, self._current, self._count = self._current, self._new_generation(), 0
+            for p in positions:
+                self._current[p >> 3] |= 1 << (p & 7)
+            self._count += 1
+
+    def seen(self, sid):
+        """True if sid was (almost certainly) added recently; counts the check as a rejection."""
+        if not self.enabled or not sid:
+            return False
+        positions = self._positions(sid)
+        current, previous = self._current, self._previous
+        self.checks += 1
+        hit = self._has_all(current, positions) or (previous is not None and self._has_all(previous, positions))
+        if hit:
+            self.rejections += 1
+        return hit
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "capacity_per_generation": self.capacity,
+            "error_rate": self.error_rate,
+            "bits_per_generation": self.num_bits,
+            "hashes": self.num_hashes,
+            "current_generation_fill": self._count,
+            "checks": self.checks,
+            "rejected_before_db": self.rejections,
+        }
+
+
+recent_sids = RecentSidFilter(
+    capacity=int(os.getenv("SID_FILTER_CAPACITY", "100000")),
+    error_rate=float(os.getenv("SID_FILTER_ERROR_RATE", "1e-6")),
+)
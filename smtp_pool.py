@@ -0,0 +1,212 @@
+# smtp_pool.py
+# Persistent SMTP connections for the SMTP email backend (EMAIL_BACKEND=smtp: email_utils.send_email_batch,
+# which the outbox email sender uses, and email_utils._send_via_smtp).
+#
+# Opening a connection costs a TCP connect, the banner, EHLO, STARTTLS (or an SSL handshake) and AUTH -
+# several round trips and a TLS handshake per message. The pool keeps up to `size` logged-in connections
+# per process and hands each to one sending thread at a time. Idle connections older than max_idle
+# seconds are closed instead of reused (servers drop them), and a connection is recycled after
+# max_messages sends (many servers cap messages per session). When a reused connection turns out to
+# be dead the message is retried once on a fresh connection. size=0 disables pooling: every message
+# gets its own connection, as before.
+
+import os
+import ssl
+import time
+import smtplib
+import threading
+
+from contextlib import contextmanager
+
+# Errors meaning the connection (not the message) is bad: reconnect and retry once
+_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError)
+
+
+class _PooledConnection:
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.last_used = time.monotonic()
+        self.sent = 0
+
+
+class SMTPConnectionPool:
+    """Thread-safe pool of logged-in SMTP connections to one server."""
+
+    def __init__(self, host, port=587, username=None, password=None, security=None, size=4,
+                 max_idle=60, max_messages=100, timeout=30, context=None):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        # "ssl" (implicit TLS), "starttls" or "none"; defaults by port like the old per-message code
+        self.security = security or ("ssl" if self.port == 465 else "starttls")
+        self.size = size
+        self.max_idle = max_idle
+        self.max_messages = max_messages
+        self.timeout = timeout
+        self.context = context or ssl.create_default_context()
+        self._idle = [] # most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size) if size > 0 else None
+        self._pid = os.getpid()
+        self.opened = 0
+        self.reused = 0
+        self.reconnects = 0
+        self.sent = 0
+        self.failed = 0
+
+    def _open(self):
+        if self.security == "ssl":
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout, context=self.context)
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == "starttls":
+                smtp.starttls(context=self.context)
+        try:
+            if self.username:
+                smtp.login(self.username, self.password)
+        except Exception:
+            self._close(smtp)
+            raise
+        self.opened += 1
+        return _PooledConnection(smtp)
+
+    @staticmethod
+    def _close(smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def _check_fork(self):
+        # Sockets inherited from a parent process (gunicorn preload) must not be shared with it
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = []
+                    self._slots = threading.BoundedSemaphore(self.size) if self.size > 0 else None
+                    self._pid = os.getpid()
+
+    def _checkout(self):
+        """An idle connection that is still fresh, or None."""
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate = self._idle.pop()
+                if now - candidate.last_used < self.max_idle:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+            stale.extend(self._expired_locked(now))
+        for old in stale:
+            self._close(old.smtp)
+        return conn
+
+    def _expired_locked(self, now):
+        expired = [c for c in self._idle if now - c.last_used >= self.max_idle]
+        if expired:
+            self._idle = [c for c in self._idle if now - c.last_used < self.max_idle]
+        return expired
+
+    def _checkin(self, conn):
+        conn.last_used = time.monotonic()
+        if conn.sent >= self.max_messages:
+            self._close(conn.smtp)
+            return
+        with self._lock:
+            self._idle.append(conn)
+
+    @contextmanager
+    def _slot(self):
+        if self._slots is None:
+            yield
+            return
+        self._slots.acquire() # Wait for a free connection rather than exceed the pool size
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        """Send an email.message.Message over a pooled connection (reconnecting once if it died)."""
+        if self.size <= 0:
+            conn = self._open()
+            try:
+                result = conn.smtp.send_message(msg, from_addr, to_addrs)
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self._close(conn.smtp)
+            self.sent += 1
+            return result
+
+        self._check_fork()
+        with self._slot():
+            conn = self._checkout()
+            if conn is not None:
+                self.reused += 1
+            for attempt in (1, 2):
+                if conn is None:
+                    conn = self._open()
+                try:
+                    result = conn.smtp.send_message(msg, from_addr, to_addrs)
+                except _CONNECTION_ERRORS:
+                    self._close(conn.smtp)
+                    conn = None
+                    if attempt == 2:
+                        self.failed += 1
+                        raise
+                    self.reconnects += 1
+                    continue
+                except smtplib.SMTPResponseException as e:
+                    # 421: the server is closing the session; anything else leaves it usable after RSET
+                    if e.smtp_code == 421 and attempt == 1:
+                        self._close(conn.smtp)
+                        conn = None
+                        self.reconnects += 1
+                        continue
+                    self._release_after_error(conn)
+                    self.failed += 1
+                    raise
+                except Exception:
+                    self._release_after_error(conn)
+                    self.failed += 1
+                    raise
+                conn.sent += 1
+                self.sent += 1
+                self._checkin(conn)
+                return result
+
+    def _release_after_error(self, conn):
+        try:
+            conn.smtp.rset()
+        except Exception:
+            self._close(conn.smtp)
+            return
+        self._checkin(conn)
+
+    def close(self):
+        """Log out of every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn.smtp)
+
+    def stats(self):
+        return {
+            "server": f"{self.host}:{self.port}",
+            "security": self.security,
+            "size": self.size,
+            "idle": len(self._idle),
+            "opened": self.opened,
+            "reused": self.reused,
+            "reconnects": self.reconnects,
+            "sent": self.sent,
+            "failed": self.failed,
+        }
@@ -0,0 +1,181 @@
+# thumbnails.py
+# Resized derivatives of uploaded images ("thumb" for grids, "medium" for previews), rendered in a process pool.
+#
+# Derivatives are cached on disk in THUMBNAIL_FOLDER (default: "derivatives" next to UPLOAD_FOLDER) as
+# <size>/<ab>/<key>.jpg. For content-addressed uploads the key is the file's SHA-256, so a derivative never
+# goes stale; legacy uploads are keyed by path. Media jobs pre-render new downloads; anything else is
+# rendered on its first request. Pillow is optional - without it the original file is served.
+
+import os
+import uuid
+import hashlib
+import threading
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from flask import current_app
+
+from media_store import media_abspath, cas_sha256
+
+try:
+    from PIL import Image, ImageOps
+except ImportError: # pragma: no cover - optional dependency
+    Image = None
+
+SIZES = {"thumb": 320, "medium": 1024} # Longest edge in pixels
+JPEG_QUALITY = 80
+RENDERABLE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".tif", ".tiff"}
+# Not fork: the serving process already runs media, spool and outbox threads, and a forked child can
+# inherit a lock one of them held at that moment and deadlock on it. forkserver children start from a
+# clean single-threaded server process (spawn where forkserver is unavailable).
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+def render_derivative(src_path, dest_path, max_edge):
+    """Write a JPEG of src_path no larger than max_edge on either side. Runs in a worker process."""
+    with Image.open(src_path) as img:
+        img = ImageOps.exif_transpose(img) # Phone photos are often stored rotated
+        img.thumbnail((max_edge, max_edge))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        tmp_path = f"{dest_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            img.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.replace(tmp_path, dest_path) # Atomic, so a concurrent request never reads a partial file
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return dest_path
+
+
+class ThumbnailService:
+    """Renders and caches image derivatives; one lazily created process pool per serving process."""
+
+    def __init__(self, app=None):
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = {} # dest_path -> Future, so concurrent requests share one render
+        self.folder = None
+        self.upload_dir = None
+        self.max_workers = 2
+        self.wait_seconds = 15
+        self.rendered = 0
+        self.cache_hits = 0
+        self.failures = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.upload_dir = app.config.get("UPLOAD_FOLDER")
+        default_folder = os.path.join(os.path.dirname(self.upload_dir.rstrip("/")), "derivatives") if self.upload_dir else None
+        self.folder = os.getenv("THUMBNAIL_FOLDER", default_folder)
+        self.max_workers = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+        self.wait_seconds = float(os.getenv("THUMBNAIL_WAIT_SECONDS", "15"))
+        app.extensions["thumbnails"] = self
+
+    @property
+    def available(self):
+        return Image is not None and bool(self.folder and self.upload_dir)
+
+    def _get_executor(self):
+        # Created lazily so the pool's processes belong to the (possibly forked) serving process
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context(START_METHOD))
+            return self._executor
+
+    def derivative_path(self, rel_path, size):
+        """Cache location for a derivative of rel_path (no check that it exists)."""
+        key = cas_sha256(rel_path) or hashlib.sha256(rel_path.replace("\\", "/").encode("utf-8")).hexdigest()
+        return os.path.join(self.folder, size, key[:2], key + ".jpg")
+
+    def can_render(self, rel_path, size):
+        return (
+            self.available
+            and size in SIZES
+            and os.path.splitext(rel_path)[1].lower() in RENDERABLE_EXTENSIONS
+        )
+
+    def _submit(self, rel_path, size):
+        """(dest_path, Future) for the derivative; the future is None when it is already on disk."""
+        dest_path = self.derivative_path(rel_path, size)
+        if os.path.exists(dest_path):
+            return dest_path, None
+        executor = self._get_executor()
+        with self._pending_lock:
+            future = self._pending.get(dest_path)
+            submitted = future is None
+            if submitted:
+                src_path = media_abspath(rel_path, self.upload_dir)
+                future = executor.submit(render_derivative, src_path, dest_path, SIZES[size])
+                self._pending[dest_path] = future
+        if submitted:
+            # Outside the lock: an already finished future runs the callback right away
+            future.add_done_callback(lambda f, key=dest_path: self._finished(key, f))
+        return dest_path, future
+
+    def _finished(self, dest_path, future):
+        with self._pending_lock:
+            self._pending.pop(dest_path, None)
+        error = future.exception()
+        if error is not None:
+            self.failures += 1
+            if isinstance(error, BrokenProcessPool):
+                with self._lock:
+                    self._executor = None # A worker died; the next render starts a fresh pool
+        else:
+            self.rendered += 1
+
+    def get(self, rel_path, size):
+        """Filesystem path of the size derivative of rel_path, rendering it first if needed.
+
+        Returns None when it can't be produced (no Pillow, not an image, unreadable file or a
+        render that took longer than THUMBNAIL_WAIT_SECONDS); callers then serve the original.
+        """
+        if not self.can_render(rel_path, size):
+            return None
+        if not os.path.exists(media_abspath(rel_path, self.upload_dir)):
+            return None
+        dest_path, future = self._submit(rel_path, size)
+        if future is None:
+            self.cache_hits += 1
+            return dest_path
+        try:
+            return future.result(timeout=self.wait_seconds)
+        except FutureTimeout:
+            current_app.logger.warning(f"⚠️ Thumbnail for {rel_path} ({size}) still rendering; serving original.")
+        except Exception as e:
+            current_app.logger.warning(f"⚠️ Could not render {size} thumbnail for {rel_path}: {e}")
+        return None
+
+    def schedule(self, rel_paths, sizes=("thumb",)):
+        """Queue derivatives for new uploads without waiting (used after media downloads)."""
+        queued = 0
+        try:
+            for rel_path in rel_paths:
+                for size in sizes:
+                    if self.can_render(rel_path, size):
+                        _, future = self._submit(rel_path, size)
+                        queued += future is not None
+        except Exception as e:
+            # Rendering is an optimization; requests fall back to rendering lazily
+            current_app.logger.warning(f"⚠️ Could not queue thumbnails: {e}")
+        return queued
+
+    def stats(self):
+        return {
+            "available": self.available,
+            "workers": self.max_workers,
+            "pending": len(self._pending),
+            "rendered_this_process": self.rendered,
+            "cache_hits": self.cache_hits,
+            "failures": self.failures,
+        }
+
+
+thumbnail_service = ThumbnailService()
@@ -1,18 +1,20 @@
 # webhook_route.py
 
-import os
 import traceback
-import base64
-import mimetypes
-import requests
-import uuid # Import uuid for unique filenames
 
-from urllib.parse import urlparse
 from datetime import datetime
 from flask import Blueprint, request, Response, current_app # Import current_app
 from extensions import db
 from models import Contact, Message
-from email_utils import send_email, wrap_email_html # Assuming this utility exists
+from media_jobs import media_job_runner
+from ingest import parse_webhook_event, InvalidWebhookEvent
+from webhook_spool import webhook_spool
+from contact_cache import lookup_contact, remember_contact
+from db_utils import dialect_insert
+from sid_filter import recent_sids
+from message_stats import message_stats
+from search_index import search_index
+from semantic_index import semantic_index
 
 # Define the Blueprint
 webhook_bp = Blueprint("webhook", __name__, url_prefix="/webhook") # Added url_prefix for clarity
@@ -26,270 +28,99 @@ def webhook():
         data = request.get_json(force=True) or {}
         current_app.logger.debug(f"Webhook payload received: {data}") # Log the whole payload
 
-        event_type = data.get("type", "")
-        # Navigate the payload structure (adjust if OpenPhone's structure differs)
-        # Assuming the relevant object is nested under 'data' -> 'object'
-        payload_data = data.get("data", {})
-        obj = payload_data.get("object", {}) if isinstance(payload_data, dict) else {}
-
-        # Extract essential info
-        sid = obj.get("sid") or obj.get("id") # Unique ID for the message event
-        if not sid:
-            current_app.logger.error("❌ Missing message SID/ID in webhook payload.")
-            return Response("Bad Request: Missing unique message ID.", status=400)
-
-        # Determine direction based on event type (adjust keywords if necessary)
-        direction = "incoming" if "received" in event_type.lower() else "outgoing"
-
-        # Extract phone number based on direction
-        phone = obj.get("from") if direction == "incoming" else obj.get("to")
-        current_app.logger.debug(f"Extracted raw phone number: {phone} (Direction: {direction})")
-
-        # --- CRITICAL PHONE NUMBER CHECK ---
-        if not phone:
-            current_app.logger.error("❌ Webhook error: Phone number is missing or null in payload!")
-            return Response("Bad Request: Missing phone number.", status=400)
-        # --- END CHECK ---
+        # Extract essential info (sid, direction, phone, text, media URLs)
+        try:
+            event = parse_webhook_event(data)
+        except InvalidWebhookEvent as bad:
+            current_app.logger.error(f"❌ Rejecting webhook payload: {bad}")
+            return Response(str(bad), status=400)
+
+        # Replayed SIDs seen recently by this worker are answered without touching the database
+        if recent_sids.seen(event["sid"]):
+            current_app.logger.info(f"🔁 SID {event['sid']} was ingested recently. No action needed.")
+            return Response("Webhook OK (Existing Message SID)", status=200)
 
-        text = obj.get("body", "")
-        media = obj.get("media") or [] # Ensure media is a list
-        # Filter URLs robustly
-        urls = [m.get("url") for m in media if isinstance(m, dict) and isinstance(m.get("url"), str)]
+        # Spool mode: persist the raw payload locally and let the batch consumer write it
+        if webhook_spool.enabled:
+            spool_id = webhook_spool.append(data)
+            current_app.logger.info(f"📥 Spooled webhook SID {event['sid']} as spool entry {spool_id}.")
+            return Response("Webhook OK (Queued)", status=200)
 
+        sid, direction, phone, key = event["sid"], event["direction"], event["phone"], event["key"]
+        text, urls = event["text"], event["urls"]
         current_app.logger.info(f"🔹 SID: {sid}, Direction: {direction}, Phone: {phone}, Text: '{text[:50]}...', Media URLs: {len(urls)}")
 
         # --- Contact Handling ---
-        # Normalize phone number to create a consistent key (last 10 digits)
-        key = "".join(filter(str.isdigit, phone))[-10:]
+        # Contacts are keyed by the phone normalized to its last 10 digits
         if len(key) != 10:
              current_app.logger.warning(f"⚠️ Could not normalize phone '{phone}' to 10-digit key. Using raw: '{key}'. Check format.")
-             # Consider how to handle this - maybe reject, or use the raw key if it's unique enough?
-             # For now, we proceed with the potentially non-standard key.
 
-        contact = Contact.query.get(key)
-        if not contact:
-            current_app.logger.info(f"ℹ️ Contact not found for key '{key}'. Creating new contact.")
-            # Create contact with raw phone as default name if lookup fails
-            contact = Contact(phone_number=key, contact_name=phone)
-            db.session.add(contact)
-            try:
-                # Commit contact separately to ensure it exists before message linking
-                db.session.commit()
-                current_app.logger.info(f"✅ Created Contact: {contact.contact_name} (Phone Key: {key})")
-            except Exception as e:
-                db.session.rollback()
-                current_app.logger.error(f"❌ Error saving new contact (Key: {key}): {e}")
-                traceback.print_exc()
-                # Decide if this is fatal - maybe continue without contact association?
-                return Response("Internal Server Error: Could not save contact.", 500)
+        contact_name, contact_exists = lookup_contact(key)
+        if contact_exists:
+            current_app.logger.info(f"✅ Found Contact: {contact_name} (Phone Key: {key})")
         else:
-            current_app.logger.info(f"✅ Found Contact: {contact.contact_name} (Phone Key: {key})")
+            # New contacts default to the raw phone as their name; inserted with the message below
+            contact_name = phone
+            current_app.logger.info(f"ℹ️ Contact not found for key '{key}'. Creating new contact.")
 
         # --- Message Handling ---
-        msg = Message.query.filter_by(sid=sid).first()
-
-        if not msg:
-            current_app.logger.info(f"ℹ️ Message with SID {sid} not found. Creating new message.")
-            msg = Message(
-                sid=sid,
-                phone_number=key, # Link to contact via the normalized phone key
-                contact_name=contact.contact_name, # Store name at time of message creation
-                direction=direction,
-                message=text,
-                media_urls=",".join(urls) if urls else None,
-                timestamp=datetime.utcnow(), # Use UTC time for consistency
-                local_media_paths=None, # Initialize as None
-                # property_id=None # Ensure default/handling elsewhere if used
-            )
-            db.session.add(msg)
-            try:
-                # Commit here to get the msg.id needed for unique filenames
-                db.session.commit()
-                current_app.logger.info(f"✅ Created Message record with DB id={msg.id} linked to key='{key}'")
-            except Exception as e:
+        # One INSERT ... ON CONFLICT (sid) DO NOTHING RETURNING id both dedups and creates the row,
+        # so concurrent retries of the same event can't race past a separate existence check.
+        received_at = datetime.utcnow()
+        try:
+            if not contact_exists:
+                # ON CONFLICT DO NOTHING covers a contact created concurrently by another worker
+                db.session.execute(
+                    dialect_insert(Contact.__table__).on_conflict_do_nothing(index_elements=["phone_number"]),
+                    {"phone_number": key, "contact_name": contact_name, "created_at": datetime.utcnow()},
+                )
+            msg_id = db.session.execute(
+                dialect_insert(Message.__table__)
+                .values(
+                    sid=sid,
+                    phone_number=key, # Link to contact via the normalized phone key
+                    contact_name=contact_name, # Store name at time of message creation
+                    direction=direction,
+                    message=text,
+                    media_urls=",".join(urls) if urls else None,
+                    timestamp=received_at, # Use UTC time for consistency
+                    local_media_paths=None, # Filled in by the media job once downloads finish
+                )
+                .on_conflict_do_nothing(index_elements=["sid"])
+                .returning(Message.__table__.c.id)
+            ).scalar()
+
+            if msg_id is None:
+                # Message with this SID already processed.
                 db.session.rollback()
-                current_app.logger.error(f"❌ Error saving new message record (SID: {sid}): {e}")
-                # This is where the IntegrityError might happen if 'key' is somehow NULL,
-                # but we checked 'phone' earlier. Log the key value here for debugging.
-                current_app.logger.error(f"   Message details: phone_key='{key}', direction='{direction}', sid='{sid}'")
-                traceback.print_exc()
-                return Response("Internal Server Error: Could not save message record.", 500)
-        else:
-            # Message with this SID already processed.
-            current_app.logger.info(f"🔁 Found existing Message record with DB id={msg.id} (SID: {sid}). No action needed.")
-            # Respond OK early to prevent re-processing (e.g., re-downloading media)
-            return Response("Webhook OK (Existing Message SID)", status=200)
-
-        # --- Media Downloading and Saving (Only for NEW incoming messages with URLs) ---
-        saved_paths = []
-        upload_dir = current_app.config.get('UPLOAD_FOLDER') # Get from app config
-        if not upload_dir:
-             current_app.logger.error("❌ UPLOAD_FOLDER is not configured in the app!")
-             # Cannot save media, maybe continue without it? Or return error?
-             # For now, log error and skip media processing. Email won't have attachments.
-             urls = [] # Clear URLs so loop is skipped
-
-        # Ensure the target directory exists
-        if upload_dir:
-             os.makedirs(upload_dir, exist_ok=True)
-             current_app.logger.info(f"ℹ️ Upload directory target: {upload_dir}")
-
-        if direction == "incoming" and urls and upload_dir: # Check upload_dir exists
-            current_app.logger.info(f"⏳ Starting media download for {len(urls)} URL(s)...")
-            for idx, url in enumerate(urls):
-                try:
-                    current_app.logger.debug(f"   Downloading media {idx+1}/{len(urls)} from: {url}")
-                    resp = requests.get(url, stream=True, timeout=30)
-                    resp.raise_for_status()
-
-                    content_type = resp.headers.get("Content-Type", "").split(";")[0].strip()
-                    extension = mimetypes.guess_extension(content_type) or ".dat"
-                    extension = ".jpg" if extension.lower() in [".jpe", ".jpeg"] else extension
-                    extension = ".mp3" if content_type == "audio/mpeg" else extension
-
-                    unique_id = str(uuid.uuid4())[:8]
-                    filename = f"msg{msg.id}_{idx+1}_{unique_id}{extension}" # Unique filename
-                    full_save_path = os.path.join(upload_dir, filename)
-                    current_app.logger.debug(f"   Attempting to save to: {full_save_path}")
-
-                    bytes_written = 0
-                    with open(full_save_path, "wb") as f:
-                        for chunk in resp.iter_content(chunk_size=8192):
-                            f.write(chunk)
-                            bytes_written += len(chunk)
-
-                    if os.path.exists(full_save_path):
-                        current_app.logger.info(f"   ✅ File saved successfully: {filename} ({bytes_written} bytes)")
-                        # Path relative to static folder root (e.g., "uploads/filename.jpg")
-                        relative_path = os.path.join(os.path.basename(upload_dir), filename)
-                        saved_paths.append(relative_path)
-                    else:
-                        current_app.logger.error(f"   ❌ CRITICAL ERROR: File NOT FOUND immediately after saving: {full_save_path}")
-
-                except requests.exceptions.RequestException as req_ex:
-                    current_app.logger.warning(f"   ⚠️ Network/HTTP error downloading media {idx+1} ({url}): {req_ex}")
-                except IOError as io_err:
-                    current_app.logger.error(f"   ⚠️ File system error saving media {idx+1} ({url}): {io_err}")
-                    traceback.print_exc()
-                except Exception as ex:
-                    current_app.logger.error(f"   ⚠️ Unexpected error processing media {idx+1} ({url}): {ex}")
-                    traceback.print_exc()
-
-            # Update Message with Saved Paths (if any files were successfully saved)
-            if saved_paths:
-                current_app.logger.info(f"ℹ️ Attempting to update message {msg.id} with paths: {saved_paths}")
-                msg.local_media_paths = ",".join(saved_paths)
-                try:
-                    current_app.logger.debug(f"   ⏳ Committing update for local_media_paths for message {msg.id}...")
-                    db.session.commit()
-                    current_app.logger.info(f"   ✅ Successfully committed local_media_paths update for message {msg.id}.")
-                except Exception as e:
-                    db.session.rollback()
-                    current_app.logger.error(f"   ❌ Error committing local_media_paths update for message {msg.id}: {e}")
-                    traceback.print_exc()
-                    # Consider implications - message exists but paths aren't saved in DB
-            else:
-                current_app.logger.info(f"ℹ️ No media paths were successfully saved for message {msg.id}.")
-
-        # --- Email Notification Logic ---
-        if direction == "incoming":
-            to_addr = os.getenv("SENDGRID_TO_EMAIL")
-            if to_addr:
-                current_app.logger.info("📧 Preparing email notification...")
-                attachments = []
-                if upload_dir: # Only try attaching if upload dir was valid
-                    for rel_path in saved_paths:
-                        # Use app context for robust path construction
-                        full_path = os.path.join(upload_dir, os.path.basename(rel_path))
-                        if os.path.exists(full_path):
-                            try:
-                                with open(full_path, "rb") as f:
-                                    # Read file content directly for Base64 encoding
-                                    file_content_bytes = f.read()
-                                # Pass the raw bytes to send_email, let it handle encoding
-                                attachments.append({
-                                    "content_bytes": file_content_bytes, # Pass bytes
-                                    "type": mimetypes.guess_type(full_path)[0] or "application/octet-stream",
-                                    "filename": os.path.basename(full_path),
-                                })
-                                current_app.logger.debug(f"   📎 Added attachment data: {os.path.basename(full_path)}")
-                            except Exception as read_err:
-                                current_app.logger.warning(f"   ⚠️ Error reading file for email attachment ({full_path}): {read_err}")
-                        else:
-                            current_app.logger.warning(f"   ⚠️ File path found in saved_paths but not found on disk for email attachment: {full_path}")
-                else:
-                     current_app.logger.warning("   ⚠️ Skipping email attachments because UPLOAD_FOLDER is not configured.")
-
-
-                email_subject = f"New message from {contact.contact_name}"
-                # email_plain_content = text or f"Message from {contact.contact_name} with {len(attachments)} attachment(s)." # Removed
-                # Ensure HTML is escaped properly if `text` contains HTML
-                # Using a simple pre-wrap for now. Consider html.escape if needed.
-                # Get property information if available
-                property_info = ""
-                if msg.property:
-                    property_info = f"""
-                    <div class="info-row">
-                        <span class="info-label">Property:</span>
-                        <span class="info-value">{msg.property.name} - {msg.property.address}</span>
-                    </div>
-                    """
-                
-                email_html_content = wrap_email_html(f"""
-                    <h3 style="color: #212529; margin-bottom: 20px;">New Message from {contact.contact_name}</h3>
-                    
-                    <div style="background-color: #f8f9fa; padding: 15px; border-radius: 4px; margin-bottom: 20px;">
-                        <div class="info-row">
-                            <span class="info-label">From:</span>
-                            <span class="info-value">{contact.contact_name} ({phone})</span>
-                        </div>
-                        {property_info}
-                        <div class="info-row">
-                            <span class="info-label">Time:</span>
-                            <span class="info-value">{msg.timestamp.strftime('%B %d, %Y at %I:%M %p')}</span>
-                        </div>
-                        <div class="info-row" style="border-bottom: none;">
-                            <span class="info-label">Message ID:</span>
-                            <span class="info-value">#{msg.id}</span>
-                        </div>
-                    </div>
-                    
-                    <div class="message-box">
-                        <h4 style="margin: 0 0 10px 0; color: #495057; font-size: 14px;">Message Content:</h4>
-                        <p class="message-text">{text or '(No text content)'}</p>
-                    </div>
-                    
-                    {f'<div class="attachment-notice"><strong>📎 {len(attachments)} Attachment(s) included</strong></div>' if attachments else ''}
-                    
-                    <div style="margin-top: 30px; padding-top: 20px; border-top: 1px solid #e9ecef;">
-                        <p style="color: #6c757d; font-size: 14px; margin: 0;">
-                            <strong>Quick Actions:</strong><br>
-                            View this conversation in your dashboard: 
-                            <a href="https://openphone-monitor-production.up.railway.app/messages?view=conversation" style="color: #3a8bab;">
-                                Open Conversation View
-                            </a>
-                        </p>
-                    </div>
-                """)
-
-                try:
-                    current_app.logger.info(f"   Sending email to {to_addr}...")
-                    # **** EDITED send_email call ****
-                    send_email(
-                        to_emails=[to_addr], # Changed: Pass as list
-                        subject=email_subject,
-                        # plain_content=email_plain_content, # Removed: Assuming not needed by send_email
-                        html_content=email_html_content,
-                        attachments=attachments if attachments else None # Changed: Pass the list of dicts
-                    )
-                    current_app.logger.info("   ✅ Email sent successfully.")
-                except Exception as e:
-                    current_app.logger.error(f"   ❌ Email send failed: {e}")
-                    traceback.print_exc()
-            else:
-                current_app.logger.warning("⚠️ No SENDGRID_TO_EMAIL configured; skipping email notification.")
+                recent_sids.add(sid)
+                current_app.logger.info(f"🔁 Message with SID {sid} already exists. No action needed.")
+                # Respond OK early to prevent re-processing (e.g., re-downloading media)
+                return Response("Webhook OK (Existing Message SID)", status=200)
+
+            # Media download + email run in the background; the job row commits with the message
+            job = media_job_runner.enqueue(msg_id, phone=phone) if direction == "incoming" else None
+            search_index.index_messages([msg_id])
+            db.session.commit()
+            recent_sids.add(sid)
+            message_stats.record_new_messages([received_at])
+            semantic_index.schedule_sync()
+            current_app.logger.info(f"✅ Created Message record with DB id={msg_id} linked to key='{key}'")
+            if not contact_exists:
+                remember_contact(key, contact_name)
+                current_app.logger.info(f"✅ Created Contact: {contact_name} (Phone Key: {key})")
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"❌ Error saving new message record (SID: {sid}): {e}")
+            current_app.logger.error(f"   Message details: phone_key='{key}', direction='{direction}', sid='{sid}'")
+            traceback.print_exc()
+            return Response("Internal Server Error: Could not save message record.", 500)
+
+        if job:
+            media_job_runner.submit(job.id)
+            current_app.logger.info(f"⏳ Queued media job {job.id} for message {msg_id} ({len(urls)} media URL(s)).")
         else:
-            current_app.logger.info("ℹ️ Skipping email notification (outgoing message).")
+            current_app.logger.info("ℹ️ Skipping media download and email notification (outgoing message).")
 
         # --- Final Response ---
         current_app.logger.info("✅ Webhook processed successfully.")
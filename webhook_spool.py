@@ -0,0 +1,229 @@
+# webhook_spool.py
+# Durable local spool for webhook payloads (SQLite in WAL mode) and the consumer that drains it in batches.
+# Enabled with WEBHOOK_INGEST_MODE=spool; the default 'direct' mode writes to the database inside the request.
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import traceback
+
+from collections import deque
+from contextlib import contextmanager
+from flask import current_app
+from extensions import db
+from ingest import parse_webhook_event, ingest_events, InvalidWebhookEvent
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    received_at REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_spool_claim ON spool (dead, claimed_by, id);
+"""
+
+
+class WebhookSpool:
+    """Append-only spool of raw webhook payloads with a batching consumer thread.
+
+    The webhook appends and returns; the consumer claims up to batch_size rows, ingests them
+    with one database transaction (ingest.ingest_events) and deletes them once committed.
+    Claims are per process, so several gunicorn workers can drain the same spool file.
+    Malformed payloads are kept as dead rows instead of being retried.
+    """
+
+    def __init__(self, app=None):
+        self._app = None
+        self.path = None
+        self.enabled = False
+        self.batch_size = 200
+        self.poll_seconds = 0.5
+        self.max_attempts = 50
+        self.claim_timeout = 300
+        self._worker_id = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._recent = deque() # (finished_at, events) for the rolling throughput window
+        self.consumed = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_batch = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._app = app
+        self.enabled = os.getenv("WEBHOOK_INGEST_MODE", "direct").lower() == "spool"
+        self.path = os.getenv("WEBHOOK_SPOOL_PATH", os.path.join(app.instance_path, "webhook_spool.db"))
+        self.batch_size = int(os.getenv("WEBHOOK_SPOOL_BATCH_SIZE", "200"))
+        self.poll_seconds = float(os.getenv("WEBHOOK_SPOOL_POLL_SECONDS", "0.5"))
+        self.max_attempts = int(os.getenv("WEBHOOK_SPOOL_MAX_ATTEMPTS", "50"))
+        app.extensions["webhook_spool"] = self
+        if self.enabled:
+            with self._connect() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(SCHEMA)
+            app.logger.info(f"✅ Webhook spool enabled at {self.path} (batch size {self.batch_size}).")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute("PRAGMA synchronous=NORMAL") # Durable across process crashes in WAL mode
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    # --- Producer side ---
+
+    def append(self, payload):
+        """Durably store one raw payload (dict) and return its spool id."""
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO spool (payload, received_at) VALUES (?, ?)",
+                (json.dumps(payload), time.time()),
+            )
+            return cur.lastrowid
+
+    # --- Consumer side ---
+
+    def depth(self):
+        with self._connect() as conn:
+            queued, dead = conn.execute(
+                "SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead = 1), 0) FROM spool"
+            ).fetchone()
+        return queued, dead
+
+    def _claim_batch(self, limit):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                """UPDATE spool SET claimed_by = ?, claimed_at = ?
+                   WHERE id IN (SELECT id FROM spool
+                                WHERE dead = 0 AND (claimed_by IS NULL OR claimed_at < ?)
+                                ORDER BY id LIMIT ?)""",
+                (self._worker_id, now, now - self.claim_timeout, limit),
+            )
+            return conn.execute(
+                "SELECT id, payload, received_at, attempts FROM spool WHERE claimed_by = ? AND dead = 0 ORDER BY id",
+                (self._worker_id,),
+            ).fetchall()
+
+    def _ack(self, ids):
+        if ids:
+            with self._connect() as conn:
+                conn.executemany("DELETE FROM spool WHERE id = ?", [(i,) for i in ids])
+
+    def _fail(self, rows, error, dead=False):
+        with self._connect() as conn:
+            for row_id, _, _, attempts in rows:
+                is_dead = dead or attempts + 1 >= self.max_attempts
+                conn.execute(
+                    "UPDATE spool SET claimed_by = NULL, claimed_at = NULL, attempts = attempts + 1, last_error = ?, dead = ? WHERE id = ?",
+                    (str(error)[:1000], 1 if is_dead else 0, row_id),
+                )
+
+    def drain_once(self):
+        """Claim and ingest one batch. Returns the number of spool rows handled (0 when empty)."""
+        if self._worker_id is None:
+            self._worker_id = f"{os.getpid()}-{threading.get_ident()}"
+        rows = self._claim_batch(self.batch_size)
+        if not rows:
+            return 0
+
+        started = time.time()
+        parsed = []
+        for row in rows:
+            try:
+                parsed.append((row, parse_webhook_event(json.loads(row[1]))))
+            except (ValueError, InvalidWebhookEvent) as e:
+                current_app.logger.error(f"❌ Dropping malformed spooled webhook {row[0]}: {e}")
+                self._fail([row], e, dead=True)
+
+        try:
+            ingest_events([event for _, event in parsed])
+            self._ack([row[0] for row, _ in parsed])
+        except Exception as batch_err:
+            db.session.rollback()
+            self.failures += 1
+            current_app.logger.warning(f"⚠️ Spool batch of {len(parsed)} failed ({batch_err}); retrying events one at a time.")
+            succeeded, last_err = 0, None
+            for row, event in parsed:
+                try:
+                    ingest_events([event])
+                    self._ack([row[0]])
+                    succeeded += 1
+                except Exception as e:
+                    db.session.rollback()
+                    self._fail([row], e)
+                    last_err = e
+            if not succeeded and last_err is not None:
+                # Nothing went through (e.g. database down) - let the consumer back off
+                raise last_err
+
+        finished = time.time()
+        self.consumed += len(parsed)
+        self.batches += 1
+        self._recent.append((finished, len(parsed)))
+        self.last_batch = {
+            "events": len(parsed),
+            "seconds": round(finished - started, 4),
+            "events_per_sec": round(len(parsed) / max(finished - started, 1e-6), 1),
+        }
+        return len(rows)
+
+    def _consume_forever(self):
+        backoff = self.poll_seconds
+        while not self._stop.is_set():
+            with self._app.app_context():
+                try:
+                    handled = self.drain_once()
+                    backoff = self.poll_seconds
+                except Exception as e:
+                    handled = 0
+                    backoff = min(max(backoff * 2, 1), 60)
+                    current_app.logger.error(f"❌ Webhook spool consumer error (next try in {backoff:.0f}s): {e}")
+                    traceback.print_exc()
+                finally:
+                    db.session.remove()
+            if not handled:
+                self._stop.wait(backoff)
+
+    def start_consumer(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._consume_forever, name="webhook-spool", daemon=True)
+            self._thread.start()
+
+    def stop_consumer(self, timeout=5):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def stats(self):
+        now = time.time()
+        while self._recent and self._recent[0][0] < now - 60:
+            self._recent.popleft()
+        queued, dead = self.depth() if self.enabled else (0, 0)
+        return {
+            "mode": "spool" if self.enabled else "direct",
+            "queue_depth": queued,
+            "dead_letters": dead,
+            "events_consumed": self.consumed,
+            "batches": self.batches,
+            "batch_failures": self.failures,
+            "events_per_sec_1m": round(sum(n for _, n in self._recent) / 60.0, 2),
+            "last_batch": self.last_batch,
+            "consumer_alive": bool(self._thread and self._thread.is_alive()),
+        }
+
+
+webhook_spool = WebhookSpool()